@@ -0,0 +1,422 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# The local API served on the command socket.
+#
+# Requests and responses are JSON objects, one per line.  A request
+# looks like:
+#
+#   {"id": 1, "method": "messages", "params": {"topic": "a/b"}}
+#
+# Query results are streamed back in chunks; the last one has "more"
+# set to false:
+#
+#   {"id": 1, "result": [...], "more": true}
+#   {"id": 1, "result": [...], "more": false}
+#
+# Errors are returned as {"id": 1, "error": "..."}.  After a
+# "subscribe" request, every matching ingest event is sent as
+# {"id": 1, "event": {...}}; if some had to be dropped because the
+# client was not reading fast enough, {"id": 1, "overrun": true,
+# "dropped": n} is sent first.  Lines which are not JSON objects are
+# treated as legacy commands such as "open <url>".
+
+import json
+import logging
+import os
+import socket
+import threading
+
+from concurrent import futures
+try:
+    import selectors
+except ImportError:
+    import selectors2 as selectors
+import paho.mqtt.client as mqtt
+
+from mqtty import db
+from mqtty import events
+from mqtty import notify
+
+# Number of items in each chunk of a streamed result.
+CHUNK_SIZE = 100
+# Bytes queued for a client above which query results wait and
+# subscription events are dropped.
+MAX_BUFFER = 1024 * 1024
+MAX_LINE = 65536
+WORKERS = 2
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class APIError(Exception):
+    pass
+
+
+class Subscription(object):
+    def __init__(self, request_id, topic_filter, reader):
+        self.request_id = request_id
+        self.topic_filter = topic_filter
+        self.reader = reader
+        self.dropped = 0
+
+
+class Client(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.inbuf = b''
+        self.outbuf = bytearray()
+        self.condition = threading.Condition()
+        self.subscriptions = {}
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data, block=True):
+        """Queue a response; may be called from any thread.
+
+        If block is True, wait until the client has read enough of
+        what is already queued, otherwise return False if it has not.
+        """
+        line = (json.dumps(data) + '\n').encode('utf8')
+        with self.condition:
+            while (block and not self.closed and
+                   len(self.outbuf) > MAX_BUFFER):
+                self.condition.wait()
+            if self.closed:
+                return False
+            if len(self.outbuf) > MAX_BUFFER:
+                return False
+            self.outbuf += line
+        self.server.wake()
+        return True
+
+    def flush(self):
+        with self.condition:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error:
+                return False
+            del self.outbuf[:sent]
+            self.condition.notify_all()
+        return True
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.sock.close()
+
+
+class APIServer(object):
+    """Serve the local API to any number of clients.
+
+    Sockets are handled by a single selector thread; queries run in a
+    small thread pool so that a long result does not hold up the
+    other clients.
+    """
+
+    def __init__(self, database, ring, socket_path, command=None):
+        self.log = logging.getLogger('mqtty.api')
+        self.database = database
+        self.ring = ring
+        self.socket_path = socket_path
+        self.command = command
+        self.clients = {}
+        self.topic_names = {}
+        self.executor = futures.ThreadPoolExecutor(WORKERS)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(socket_path)
+        self.socket.listen(16)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.running = True
+
+    def wake(self):
+        try:
+            self.wakeup_w.send(b'x')
+        except socket.error:
+            # Already full, so the selector will wake anyway.
+            pass
+
+    def run(self):
+        while self.running:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.wakeup_r:
+                    self._drainWakeup()
+                elif key.fileobj is self.socket:
+                    self._accept()
+                else:
+                    client = key.fileobj
+                    if mask & selectors.EVENT_READ:
+                        self._read(client)
+                    if mask & selectors.EVENT_WRITE and not client.closed:
+                        if not client.flush():
+                            self._close(client)
+            for client in list(self.clients.values()):
+                try:
+                    self._pump(client)
+                except Exception:
+                    # Lose the event rather than the server.
+                    self.log.exception("Unable to send events to %s" %
+                                       (client,))
+                self._register(client)
+        for client in list(self.clients.values()):
+            self._close(client)
+        self.selector.close()
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def _drainWakeup(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _accept(self):
+        try:
+            sock, addr = self.socket.accept()
+        except socket.error:
+            return
+        self.log.debug("Accepted socket connection %s" % (sock,))
+        sock.setblocking(False)
+        client = Client(self, sock)
+        self.clients[sock.fileno()] = client
+        self.selector.register(client, selectors.EVENT_READ)
+
+    def _register(self, client):
+        if client.closed:
+            return
+        mask = selectors.EVENT_READ
+        if client.outbuf:
+            mask |= selectors.EVENT_WRITE
+        if self.selector.get_key(client).events != mask:
+            self.selector.modify(client, mask)
+
+    def _close(self, client):
+        for sub in client.subscriptions.values():
+            self.ring.removeReader(sub.reader)
+        client.subscriptions = {}
+        self.clients.pop(client.fileno(), None)
+        try:
+            self.selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        client.close()
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error:
+            data = b''
+        if not data:
+            self._close(client)
+            return
+        client.inbuf += data
+        while b'\n' in client.inbuf:
+            line, client.inbuf = client.inbuf.split(b'\n', 1)
+            line = line.strip()
+            if line:
+                self._handle(client, line.decode('utf8', 'replace'))
+        if len(client.inbuf) > MAX_LINE:
+            self.log.debug("Request too long from %s" % (client.sock,))
+            self._close(client)
+
+    def _handle(self, client, line):
+        self.log.debug("Received %s from socket" % (line,))
+        if not line.startswith('{'):
+            parts = line.split()
+            try:
+                self._command(parts[0], parts[1:])
+            except APIError as e:
+                self.log.error(str(e))
+            except Exception:
+                self.log.exception("Unable to run command %s" % (line,))
+            return
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            method = request['method']
+            params = request.get('params', {})
+            if method == 'subscribe':
+                self.subscribe(client, request_id, **params)
+            elif method == 'unsubscribe':
+                self.unsubscribe(client, request_id, **params)
+            elif method == 'open':
+                self._command('open', [params['url']])
+                client.send(dict(id=request_id, result=None, more=False),
+                            block=False)
+            elif method in ('topics', 'messages', 'search'):
+                fn = getattr(self, method)
+                self.executor.submit(self._stream, client, request_id,
+                                     fn, params)
+            else:
+                raise APIError("Unknown method %s" % (method,))
+        except Exception as e:
+            client.send(dict(id=request_id, error=str(e)), block=False)
+
+    def _command(self, command, args):
+        if self.command is None:
+            raise APIError("Command %s is not supported" % (command,))
+        self.command(command, args)
+
+    def _stream(self, client, request_id, fn, params):
+        try:
+            chunk = []
+            for item in fn(**params):
+                if len(chunk) >= CHUNK_SIZE:
+                    if not client.send(dict(id=request_id, result=chunk,
+                                            more=True)):
+                        return
+                    chunk = []
+                chunk.append(item)
+            client.send(dict(id=request_id, result=chunk, more=False))
+        except APIError as e:
+            client.send(dict(id=request_id, error=str(e)))
+        except Exception as e:
+            self.log.exception("Error in API request %s" % (request_id,))
+            client.send(dict(id=request_id, error=str(e)))
+
+    # Queries; these run in the thread pool and yield result items.
+
+    def topics(self, subscribed=False, sort_by='name'):
+        with self.database.getSession() as session:
+            topics = session.getTopics(subscribed=subscribed,
+                                       sort_by=sort_by)
+            counts = session.getMessageCounts()
+        for topic in topics:
+            yield dict(key=topic.key, name=topic.name,
+                       subscribed=bool(topic.subscribed),
+                       messages=counts.get(topic.key, 0))
+
+    def messages(self, topic, after=None, before=None, limit=None,
+                 reverse=False, contains=None):
+        with self.database.getSession() as session:
+            t = session.getTopicByName(topic)
+        if t is None:
+            raise APIError("Unknown topic %s" % (topic,))
+        return self._messages({t.key: t.name}, after, before, limit,
+                              reverse, contains)
+
+    def search(self, topic_filter='#', after=None, before=None, limit=None,
+               reverse=False, contains=None):
+        with self.database.getSession() as session:
+            topics = session.getTopicsByFilter(topic_filter)
+        return self._messages(dict((t.key, t.name) for t in topics),
+                              after, before, limit, reverse, contains)
+
+    def _messages(self, names, after, before, limit, reverse, contains):
+        if not names:
+            return
+        # One query per page over all of the topics, and no larger a
+        # page than the limit asks for.
+        page_size = CHUNK_SIZE
+        if limit is not None and contains is None:
+            page_size = max(1, min(limit, CHUNK_SIZE))
+        cursor = db.MessageSetCursor(self.database, list(names),
+                                     reverse=reverse, page_size=page_size)
+        start = before if reverse else after
+        if start is not None:
+            cursor.position = (start, start)
+        merger = db.MessageMerger([cursor], reverse=reverse)
+        count = 0
+        while limit is None or count < limit:
+            taken = merger.take(1)
+            if not taken:
+                break
+            topic_key, message = taken[0]
+            if reverse and after is not None and message.key <= after:
+                break
+            if not reverse and before is not None and message.key >= before:
+                break
+            if contains is not None and contains not in message.message:
+                continue
+            count += 1
+            yield dict(key=message.key, topic=names[topic_key],
+                       updated=message.updated.strftime(TIME_FORMAT),
+                       message=message.message)
+
+    # Subscriptions; these are handled in the selector thread.
+
+    def subscribe(self, client, request_id, topic_filter='#'):
+        if request_id in client.subscriptions:
+            raise APIError("Subscription %s already exists" % (request_id,))
+        reader = self.ring.reader(self.wake)
+        client.subscriptions[request_id] = Subscription(
+            request_id, topic_filter, reader)
+        client.send(dict(id=request_id, result=[], more=True), block=False)
+
+    def unsubscribe(self, client, request_id, subscription):
+        sub = client.subscriptions.pop(subscription, None)
+        if sub is None:
+            raise APIError("Unknown subscription %s" % (subscription,))
+        self.ring.removeReader(sub.reader)
+        client.send(dict(id=request_id, result=None, more=False),
+                    block=False)
+
+    def topicName(self, topic_key):
+        name = self.topic_names.get(topic_key)
+        if name is None:
+            with self.database.getSession() as session:
+                topic = session.getTopic(topic_key)
+                if topic is not None:
+                    name = self.topic_names[topic_key] = topic.name
+        return name
+
+    def _pump(self, client):
+        for sub in list(client.subscriptions.values()):
+            evs, overrun = sub.reader.read()
+            if overrun:
+                sub.dropped += sub.reader.dropped
+                sub.reader.dropped = 0
+            for event in evs:
+                if not hasattr(event, 'topic_key'):
+                    # Not about a topic, such as a ConnectionEvent.
+                    continue
+                if isinstance(event, events.TopicAddedEvent):
+                    self.topic_names[event.topic_key] = event.name
+                    name = event.name
+                else:
+                    name = self.topicName(event.topic_key)
+                if name is None or not mqtt.topic_matches_sub(
+                        sub.topic_filter, name):
+                    continue
+                self._sendDropped(client, sub)
+                data = notify.encode(event)
+                data['topic'] = name
+                if sub.dropped or not client.send(
+                        dict(id=sub.request_id, event=data), block=False):
+                    sub.dropped += 1
+            # Report drops as soon as the client has caught up, even if
+            # nothing else matches for a while.
+            self._sendDropped(client, sub)
+
+    def _sendDropped(self, client, sub):
+        if sub.dropped and client.send(
+                dict(id=sub.request_id, overrun=True, dropped=sub.dropped),
+                block=False):
+            sub.dropped = 0
@@ -13,33 +13,36 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import argparse
+import collections
 import dateutil
 import fcntl
 import functools
 import logging
 import os
-import re
-import socket
 import subprocess
 import sys
 import textwrap
 import threading
+import time
 import warnings
 import webbrowser
 
 import six
 from six.moves import queue
-from six.moves.urllib import parse as urlparse
 import urwid
 
+from mqtty import api
 from mqtty import config
 from mqtty import db
+from mqtty import events
+from mqtty import executor
 from mqtty import keymap
 from mqtty import mywid
+from mqtty import notify
+from mqtty import prefetch
 from mqtty import sync
-import mqtty.version
-import mqtty.view
+import mqtty.cmd
+from mqtty.view import message_list as view_message_list
 from mqtty.view import topic_list as view_topic_list
 
 WELCOME_TEXT = """\
@@ -64,24 +67,32 @@ class StatusHeader(urwid.WidgetWrap):
         self.error_widget = urwid.Text('')
         self.offline_widget = urwid.Text('')
         self.sync_widget = urwid.Text(u'Sync: 0')
+        self.dropped_widget = urwid.Text(u'')
+        self.latency_widget = urwid.Text(u'')
         self.held_widget = urwid.Text(u'')
         self._w.contents.append((self.title_widget, ('pack', None, False)))
         self._w.contents.append((urwid.Text(u''), ('weight', 1, False)))
         self._w.contents.append((self.held_widget, ('pack', None, False)))
         self._w.contents.append((self.error_widget, ('pack', None, False)))
         self._w.contents.append((self.offline_widget, ('pack', None, False)))
+        self._w.contents.append((self.latency_widget, ('pack', None, False)))
+        self._w.contents.append((self.dropped_widget, ('pack', None, False)))
         self._w.contents.append((self.sync_widget, ('pack', None, False)))
         self.error = None
         self.offline = None
         self.title = None
         self.message = None
         self.sync = None
+        self.dropped = 0
+        self.latency = u''
         self.held = None
         self._error = False
-        self._offline = False
+        self._offline = u''
         self._title = ''
         self._message = ''
         self._sync = 0
+        self._dropped = 0
+        self._latency = u''
         self._held = 0
         self.held_key = self.app.config.keymap.formatKeys(keymap.LIST_HELD)
 
@@ -97,7 +108,15 @@ class StatusHeader(urwid.WidgetWrap):
             self.offline = offline
         if held is not None:
             self.held = held
-        self.sync = self.app.sync.queue.qsize()
+        if self.app.sync is not None:
+            self.sync = self.app.sync.writer.qsize()
+            self.dropped = self.app.sync.dropped()
+            percentiles = self.app.sync.latency.percentiles()
+            if percentiles:
+                self.latency = u' Latency p50/p99: %.0f/%.0fms' % (
+                    percentiles['p50'] * 1000, percentiles['p99'] * 1000)
+        else:
+            self.sync = None
         if refresh:
             self.refresh()
 
@@ -120,15 +139,39 @@ class StatusHeader(urwid.WidgetWrap):
                 self.error_widget.set_text(('error', u' Error'))
             else:
                 self.error_widget.set_text(u'')
-        if self._offline != self.offline:
-            self._offline = self.offline
-            if self._offline:
-                self.offline_widget.set_text(u' Offline')
-            else:
-                self.offline_widget.set_text(u'')
+        # offline is True, or the time the connection was lost.
+        if self.offline is True:
+            offline = u' Offline'
+        elif self.offline:
+            offline = u' Offline %s' % (
+                formatDuration(time.time() - self.offline),)
+        else:
+            offline = u''
+        if self._offline != offline:
+            self._offline = offline
+            self.offline_widget.set_text(offline)
+        if self._dropped != self.dropped:
+            self._dropped = self.dropped
+            self.dropped_widget.set_text(
+                ('error', u' Dropped: %i' % self._dropped))
+        if self._latency != self.latency:
+            self._latency = self.latency
+            self.latency_widget.set_text(self._latency)
         if self._sync != self.sync:
             self._sync = self.sync
-            self.sync_widget.set_text(u' Sync: %i' % self._sync)
+            if self._sync is None:
+                self.sync_widget.set_text(u' Read-only')
+            else:
+                self.sync_widget.set_text(u' Sync: %i' % self._sync)
+
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return u'%ss' % (seconds,)
+    if seconds < 3600:
+        return u'%sm%02ds' % (seconds // 60, seconds % 60)
+    return u'%sh%02dm' % (seconds // 3600, seconds % 3600 // 60)
 
 
 class BreadCrumbBar(urwid.WidgetWrap):
@@ -183,7 +226,7 @@ class SearchDialog(mywid.ButtonDialog):
                              lambda button: self._emit('cancel'))
         super(
             SearchDialog, self).__init__(
-            "Search", "Enter a change number or search string.",
+            "Search", "Enter a topic filter (+ and # wildcards allowed).",
             entry_prompt="Search: ", entry_text=default,
             buttons=[search_button, cancel_button],
             ring=app.ring)
@@ -241,15 +284,39 @@ class ProjectCache(object):
             del self.projects[project.key]
 
 
-class App(object):
-    simple_story_search = re.compile('^(\d+)$')
+class ScreenCache(object):
+    """A bounded LRU cache of screens which have already been built."""
+
+    def __init__(self, app, size):
+        self.app = app
+        self.size = size
+        self.screens = collections.OrderedDict()
+
+    def get(self, key):
+        screen = self.screens.pop(key, None)
+        if screen is not None:
+            self.screens[key] = screen
+        return screen
+
+    def put(self, key, screen):
+        self.screens.pop(key, None)
+        self.screens[key] = screen
+        while len(self.screens) > self.size:
+            old_key, old_screen = self.screens.popitem(last=False)
+            self.app.executor.cancel(old_screen)
+
+    def clear(self):
+        self.screens.clear()
 
+
+class App(object):
     def __init__(self, server=None, palette='default',
                  keymap='default', debug=False, verbose=False,
                  disable_sync=False, disable_background_sync=False,
                  fetch_missing_refs=False,
-                 path=config.DEFAULT_CONFIG_PATH):
+                 path=config.DEFAULT_CONFIG_PATH, read_only=False):
         self.server = server
+        self.read_only = read_only
         self.config = config.Config(server, palette, keymap, path)
         if debug:
             level = logging.DEBUG
@@ -274,15 +341,19 @@ class App(object):
         self.log = logging.getLogger('mqtty.App')
         self.log.debug("Starting")
 
-        self.lock_fd = open(self.config.lock_file, 'w')
-        try:
-            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError:
-            print("error: another instance of mqtty is running for: %s" %
-                  self.config.server['name'])
-            sys.exit(1)
+        # Read-only viewers may run alongside the instance which
+        # records messages.
+        if not read_only:
+            self.lock_fd = open(self.config.lock_file, 'w')
+            try:
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                print("error: another instance of mqtty is running for: %s" %
+                      self.config.server['name'])
+                sys.exit(1)
 
         self.project_cache = ProjectCache()
+        self.screen_cache = ScreenCache(self, self.config.screen_cache_size)
         self.ring = mywid.KillRing()
         self.input_buffer = []
         webbrowser.register('xdg-open', None, BackgroundBrowser("xdg-open"))
@@ -291,8 +362,16 @@ class App(object):
         self.config.keymap.updateCommandMap()
         # self.search = search.SearchCompiler(self.config.username)
         self.search = None
-        self.db = db.Database(self, self.config.dburi, self.search)
-        self.sync = sync.Sync(self, disable_background_sync)
+        self.db = db.Database(self, self.config.dburi, self.search,
+                              read_only=read_only)
+        if read_only:
+            self.sync = None
+            self.listener = notify.Listener(self.config.notify_dir,
+                                            events.EventRing())
+            event_ring = self.listener.events
+        else:
+            self.sync = sync.Sync(self, disable_background_sync)
+            event_ring = self.sync.events
 
         self.status = StatusHeader(self)
         self.header = urwid.AttrMap(self.status, 'header')
@@ -305,16 +384,29 @@ class App(object):
         else:
             self.footer = None
 
-        screen = view_topic_list.TopicListView(self)
-        self.status.update(title=screen.title)
-        self.updateStatusQueries()
-        self.frame = urwid.Frame(body=screen, footer=self.footer)
+        # The first screen is created once the main loop exists so that
+        # its queries can be delivered through the executor pipe.
+        self.frame = urwid.Frame(body=urwid.SolidFill(), footer=self.footer)
         self.loop = urwid.MainLoop(
             self.frame, palette=self.config.palette.getPalette(),
             handle_mouse=self.config.handle_mouse,
             unhandled_input=self.unhandledInput, input_filter=self.inputFilter)
+        self.executor = executor.QueryExecutor()
+        self.executor.pipe = self.loop.watch_pipe(self.executor.deliver)
+        self.prefetcher = prefetch.Prefetcher(
+            self, self.config.prefetch_budget, view_message_list.PAGE_SIZE)
+
+        screen = view_topic_list.TopicListView(self)
+        self.frame.body = screen
+        self.status.update(title=screen.title)
+        self.updateStatusQueries()
 
-        self.sync_pipe = self.loop.watch_pipe(self.refresh)
+        self.offline_alarm = None
+        # The time each server which is not connected was lost.
+        self.offline_servers = {}
+        self.sync_pipe = self.loop.watch_pipe(self._syncPipeInput)
+        self.event_reader = event_ring.reader(
+            lambda: os.write(self.sync_pipe, six.b('sync\n')))
         self.error_queue = queue.Queue()
         self.error_pipe = self.loop.watch_pipe(self._errorPipeInput)
         self.logged_warnings = set()
@@ -334,13 +426,21 @@ class App(object):
         self.loop.screen.tty_signal_keys(start='undefined', stop='undefined')
         # self.loop.screen.set_terminal_properties(colors=88)
 
-        self.startSocketListener()
+        # The command socket belongs to the recording instance.
+        if not read_only:
+            self.startSocketListener()
 
-        if not disable_sync:
+        if read_only:
+            self.sync_thread = threading.Thread(target=self.listener.run)
+            self.sync_thread.daemon = True
+            self.sync_thread.start()
+        elif not disable_sync:
             self.sync_thread = threading.Thread(
                 target=self.sync.run, args=(self.sync_pipe,))
             self.sync_thread.daemon = True
             self.sync_thread.start()
+            self.offline_servers = self.sync.offlineServers()
+            self.setOffline(self.sync.offline_since)
         else:
             self.sync_thread = None
             self.sync.offline = True
@@ -351,6 +451,14 @@ class App(object):
             self.loop.run()
         except KeyboardInterrupt:
             pass
+        self.executor.shutdown()
+        if self.read_only:
+            self.listener.stop()
+        else:
+            self.api.stop()
+            if self.sync_thread is not None:
+                # Write whatever has been received before exiting.
+                self.sync.stop()
 
     def _quit(self, widget=None):
         raise urwid.ExitMainLoop()
@@ -364,33 +472,16 @@ class App(object):
         self.popup(dialog)
 
     def startSocketListener(self):
-        if os.path.exists(self.config.socket_path):
-            os.unlink(self.config.socket_path)
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.socket.bind(self.config.socket_path)
-        self.socket.listen(1)
-        self.socket_thread = threading.Thread(target=self._socketListener)
+        self.api = api.APIServer(self.db, self.sync.events,
+                                 self.config.socket_path, self._socketCommand)
+        self.socket_thread = threading.Thread(target=self.api.run)
         self.socket_thread.daemon = True
         self.socket_thread.start()
 
-    def _socketListener(self):
-        while True:
-            try:
-                s, addr = self.socket.accept()
-                self.log.debug("Accepted socket connection %s" % (s,))
-                buf = ''
-                while True:
-                    buf += s.recv(1)
-                    if buf[-1] == '\n':
-                        break
-                buf = buf.strip()
-                self.log.debug("Received %s from socket" % (buf,))
-                s.close()
-                parts = buf.split()
-                self.command_queue.put((parts[0], parts[1:]))
-                os.write(self.command_pipe, six.b('command\n'))
-            except Exception:
-                self.log.exception("Exception in socket handler")
+    def _socketCommand(self, command, args):
+        # Called from the API server thread.
+        self.command_queue.put((command, args))
+        os.write(self.command_pipe, six.b('command\n'))
 
     def clearInputBuffer(self):
         if self.input_buffer:
@@ -400,14 +491,27 @@ class App(object):
     def changeScreen(self, widget, push=True):
         self.log.debug("Changing screen to %s" % (widget,))
         self.status.update(error=False, title=widget.title)
+        self.executor.cancel(self.frame.body)
         if push:
             self.screens.append(self.frame.body)
         self.clearInputBuffer()
         self.frame.body = widget
 
+    def changeCachedScreen(self, key, factory):
+        """Switch to the cached screen for key, bringing it up to date,
+        or to a new one created by factory."""
+        widget = self.screen_cache.get(key)
+        if widget is None:
+            widget = factory()
+            self.screen_cache.put(key, widget)
+        else:
+            widget.refresh()
+        self.changeScreen(widget)
+
     def backScreen(self, target_widget=None):
         if not self.screens:
             return
+        self.executor.cancel(self.frame.body)
         while self.screens:
             self.log.debug("screens %s" % (target_widget,))
             widget = self.screens.pop()
@@ -440,20 +544,52 @@ class App(object):
             widget = widget.contents[0][0]
         interested = force
         invalidate = False
-        try:
-            while True:
-                event = self.sync.result_queue.get(0)
-                if widget.interested(event):
-                    interested = True
-                if hasattr(event, 'held_changed') and event.held_changed:
-                    invalidate = True
-        except queue.Empty:
-            pass
+        new_events, overrun = self.event_reader.read()
+        if overrun:
+            # Some events were lost; let the screen catch up on its own
+            # rather than applying only the ones which are left.
+            self.log.debug("Event reader overrun, %s events dropped" %
+                           (self.event_reader.dropped,))
+            interested = True
+            new_events = []
+            if self.sync is not None:
+                self.offline_servers = self.sync.offlineServers()
+                self.setOffline(self.sync.offline_since)
+        subscriptions = getattr(widget, 'subscriptions', ())
+        for event in new_events:
+            if isinstance(event, subscriptions) and widget.interested(event):
+                interested = True
+            if isinstance(event, events.ConnectionEvent):
+                # Offline while any of the servers is.
+                if event.offline_since:
+                    self.offline_servers[event.server] = event.offline_since
+                else:
+                    self.offline_servers.pop(event.server, None)
+                self.setOffline(min(self.offline_servers.values())
+                                if self.offline_servers else None)
+            if hasattr(event, 'held_changed') and event.held_changed:
+                invalidate = True
         if interested:
             widget.refresh()
         if invalidate:
             self.updateStatusQueries()
-        self.status.refresh()
+        # Picks up the queue length and drop count too.
+        self.status.update()
+
+    def setOffline(self, offline_since):
+        self.status.update(offline=offline_since or False, refresh=False)
+        if offline_since and not self.offline_alarm:
+            self.offline_alarm = self.loop.set_alarm_in(1, self._offlineTick)
+
+    def _offlineTick(self, loop=None, data=None):
+        # Keep the time spent offline up to date.
+        self.offline_alarm = None
+        if self.status.offline and self.status.offline is not True:
+            self.status.refresh()
+            self.offline_alarm = self.loop.set_alarm_in(1, self._offlineTick)
+
+    def _syncPipeInput(self, data=None):
+        self.refresh(force=False)
 
     def updateStatusQueries(self):
         return
@@ -507,7 +643,7 @@ class App(object):
             for cmd, keys, cmdtext in items:
                 text += '{keys:{width}} {text}\n'.format(
                     keys=keys, width=keylen, text=cmdtext)
-        dialog = mywid.MessageDialog('Help for %s' % version(), text)
+        dialog = mywid.MessageDialog('Help for %s' % mqtty.cmd.version(), text)
         lines = text.split('\n')
         urwid.connect_signal(dialog, 'close',
                              lambda button: self.backScreen())
@@ -532,13 +668,14 @@ class App(object):
     def _searchDialog(self, dialog):
         self.backScreen()
         query = dialog.entry.edit_text.strip()
-        if self.simple_story_search.match(query):
-            query = 'story:%s' % query
-        else:
-            result = self.parseInternalURL(query)
-            if result is not None:
-                return self.openInternalURL(result)
-        self.doSearch(query)
+        if query:
+            self.doSearch(query)
+
+    def doSearch(self, query):
+        self.log.debug("Opening messages for topic filter %s" % (query,))
+        self.changeCachedScreen(
+            ('filter', query),
+            lambda: view_message_list.MultiTopicMessageListView(self, query))
 
     def error(self, message, title='Error'):
         dialog = mywid.MessageDialog(title, message)
@@ -644,78 +781,8 @@ class App(object):
                 "Unable to parse command %s with data %s" % (command, data))
 
 
-def version():
-    return "Mqtty version: %s" % mqtty.version.version_info.release_string()
-
-
-class PrintKeymapAction(argparse.Action):
-    def __call__(self, parser, namespace, values, option_string=None):
-        for cmd in sorted(keymap.DEFAULT_KEYMAP.keys()):
-            print(cmd.replace(' ', '-'))
-        sys.exit(0)
-
-
-class PrintPaletteAction(argparse.Action):
-    def __call__(self, parser, namespace, values, option_string=None):
-        # for attr in sorted(palette.DEFAULT_PALETTE.keys()):
-        #     print(attr)
-        sys.exit(0)
-
-
-class OpenChangeAction(argparse.Action):
-    def __call__(self, parser, namespace, values, option_string=None):
-        cf = config.Config(namespace.server, namespace.palette,
-                           namespace.keymap, namespace.path)
-        url = values[0]
-        urlparse.urlparse(values[0])
-        if not url.startswith(cf.url):
-            print('Supplied URL must start with %s' % (cf.url,))
-            sys.exit(1)
-
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.connect(cf.socket_path)
-        s.sendall('open %s\n' % url)
-        sys.exit(0)
-
-
 def main():
-    parser = argparse.ArgumentParser(
-        description='Console client for MQTTY')
-    parser.add_argument('-c', dest='path',
-                        default=config.DEFAULT_CONFIG_PATH,
-                        help='path to config file')
-    parser.add_argument('-v', dest='verbose', action='store_true',
-                        help='enable more verbose logging')
-    parser.add_argument('-d', dest='debug', action='store_true',
-                        help='enable debug logging')
-    parser.add_argument('--no-sync', dest='no_sync', action='store_true',
-                        help='disable remote syncing')
-    parser.add_argument(
-        '--debug-sync', dest='debug_sync', action='store_true',
-        help='disable most background sync tasks for debugging')
-    parser.add_argument('--fetch-missing-refs', dest='fetch_missing_refs',
-                        action='store_true',
-                        help='fetch any refs missing from local repos')
-    parser.add_argument('--print-keymap', nargs=0, action=PrintKeymapAction,
-                        help='print the keymap command names to stdout')
-    parser.add_argument('--print-palette', nargs=0, action=PrintPaletteAction,
-                        help='print the palette attribute names to stdout')
-    parser.add_argument('--open', nargs=1, action=OpenChangeAction,
-                        metavar='URL',
-                        help='open the given URL in a running Boardtty')
-    parser.add_argument('--version', dest='version', action='version',
-                        version=version(),
-                        help='show Mqtty\'s version')
-    parser.add_argument('-p', dest='palette', default='default',
-                        help='color palette to use')
-    parser.add_argument('-k', dest='keymap', default='default',
-                        help='keymap to use')
-    parser.add_argument('server', nargs='?',
-                        help='the server to use (as specified in config file)')
-    args = parser.parse_args()
-    g = App(args.server, args.palette, args.keymap, args.debug, args.verbose,
-            args.no_sync, args.debug_sync, args.fetch_missing_refs, args.path)
-    g.run()
+    mqtty.cmd.main()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,477 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# The ingest benchmark: "mqtty bench run [options]" and
+# "mqtty bench compare BASELINE RESULTS".
+#
+# Each run starts a stand-in broker in this process, which speaks just
+# enough MQTT to accept a subscription and then publishes probe
+# messages (see mqtty.probe) as fast as it can or at a given rate.  A
+# Sync records them into a fresh database in a temporary directory,
+# with the ingest settings of the configuration file if one is given.
+# A run measures:
+#
+#   messages_per_second  from the first message sent until the last
+#                        one was written, filtered, sampled out or
+#                        dropped
+#   write_ms             time taken by each batch written
+#   commit_latency_ms    from receiving the oldest message of a batch
+#                        to committing it
+#   lock_hold_ms         time each session held the database lock
+#   latency_ms           from the broker sending a message to mqtty
+#                        receiving it
+#   max_rss_kb           peak resident size of the process
+#
+# along with how many messages were received, written, filtered,
+# sampled out and dropped.
+#
+# Every combination of the given payload sizes and topic counts is a
+# separate run.  The results are printed, or written with -o, as
+# JSON; compare finds the runs of a result file with the same
+# parameters as those of a baseline and fails if any got worse by more
+# than a tolerance.
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import yaml
+
+from mqtty import config
+from mqtty import db
+from mqtty import probe
+from mqtty import sync
+import mqtty.version
+
+# Ingest settings taken from a configuration file for a run.
+INGEST_SETTINGS = ('journal', 'ingest-queue', 'processing', 'filters',
+                   'sampling')
+# Messages sent to the subscriber at once.
+CHUNK = 100
+# Percent by which a metric may get worse before compare fails.
+TOLERANCE = 10.0
+
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+CONNACK = b'\x20\x02\x00\x00'
+PINGRESP = b'\xd0\x00'
+
+
+def encodeLength(length):
+    ret = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        ret.append(byte)
+        if not length:
+            return bytes(ret)
+
+
+def encodeString(value):
+    value = value.encode('utf8')
+    return struct.pack('!H', len(value)) + value
+
+
+class FakeBroker(object):
+    """Publish messages to the first client which subscribes."""
+
+    def __init__(self, count, rate=0, size=100, topics=1, qos=0,
+                 prefix='bench'):
+        self.log = logging.getLogger('mqtty.bench')
+        self.count = count
+        self.rate = rate
+        self.size = size
+        self.topics = topics
+        self.qos = qos
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.send_lock = threading.Lock()
+        self.publisher = None
+        self.running = True
+        self.sent = 0
+        self.first = None
+        self.last = None
+
+    def run(self):
+        while self.running:
+            try:
+                conn, addr = self.socket.accept()
+            except (socket.error, OSError):
+                break
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self.socket.close()
+
+    def read(self, f):
+        header = f.read(1)
+        if not header:
+            return None, None
+        length = 0
+        shift = 0
+        while True:
+            byte = bytearray(f.read(1))[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return bytearray(header)[0] >> 4, f.read(length)
+
+    def send(self, conn, data):
+        with self.send_lock:
+            conn.sendall(data)
+
+    def serve(self, conn):
+        f = conn.makefile('rb')
+        try:
+            while True:
+                kind, body = self.read(f)
+                if kind is None or kind == DISCONNECT:
+                    break
+                if kind == CONNECT:
+                    self.send(conn, CONNACK)
+                elif kind == SUBSCRIBE:
+                    granted = bytearray()
+                    offset = 2
+                    while offset < len(body):
+                        length = struct.unpack_from('!H', body, offset)[0]
+                        offset += 2 + length
+                        granted.append(bytearray(body)[offset])
+                        offset += 1
+                    self.send(conn, b'\x90' + encodeLength(2 + len(granted)) +
+                              bytes(body[:2]) + bytes(granted))
+                    if self.publisher is None:
+                        self.publisher = threading.Thread(
+                            target=self.publish, args=(conn,))
+                        self.publisher.daemon = True
+                        self.publisher.start()
+                elif kind == PINGREQ:
+                    self.send(conn, PINGRESP)
+                # Acknowledgements need no answer.
+        except (socket.error, OSError, IndexError):
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+    def packet(self, sequence):
+        topic = encodeString('%s/%s' % (self.prefix, sequence % self.topics))
+        if self.qos:
+            topic += struct.pack('!H', sequence % 65535 + 1)
+        body = topic + probe.makePayload(sequence, self.size)
+        return (bytearray([PUBLISH << 4 | self.qos << 1]) +
+                encodeLength(len(body)) + body)
+
+    def publish(self, conn):
+        self.first = time.time()
+        try:
+            while self.sent < self.count:
+                if self.rate:
+                    due = self.first + self.sent / float(self.rate)
+                    now = time.time()
+                    if due > now:
+                        time.sleep(due - now)
+                    chunk = max(1, min(CHUNK, int(self.rate / 100)))
+                else:
+                    chunk = CHUNK
+                chunk = min(chunk, self.count - self.sent)
+                data = b''.join(bytes(self.packet(self.sent + i))
+                                for i in range(chunk))
+                self.send(conn, data)
+                self.sent += chunk
+        except (socket.error, OSError):
+            self.log.error("Subscriber went away after %s messages" %
+                           (self.sent,))
+        self.last = time.time()
+
+
+class Harness(object):
+    """What a Sync needs of the application: a config and database."""
+
+    def __init__(self, path):
+        self.config = config.Config(path=path, headless=True)
+        self.db = db.Database(self, self.config.dburi, None)
+
+
+def makeConfig(directory, port, base=None):
+    server = {
+        'name': 'bench',
+        'host': '127.0.0.1',
+        'port': port,
+        'clean-session': True,
+        'dburi': 'sqlite:///' + os.path.join(directory, 'mqtty.db'),
+        'socket': os.path.join(directory, 'mqtty.sock'),
+        'lock-file': os.path.join(directory, 'mqtty.lock'),
+        'notify-dir': os.path.join(directory, 'notify'),
+    }
+    data = {
+        'servers': [server],
+        'subscribed-topics': [{'topic': 'bench/#', 'qos': 1}],
+    }
+    for key in INGEST_SETTINGS:
+        if base and key in base:
+            data[key] = base[key]
+    if 'journal' in data:
+        data['journal'] = dict(data['journal'],
+                               path=os.path.join(directory, 'journal'))
+    path = os.path.join(directory, 'mqtty.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style=False)
+    return path
+
+
+def maxRSS():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes rather than kilobytes.
+        rss //= 1024
+    return rss
+
+
+def milliseconds(latency):
+    return collections.OrderedDict(
+        (name, seconds * 1000)
+        for name, seconds in latency.percentiles().items())
+
+
+def counts(s):
+    """Return what has become of the messages a Sync received."""
+    ret = collections.OrderedDict()
+    ret['received'] = sum(c.received for c in s.connections)
+    ret['written'] = s.writer.written
+    ret['filtered'] = s.filter.dropped if s.filter else 0
+    ret['sampled'] = 0
+    if s.sampler:
+        # Including those held by latest rules until they are due.
+        ret['sampled'] = sum(r.seen - r.stored for r in s.sampler.rules)
+    ret['dropped'] = s.dropped()
+    if s.pipeline:
+        ret['dropped'] += s.pipeline.dropped
+    return ret
+
+
+def runOne(count, rate, size, topics, qos, base=None, timeout=300):
+    directory = tempfile.mkdtemp(prefix='mqtty-bench-')
+    broker = FakeBroker(count, rate, size, topics, qos)
+    broker_thread = threading.Thread(target=broker.run)
+    broker_thread.daemon = True
+    broker_thread.start()
+    try:
+        harness = Harness(makeConfig(directory, broker.port, base))
+        lock_hold = probe.Latency(count)
+        harness.db.lock_timer = lock_hold.add
+        s = sync.Sync(harness, False)
+        writes = probe.Latency(count)
+        commits = probe.Latency(count)
+        write = s.writer.write
+
+        def timedWrite(batch):
+            start = time.time()
+            write(batch)
+            end = time.time()
+            writes.add(end - start)
+            oldest = min(r.updated for r in batch)
+            commits.add(end - probe.timestamp(oldest))
+
+        s.writer.write = timedWrite
+        sync_thread = threading.Thread(target=s.run)
+        sync_thread.daemon = True
+        sync_thread.start()
+        # The run is over once every message has been received and
+        # then written, filtered, sampled out or dropped.  Should that
+        # not happen, the rate is taken up to the last progress made.
+        deadline = time.time() + timeout
+        done = handled = 0
+        end = time.time()
+        while time.time() < deadline:
+            current = counts(s)
+            handled = sum(current.values()) - current['received']
+            if handled != done:
+                done = handled
+                end = time.time()
+            if current['received'] >= count and handled >= count:
+                break
+            time.sleep(0.01)
+        complete = handled >= count
+        s.stop()
+        sync_thread.join()
+        current = counts(s)
+    finally:
+        broker.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    seconds = end - (broker.first or end)
+    return collections.OrderedDict([
+        ('parameters', collections.OrderedDict([
+            ('count', count), ('rate', rate), ('size', size),
+            ('topics', topics), ('qos', qos)])),
+        ('complete', complete),
+    ] + list(current.items()) + [
+        ('seconds', seconds),
+        ('messages_per_second', done / max(seconds, 1e-6)),
+        ('write_ms', milliseconds(writes)),
+        ('commit_latency_ms', milliseconds(commits)),
+        ('lock_hold_ms', milliseconds(lock_hold)),
+        ('latency_ms', milliseconds(s.latency)),
+        ('max_rss_kb', maxRSS()),
+    ])
+
+
+def metrics(run):
+    """Yield the name, value and whether higher is better of each
+    metric of a run."""
+    yield 'messages_per_second', run['messages_per_second'], True
+    for key in ('write_ms', 'commit_latency_ms', 'lock_hold_ms',
+                'latency_ms'):
+        for name, value in run[key].items():
+            yield '%s.%s' % (key, name), value, False
+    if run.get('max_rss_kb') is not None:
+        yield 'max_rss_kb', run['max_rss_kb'], False
+
+
+def compare(baseline, results, tolerance=TOLERANCE, out=sys.stdout):
+    """Print how results differ from baseline; return the number of
+    regressions."""
+    runs = dict((json.dumps(r['parameters'], sort_keys=True), r)
+                for r in results['runs'])
+    regressions = 0
+    for base in baseline['runs']:
+        key = json.dumps(base['parameters'], sort_keys=True)
+        run = runs.get(key)
+        out.write('%s\n' % (', '.join('%s=%s' % item for item in
+                                      base['parameters'].items()),))
+        if run is None:
+            out.write('  not in results\n')
+            continue
+        current = dict((name, value) for name, value, _ in metrics(run))
+        for name, value, higher in metrics(base):
+            if name not in current:
+                continue
+            if value:
+                change = (current[name] - value) * 100.0 / value
+            else:
+                change = 0.0
+            worse = -change if higher else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            out.write('  %-26s %12.3f %12.3f %+8.1f%%%s\n' % (
+                name, value, current[name], change, flag))
+    out.write('%s regressions beyond %s%%\n' % (regressions, tolerance))
+    return regressions
+
+
+def intList(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='mqtty bench', description='Benchmark message ingest')
+    parser.add_argument('-d', dest='debug', action='store_true',
+                        help='enable debug logging')
+    actions = parser.add_subparsers(dest='action')
+    run = actions.add_parser('run', help='run the benchmark')
+    run.add_argument('-c', dest='path',
+                     help='take the ingest settings from this config file')
+    run.add_argument('-o', dest='output',
+                     help='write the results to this file (default stdout)')
+    run.add_argument('--count', type=int, default=20000,
+                     help='messages per run (default 20000)')
+    run.add_argument('--rate', type=int, default=0,
+                     help='messages per second, 0 for as fast as possible '
+                     '(default 0)')
+    run.add_argument('--sizes', type=intList, default=[100],
+                     help='comma separated payload sizes (default 100)')
+    run.add_argument('--topics', type=intList, default=[10],
+                     help='comma separated topic counts (default 10)')
+    run.add_argument('--qos', type=int, choices=(0, 1), default=0,
+                     help='the QoS to publish with (default 0)')
+    run.add_argument('--timeout', type=float, default=300,
+                     help='seconds to wait for a run to finish')
+    comp = actions.add_parser('compare',
+                              help='compare results with a baseline')
+    comp.add_argument('baseline', help='baseline results file')
+    comp.add_argument('results', help='results file')
+    comp.add_argument('--tolerance', type=float, default=TOLERANCE,
+                      help='percent a metric may get worse (default %s)' %
+                      (TOLERANCE,))
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+    if args.action == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+        if compare(baseline, results, args.tolerance):
+            return 1
+        return 0
+    if args.action != 'run':
+        parser.print_help()
+        return 2
+    base = None
+    if args.path:
+        with open(os.path.expanduser(args.path)) as f:
+            base = yaml.safe_load(f)
+    results = collections.OrderedDict([
+        ('version', mqtty.version.version_info.release_string()),
+        ('python', platform.python_version()),
+        ('runs', []),
+    ])
+    for size in args.sizes:
+        for topics in args.topics:
+            result = runOne(args.count, args.rate, size, topics, args.qos,
+                            base, args.timeout)
+            sys.stderr.write(
+                "size %s, %s topics: %.1f messages/s, write p50 %.1fms\n" % (
+                    size, topics, result['messages_per_second'],
+                    result['write_ms'].get('p50', 0.0)))
+            results['runs'].append(result)
+    data = json.dumps(results, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        sys.stdout.write(data)
+    return 0
@@ -0,0 +1,147 @@
+# Copyright 2014 OpenStack Foundation
+# Copyright 2014 Hewlett-Packard Development Company, L.P.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# The command line entry point.  This module must not import urwid or
+# the views (directly or through mqtty.app at module level) so that the
+# headless recorder can run without them.
+
+import argparse
+import importlib
+import socket
+import sys
+
+from six.moves.urllib import parse as urlparse
+
+from mqtty import config
+import mqtty.version
+
+
+# Subcommands, as "mqtty <command> ...", and the modules which run them.
+COMMANDS = {
+    'bench': 'mqtty.bench',
+    'bench-publish': 'mqtty.probe',
+    'export': 'mqtty.exporter',
+    'import': 'mqtty.importer',
+    'replay': 'mqtty.replay',
+}
+
+
+def version():
+    return "Mqtty version: %s" % mqtty.version.version_info.release_string()
+
+
+def commandParser(command, description):
+    """Return a parser with the options every subcommand takes."""
+    parser = argparse.ArgumentParser(prog='mqtty %s' % (command,),
+                                     description=description)
+    parser.add_argument('-c', dest='path',
+                        default=config.DEFAULT_CONFIG_PATH,
+                        help='path to config file')
+    parser.add_argument('-s', dest='server',
+                        help='the server to use (as specified in config '
+                        'file)')
+    parser.add_argument('-d', dest='debug', action='store_true',
+                        help='enable debug logging')
+    return parser
+
+
+class PrintKeymapAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        from mqtty import keymap
+        for cmd in sorted(keymap.DEFAULT_KEYMAP.keys()):
+            print(cmd.replace(' ', '-'))
+        sys.exit(0)
+
+
+class PrintPaletteAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        # for attr in sorted(palette.DEFAULT_PALETTE.keys()):
+        #     print(attr)
+        sys.exit(0)
+
+
+class OpenChangeAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        cf = config.Config(namespace.server, namespace.palette,
+                           namespace.keymap, namespace.path)
+        url = values[0]
+        urlparse.urlparse(values[0])
+        if not url.startswith(cf.url):
+            print('Supplied URL must start with %s' % (cf.url,))
+            sys.exit(1)
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(cf.socket_path)
+        s.sendall('open %s\n' % url)
+        sys.exit(0)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        module = importlib.import_module(COMMANDS[sys.argv[1]])
+        return module.main(sys.argv[2:])
+    parser = argparse.ArgumentParser(
+        description='Console client for MQTTY')
+    parser.add_argument('-c', dest='path',
+                        default=config.DEFAULT_CONFIG_PATH,
+                        help='path to config file')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+                        help='enable more verbose logging')
+    parser.add_argument('-d', dest='debug', action='store_true',
+                        help='enable debug logging')
+    parser.add_argument('--no-sync', dest='no_sync', action='store_true',
+                        help='disable remote syncing')
+    parser.add_argument(
+        '--debug-sync', dest='debug_sync', action='store_true',
+        help='disable most background sync tasks for debugging')
+    parser.add_argument('--fetch-missing-refs', dest='fetch_missing_refs',
+                        action='store_true',
+                        help='fetch any refs missing from local repos')
+    parser.add_argument('--headless', dest='headless', action='store_true',
+                        help='record messages to the database without a '
+                        'user interface')
+    parser.add_argument('--read-only', dest='read_only', action='store_true',
+                        help='browse the database while another instance '
+                        'records messages')
+    parser.add_argument('--print-keymap', nargs=0, action=PrintKeymapAction,
+                        help='print the keymap command names to stdout')
+    parser.add_argument('--print-palette', nargs=0, action=PrintPaletteAction,
+                        help='print the palette attribute names to stdout')
+    parser.add_argument('--open', nargs=1, action=OpenChangeAction,
+                        metavar='URL',
+                        help='open the given URL in a running Boardtty')
+    parser.add_argument('--version', dest='version', action='version',
+                        version=version(),
+                        help='show Mqtty\'s version')
+    parser.add_argument('-p', dest='palette', default='default',
+                        help='color palette to use')
+    parser.add_argument('-k', dest='keymap', default='default',
+                        help='keymap to use')
+    parser.add_argument('server', nargs='?',
+                        help='the server to use (as specified in config file)')
+    args = parser.parse_args()
+    if args.headless:
+        from mqtty import recorder
+        g = recorder.Recorder(args.server, args.debug, args.path)
+    else:
+        from mqtty import app
+        g = app.App(args.server, args.palette, args.keymap, args.debug,
+                    args.verbose, args.no_sync, args.debug_sync,
+                    args.fetch_missing_refs, args.path, args.read_only)
+    g.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,6 @@ import yaml
 
 import voluptuous as v
 
-import mqtty.keymap
 import mqtty.palette
 
 try:
@@ -33,16 +32,31 @@ except AttributeError:
     OrderedDict = ordereddict.OrderedDict
 
 DEFAULT_CONFIG_PATH = '~/.mqtty.yaml'
+# Settings of the servers after the first which are not used when they
+# are recorded together; everything goes to the first one's.
+SHARED_SETTINGS = ('dburi', 'socket', 'log-file', 'lock-file', 'notify-dir')
 
 
 class ConfigSchema(object):
     server = {v.Required('name'): str,
               v.Required('host'): str,
+              'port': int,
+              'client-id': str,
+              'clean-session': bool,
+              'reconnect-max-delay': int,
+              'workers': int,
+              'share-group': str,
+              'dburi': str,
+              'socket': str,
+              'log-file': str,
+              'lock-file': str,
+              'notify-dir': str,
               }
     servers = [server]
 
     topic = {'name': str,
-             'topic': str,
+             v.Required('topic'): str,
+             'qos': v.Any(0, 1, 2),
              }
     subscribed_topics = [topic]
 
@@ -100,6 +114,45 @@ class ConfigSchema(object):
                                              'disabled', None),
                    v.Optional('thresholds'): thresholds}
 
+    # Exactly one of a port or a socket.
+    fanout = v.Any({v.Required('port'): int,
+                    'queue-size': int},
+                   {v.Required('socket'): str,
+                    'queue-size': int})
+
+    shared_memory = {'name': str,
+                     'slots': int,
+                     'slot-size': int}
+
+    journal = {'path': str,
+               'checkpoint-interval': int}
+
+    filter_rule = {'name': str,
+                   'topic': str,
+                   'payload': str,
+                   v.Required('action'): v.Any('include', 'exclude')}
+
+    filters = [filter_rule]
+
+    sampling_rule = {v.Required('topic'): str,
+                     v.Required('policy'): v.Any('every-nth', 'interval',
+                                                 'latest'),
+                     'every': v.All(int, v.Range(min=1)),
+                     'interval': v.All(v.Any(int, float),
+                                       v.Range(min=0, min_included=False))}
+
+    sampling = [sampling_rule]
+
+    ingest_queue = {'max-messages': int,
+                    'max-bytes': int,
+                    'policy': v.Any('block', 'drop-oldest', 'drop-newest',
+                                    'sample'),
+                    'sample-rate': int}
+
+    processing = {'workers': int,
+                  'batch-size': int,
+                  'stages': [str]}
+
     def getSchema(self, data):
         schema = v.Schema({v.Required('servers'): self.servers,
                            'subscribed-topics': self.subscribed_topics,
@@ -119,13 +172,24 @@ class ConfigSchema(object):
                            'change-list-options': self.change_list_options,
                            'expire-age': str,
                            'size-column': self.size_column,
+                           'screen-cache-size': int,
+                           'prefetch-budget': int,
+                           'tail-window': int,
+                           'namespace-topics': bool,
+                           'fanout': self.fanout,
+                           'shared-memory': self.shared_memory,
+                           'journal': self.journal,
+                           'processing': self.processing,
+                           'ingest-queue': self.ingest_queue,
+                           'filters': self.filters,
+                           'sampling': self.sampling,
                            })
         return schema
 
 
 class Config(object):
     def __init__(self, server=None, palette='default', keymap='default',
-                 path=DEFAULT_CONFIG_PATH):
+                 path=DEFAULT_CONFIG_PATH, headless=False):
         self.path = os.path.expanduser(path)
 
         if not os.path.exists(self.path):
@@ -135,10 +199,23 @@ class Config(object):
         self.config = yaml.load(open(self.path))
         schema = ConfigSchema().getSchema(self.config)
         schema(self.config)
-        server = self.getServer(server)
+        # Messages are recorded from the named server, or from every
+        # configured server at once; the first one's settings are used
+        # for the database and local sockets.
+        if server is not None:
+            self.servers = [self.getServer(server)]
+        else:
+            self.servers = self.config['servers']
+        server = self.servers[0]
         self.server = server
+        # With several servers configured each topic is prefixed with
+        # the name of the server it came from, however many of them
+        # are recorded, so that a topic is always stored under the same
+        # name.
+        self.namespace_topics = self.config.get(
+            'namespace-topics', len(self.config['servers']) > 1)
 
-        self.subscribed_topic = self.get_topic('default')
+        self.subscribed_topics = self.config.get('subscribed-topics', [])
 
         self.dburi = server.get(
             'dburi', 'sqlite:///' + os.path.expanduser('~/.mqtty.db'))
@@ -149,6 +226,9 @@ class Config(object):
         lock_file = server.get(
             'lock-file', '~/.mqtty.%s.lock' % server['name'])
         self.lock_file = os.path.expanduser(lock_file)
+        notify_dir = server.get(
+            'notify-dir', '~/.mqtty.%s.d' % server['name'])
+        self.notify_dir = os.path.expanduser(notify_dir)
 
         self.palettes = {
             'default': mqtty.palette.Palette({}),
@@ -160,14 +240,10 @@ class Config(object):
                 self.palettes[p['name']].update(p)
         self.palette = self.palettes[self.config.get('palette', palette)]
 
-        self.keymaps = {'default': mqtty.keymap.KeyMap({}),
-                        'vi': mqtty.keymap.KeyMap(mqtty.keymap.VI_KEYMAP)}
-        for p in self.config.get('keymaps', []):
-            if p['name'] not in self.keymaps:
-                self.keymaps[p['name']] = mqtty.keymap.KeyMap(p)
-            else:
-                self.keymaps[p['name']].update(p)
-        self.keymap = self.keymaps[self.config.get('keymap', keymap)]
+        # The keymap module needs urwid, which the headless recorder
+        # does not load.
+        if not headless:
+            self.loadKeymaps(keymap)
 
         self.project_change_list_query = self.config.get(
             'change-list-query', 'status:open')
@@ -199,6 +275,25 @@ class Config(object):
 
         self.expire_age = self.config.get('expire-age', '2 months')
 
+        self.screen_cache_size = self.config.get('screen-cache-size', 10)
+        self.prefetch_budget = self.config.get('prefetch-budget',
+                                               4 * 1024 * 1024)
+        self.tail_window = self.config.get('tail-window', 1000)
+
+        self.fanout = self.config.get('fanout')
+        self.shared_memory = self.config.get('shared-memory')
+        self.journal = self.config.get('journal')
+        self.processing = self.config.get('processing')
+        self.ingest_queue = self.config.get('ingest-queue', {})
+        self.filters = self.config.get('filters', [])
+        self.sampling = self.config.get('sampling', [])
+        if self.journal is not None:
+            self.journal['path'] = os.path.expanduser(self.journal.get(
+                'path', '~/.mqtty.%s.journal' % server['name']))
+        if self.shared_memory is not None:
+            self.shared_memory.setdefault('name',
+                                          'mqtty-%s' % server['name'])
+
         self.size_column = self.config.get('size-column', {})
         self.size_column['type'] = self.size_column.get('type', 'graph')
         if self.size_column['type'] == 'graph':
@@ -208,6 +303,30 @@ class Config(object):
             self.size_column['thresholds'] = self.size_column.get(
                 'thresholds', [1, 10, 100, 200, 400, 600, 800, 1000])
 
+    def ignoredSettings(self):
+        """Return (server name, setting) for each local setting of a
+        recorded server which differs from the first one's, and so is
+        not used."""
+        ret = []
+        for server in self.servers[1:]:
+            for setting in SHARED_SETTINGS:
+                if (setting in server and
+                        server[setting] != self.server.get(setting)):
+                    ret.append((server['name'], setting))
+        return ret
+
+    def loadKeymaps(self, keymap):
+        import mqtty.keymap
+
+        self.keymaps = {'default': mqtty.keymap.KeyMap({}),
+                        'vi': mqtty.keymap.KeyMap(mqtty.keymap.VI_KEYMAP)}
+        for p in self.config.get('keymaps', []):
+            if p['name'] not in self.keymaps:
+                self.keymaps[p['name']] = mqtty.keymap.KeyMap(p)
+            else:
+                self.keymaps[p['name']].update(p)
+        self.keymap = self.keymaps[self.config.get('keymap', keymap)]
+
     def getServer(self, name=None):
         for server in self.config['servers']:
             if name is None or name == server['name']:
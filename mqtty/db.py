@@ -13,7 +13,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import heapq
 import logging
+import os
 import threading
 import time
 
@@ -22,10 +25,17 @@ import alembic.config
 import sqlalchemy
 from sqlalchemy import create_engine, MetaData, Table, Column, Integer
 from sqlalchemy import String, Boolean, DateTime, Text, UniqueConstraint, func
+from sqlalchemy import and_, or_, event, literal_column
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.orm import mapper, sessionmaker, relationship, scoped_session
 from sqlalchemy.orm.session import Session
 
+import paho.mqtt.client as mqtt
+
+# Most bound parameters in one statement; older sqlite builds allow no
+# more than 999.
+MAX_PARAMETERS = 500
+
 metadata = MetaData()
 topic_table = Table(
     'topic', metadata,
@@ -88,9 +98,13 @@ class TopicMessage(object):
 
 
 class Message(object):
-    def __init__(self, message, topic):
+    def __init__(self, message, topic=None, updated=None, topic_key=None):
         self.message = message
-        self.topic_key = topic.key
+        if topic is not None:
+            topic_key = topic.key
+        self.topic_key = topic_key
+        if updated is not None:
+            self.updated = updated
 
     def addTopic(self, topic):
         session = Session.object_session(self)
@@ -126,14 +140,41 @@ mapper(Message, message_table, properties=dict(
 mapper(TopicMessage, topic_message_table)
 
 
+def topicKeyIn(topic_keys):
+    """Return a filter on the messages of any of topic_keys."""
+    column = message_table.c.topic_key
+    if len(topic_keys) <= MAX_PARAMETERS:
+        return column.in_(topic_keys)
+    # Too many for bound parameters; the keys are integers, so they
+    # can be written into the statement itself.
+    return column.in_([literal_column(str(int(key)))
+                       for key in topic_keys])
+
+
 class Database(object):
-    def __init__(self, app, dburi, search):
+    def __init__(self, app, dburi, search, read_only=False):
         self.log = logging.getLogger('mqtty.db')
         self.dburi = dburi
         self.search = search
-        self.engine = create_engine(self.dburi)
+        self.read_only = read_only
+        # The sqlite synchronous setting for new connections, if not
+        # the default.
+        self.synchronous = None
+        if read_only and dburi.startswith('sqlite:///'):
+            # Let sqlite enforce that a viewer never writes.
+            dburi = 'sqlite:///file:%s?mode=ro&uri=true' % (
+                dburi[len('sqlite:///'):],)
+        self.engine = create_engine(dburi)
+        if self.engine.dialect.name == 'sqlite' and not read_only:
+            # In WAL mode readers in other processes never block the
+            # writer (and vice versa).
+            event.listen(self.engine, 'connect', self._setPragmas)
         # metadata.create_all(self.engine)
-        self.migrate(app)
+        if read_only:
+            # The writer owns the schema; fail early if there is none.
+            self.engine.connect().close()
+        else:
+            self.migrate(app)
         # If we want the objects returned from query() to be usable
         # outside of the session, we need to expunge them from the session,
         # and since the DatabaseSession always calls commit() on the session
@@ -144,8 +185,32 @@ class Database(object):
                                             autoflush=False)
         self.session = scoped_session(self.session_factory)
         self.lock = threading.Lock()
+        # Called with the seconds the lock was held by each session.
+        self.lock_timer = None
         self.topics = {}
 
+    def _setPragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        if self.synchronous is not None:
+            cursor.execute('PRAGMA synchronous=%s' % (self.synchronous,))
+        cursor.close()
+
+    def sync(self):
+        # Make committed transactions durable even if sqlite has not
+        # synced them itself.
+        if self.engine.dialect.name != 'sqlite':
+            return
+        path = self.engine.url.database
+        for name in (path, path + '-wal'):
+            if not os.path.exists(name):
+                continue
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
     def getSession(self):
         return DatabaseSession(self)
 
@@ -166,6 +231,7 @@ class Database(object):
             self.log.debug('Stamping database as initial revision')
             alembic.command.stamp(config, "66918e5b789b")
         alembic.command.upgrade(config, 'head')
+        conn.close()
 
     def append(self, msg):
         self.topics.update({msg.topic: str(msg.payload)})
@@ -192,6 +258,8 @@ class DatabaseSession(object):
         end = time.time()
         self.database.log.debug(
             "Database lock held %s seconds" % (end - self.start,))
+        if self.database.lock_timer is not None:
+            self.database.lock_timer(end - self.start)
         self.database.lock.release()
 
     def abort(self):
@@ -206,10 +274,12 @@ class DatabaseSession(object):
     def vacuum(self):
         self.session().execute("VACUUM")
 
-    def getTopics(self, subscribed=False, sort_by='name'):
+    def getTopics(self, subscribed=False, sort_by='name', after=None):
         q = self.session().query(Topic)
         if subscribed:
             q = q.filter_by(subscribed=subscribed)
+        if after is not None:
+            q = q.filter(topic_table.c.key > after)
         if not isinstance(sort_by, (list, tuple)):
             sort_by = [sort_by]
         for s in sort_by:
@@ -240,6 +310,11 @@ class DatabaseSession(object):
     def getMessages(self):
         return self.session().query(Message).order_by(Message.key).all()
 
+    def hasMessage(self, topic_key, updated, message):
+        q = self.session().query(Message.key).filter_by(
+            topic_key=topic_key, updated=updated, message=message)
+        return q.first() is not None
+
     def getMessage(self, key):
         try:
             return self.session().query(Message).filter_by(key=key).one()
@@ -261,6 +336,92 @@ class DatabaseSession(object):
         self.database.log.debug("Search SQL: %s" % q)
         return q.all()
 
+    def getTopicsByFilter(self, topic_filter, sort_by='name'):
+        return [t for t in self.getTopics(sort_by=sort_by)
+                if mqtt.topic_matches_sub(topic_filter, t.name)]
+
+    def getMessageCounts(self, after=None, upto=None):
+        q = self.session().query(message_table.c.topic_key,
+                                 func.count(message_table.c.key))
+        if after is not None:
+            q = q.filter(message_table.c.key > after)
+        if upto is not None:
+            q = q.filter(message_table.c.key <= upto)
+        q = q.group_by(message_table.c.topic_key)
+        return dict(q.all())
+
+    def getLastMessageKey(self):
+        return self.session().query(func.max(message_table.c.key)).scalar()
+
+    def getMessageCount(self, topic_keys, after=None, upto=None):
+        q = self.session().query(func.count(message_table.c.key))
+        q = q.filter(topicKeyIn(topic_keys))
+        if after is not None:
+            q = q.filter(message_table.c.key > after)
+        if upto is not None:
+            q = q.filter(message_table.c.key <= upto)
+        return q.scalar()
+
+    def getMessagesPage(self, topic_key, sort_by='key', reverse=False,
+                        after=None, limit=100):
+        # Keyset pagination: rather than using an OFFSET, continue from
+        # the (sort value, key) position of the last message returned.
+        # topic_key may also be a list of keys, to page through the
+        # messages of several topics with one query.
+        q = self.session().query(Message)
+        if isinstance(topic_key, (list, tuple)):
+            q = q.filter(topicKeyIn(topic_key))
+        else:
+            q = q.filter_by(topic_key=topic_key)
+        key = message_table.c.key
+        if sort_by == 'updated':
+            col = message_table.c.updated
+        else:
+            col = key
+        if after is not None:
+            value, last = after
+            if col is key:
+                if reverse:
+                    q = q.filter(key < last)
+                else:
+                    q = q.filter(key > last)
+            elif reverse:
+                q = q.filter(or_(col < value, and_(col == value, key < last)))
+            else:
+                q = q.filter(or_(col > value, and_(col == value, key > last)))
+        if reverse:
+            q = q.order_by(col.desc(), key.desc())
+        else:
+            q = q.order_by(col, key)
+        return q.limit(limit).all()
+
+    def getMessageRange(self, topic_keys=None, after=None, since=None,
+                        until=None, limit=1000, sort_by='key'):
+        # Keyset pagination in key or (updated, key) order, returning
+        # plain rows of (key, topic_key, updated, message) rather than
+        # objects.  after is the key, or the (updated, key), of the
+        # last row returned.
+        c = message_table.c
+        q = self.session().query(c.key, c.topic_key, c.updated, c.message)
+        if topic_keys is not None:
+            q = q.filter(topicKeyIn(topic_keys))
+        if after is not None:
+            if sort_by == 'updated':
+                value, last = after
+                q = q.filter(or_(c.updated > value,
+                                 and_(c.updated == value, c.key > last)))
+            else:
+                q = q.filter(c.key > after)
+        if since is not None:
+            q = q.filter(c.updated >= since)
+        if until is not None:
+            q = q.filter(c.updated < until)
+        if sort_by == 'updated':
+            q = q.order_by(c.updated, c.key)
+        else:
+            q = q.order_by(c.key)
+        return q.limit(limit).all()
+
     def createTopic(self, *args, **kw):
         o = Topic(*args, **kw)
         self.session().add(o)
@@ -272,3 +433,131 @@ class DatabaseSession(object):
         self.session().add(o)
         self.session().flush()
         return o
+
+    def insertMessages(self, rows):
+        # rows are dicts of topic_key, updated and message; inserted
+        # with one executemany rather than an object per message.
+        self.session().execute(message_table.insert(), rows)
+
+
+class MessageCursor(object):
+    """Iterate over the messages of a single topic in sort order,
+    fetching them from the database one page at a time."""
+
+    def __init__(self, database, topic_key, sort_by='key', reverse=False,
+                 page_size=100):
+        self.database = database
+        self.topic_key = topic_key
+        self.sort_by = sort_by
+        self.reverse = reverse
+        self.page_size = page_size
+        self.position = None
+        self.buffer = collections.deque()
+        self.exhausted = False
+
+    def sortKey(self, message):
+        return (getattr(message, self.sort_by), message.key)
+
+    def fetch(self):
+        with self.database.getSession() as session:
+            page = session.getMessagesPage(
+                self.topic_key, sort_by=self.sort_by, reverse=self.reverse,
+                after=self.position, limit=self.page_size)
+        if len(page) < self.page_size:
+            self.exhausted = True
+        if page:
+            self.position = self.sortKey(page[-1])
+        self.buffer.extend(page)
+        return len(page)
+
+    def peek(self):
+        if not self.buffer and not self.exhausted:
+            self.fetch()
+        if self.buffer:
+            return self.buffer[0]
+        return None
+
+    def pop(self):
+        return self.buffer.popleft()
+
+    def resume(self):
+        # Messages may have been added since we reached the end; look
+        # again on the next peek.
+        self.exhausted = False
+
+
+class MessageSetCursor(MessageCursor):
+    """Iterate over the messages of several topics in sort order,
+    fetching a page of all of them with each query."""
+
+    def __init__(self, database, topic_keys, sort_by='key', reverse=False,
+                 page_size=100):
+        super(MessageSetCursor, self).__init__(
+            database, sorted(topic_keys), sort_by, reverse, page_size)
+
+    def addTopics(self, topic_keys):
+        # Their messages past the current position are returned from
+        # the next page on.
+        self.topic_key = sorted(set(self.topic_key) | set(topic_keys))
+        self.resume()
+
+
+class _Descending(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class MessageMerger(object):
+    """Merge several MessageCursors into one stream in sort order.
+
+    This is a k-way merge: the heap holds the next message of each
+    cursor, so only a page per cursor is ever held in memory.
+    """
+
+    def __init__(self, cursors=(), reverse=False):
+        self.reverse = reverse
+        self.cursors = []
+        self.heap = []
+        self.pending = set()
+        for cursor in cursors:
+            self.addCursor(cursor)
+
+    def addCursor(self, cursor):
+        self.cursors.append(cursor)
+        self._push(len(self.cursors) - 1)
+
+    def _push(self, index):
+        cursor = self.cursors[index]
+        message = cursor.peek()
+        if message is None:
+            return
+        key = cursor.sortKey(message)
+        if self.reverse:
+            key = _Descending(key)
+        heapq.heappush(self.heap, (key, index))
+        self.pending.add(index)
+
+    @property
+    def exhausted(self):
+        return not self.heap
+
+    def take(self, count):
+        ret = []
+        while self.heap and len(ret) < count:
+            key, index = heapq.heappop(self.heap)
+            self.pending.discard(index)
+            message = self.cursors[index].pop()
+            ret.append((message.topic_key, message))
+            self._push(index)
+        return ret
+
+    def resume(self):
+        for index, cursor in enumerate(self.cursors):
+            if index not in self.pending:
+                cursor.resume()
+                self._push(index)
@@ -0,0 +1,132 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import itertools
+import threading
+
+# Number of events kept for readers which have fallen behind.
+EVENT_RING_SIZE = 4096
+# Number of characters of each message carried in its event.
+PREVIEW_LENGTH = 256
+
+
+class UpdateEvent(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join(
+            '%s=%r' % (k, getattr(self, k)) for k in self.__slots__))
+
+
+class TopicAddedEvent(UpdateEvent):
+    __slots__ = ('topic_key', 'name')
+
+    def __init__(self, topic_key, name):
+        self.topic_key = topic_key
+        self.name = name
+
+
+class MessageAddedEvent(UpdateEvent):
+    __slots__ = ('topic_key', 'message_key', 'size', 'updated', 'preview')
+
+    def __init__(self, topic_key, message_key, size, updated=None,
+                 preview=u''):
+        self.topic_key = topic_key
+        self.message_key = message_key
+        self.size = size
+        self.updated = updated
+        self.preview = preview[:PREVIEW_LENGTH]
+
+
+class ConnectionEvent(UpdateEvent):
+    __slots__ = ('server', 'offline_since')
+
+    def __init__(self, server, offline_since=None):
+        self.server = server
+        # The time the connection was lost, or None once connected.
+        self.offline_since = offline_since
+
+
+class EventRing(object):
+    """A bounded ring buffer of update events.
+
+    The ingest side puts events without ever blocking; each reader
+    keeps its own position and is told when it has fallen so far
+    behind that events were overwritten.
+    """
+
+    def __init__(self, size=EVENT_RING_SIZE):
+        self.events = collections.deque(maxlen=size)
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.readers = []
+
+    def put(self, event):
+        with self.lock:
+            self.events.append(event)
+            self.sequence += 1
+            readers = self.readers[:]
+        for reader in readers:
+            reader.notify()
+
+    def drop(self):
+        # Discard the events so that every reader sees an overrun.
+        with self.lock:
+            self.events.clear()
+            self.sequence += 1
+            readers = self.readers[:]
+        for reader in readers:
+            reader.notify()
+
+    def reader(self, wakeup=None):
+        reader = EventReader(self, wakeup)
+        with self.lock:
+            reader.position = self.sequence
+            self.readers.append(reader)
+        return reader
+
+    def removeReader(self, reader):
+        with self.lock:
+            if reader in self.readers:
+                self.readers.remove(reader)
+
+
+class EventReader(object):
+    def __init__(self, ring, wakeup=None):
+        self.ring = ring
+        self.wakeup = wakeup
+        self.position = 0
+        self.pending = False
+        self.dropped = 0
+
+    def notify(self):
+        # Only wake the reader once until it has read the events.
+        if self.wakeup is not None and not self.pending:
+            self.pending = True
+            self.wakeup()
+
+    def read(self):
+        """Return (events, overrun) with every event put since the last
+        read; overrun is True if some of them were lost."""
+        self.pending = False
+        ring = self.ring
+        with ring.lock:
+            oldest = ring.sequence - len(ring.events)
+            overrun = self.position < oldest
+            if overrun:
+                self.dropped += oldest - self.position
+                self.position = oldest
+            ret = list(itertools.islice(ring.events,
+                                        self.position - oldest, None))
+            self.position = ring.sequence
+        return ret, overrun
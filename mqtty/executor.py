@@ -0,0 +1,92 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from concurrent import futures
+import logging
+import os
+import threading
+
+import six
+from six.moves import queue
+
+DEFAULT_WORKERS = 2
+
+
+class QueryExecutor(object):
+    """Run database queries for views in a thread pool.
+
+    Results are delivered back to the urwid main loop through a pipe
+    created with MainLoop.watch_pipe, so that callbacks always run in
+    the UI thread.  Queries are grouped by owner (normally the view
+    which submitted them) so that they can be cancelled together when
+    the view is no longer displayed.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.log = logging.getLogger('mqtty.executor')
+        self.pool = futures.ThreadPoolExecutor(workers)
+        self.completed = queue.Queue()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pipe = None
+
+    def submit(self, owner, fn, callback, *args, **kw):
+        future = self.pool.submit(fn, *args, **kw)
+        future.mqtty_owner = owner
+        future.mqtty_callback = callback
+        with self.lock:
+            self.pending.setdefault(owner, set()).add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        # Called from the worker thread.
+        if future.cancelled():
+            return
+        self.completed.put(future)
+        if self.pipe is not None:
+            os.write(self.pipe, six.b('query\n'))
+
+    def cancel(self, owner):
+        # Queries which have already started can not be interrupted;
+        # they will still be delivered so that the owner's state stays
+        # consistent with what was read.
+        with self.lock:
+            owned = self.pending.get(owner, set())
+            for future in list(owned):
+                if future.cancel():
+                    owned.discard(future)
+            if not owned:
+                self.pending.pop(owner, None)
+
+    def deliver(self, data=None):
+        # Called from the main loop when the pipe is readable.
+        while True:
+            try:
+                future = self.completed.get(0)
+            except queue.Empty:
+                return
+            with self.lock:
+                owned = self.pending.get(future.mqtty_owner, set())
+                owned.discard(future)
+                if not owned:
+                    self.pending.pop(future.mqtty_owner, None)
+            try:
+                result = future.result()
+            except Exception:
+                self.log.exception("Exception in query for %s" %
+                                   (future.mqtty_owner,))
+                continue
+            future.mqtty_callback(result)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
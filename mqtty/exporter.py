@@ -0,0 +1,169 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Export of recorded messages: "mqtty export [options] [FILTER...]".
+#
+# Messages of the topics matching the MQTT filters (every topic by
+# default) are written in the order they were stored, as JSON lines
+# which "mqtty import" reads back, or as CSV.  The database is opened
+# read-only and read a chunk at a time, each in its own short
+# transaction, so an export runs alongside a recorder without holding
+# up its writes and uses the same memory however much it exports.
+
+import csv
+import errno
+import io
+import json
+import logging
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtty import cmd
+from mqtty import config
+from mqtty import db
+from mqtty import importer
+
+# Messages read in one transaction.
+CHUNK_SIZE = 1000
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 2.0
+
+
+class JSONWriter(object):
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, topic, updated, message):
+        self.out.write(json.dumps(dict(
+            topic=topic, payload=message,
+            updated=updated.strftime(importer.TIME_FORMAT))) + '\n')
+
+
+class CSVWriter(object):
+    def __init__(self, out):
+        self.writer = csv.writer(out)
+        self.writer.writerow(('topic', 'updated', 'payload'))
+
+    def write(self, topic, updated, message):
+        self.writer.writerow(
+            (topic, updated.strftime(importer.TIME_FORMAT), message))
+
+
+FORMATS = {
+    'jsonl': JSONWriter,
+    'csv': CSVWriter,
+}
+
+
+class Exporter(object):
+    def __init__(self, server=None, path=config.DEFAULT_CONFIG_PATH,
+                 chunk_size=CHUNK_SIZE, out=sys.stderr):
+        self.log = logging.getLogger('mqtty.exporter')
+        self.config = config.Config(server, path=path, headless=True)
+        self.db = db.Database(self, self.config.dburi, None, read_only=True)
+        self.chunk_size = chunk_size
+        self.out = out
+        self.exported = 0
+
+    def topics(self, filters):
+        """Return the names of the topics matching filters by key."""
+        with self.db.getSession() as session:
+            topics = session.getTopics()
+        return dict((t.key, t.name) for t in topics
+                    if any(mqtt.topic_matches_sub(f, t.name)
+                           for f in filters))
+
+    def report(self, start, final=False):
+        elapsed = max(time.time() - start, 1e-6)
+        self.out.write("%s %s messages, %.1f/s\n" % (
+            'Exported' if final else 'Read', self.exported,
+            self.exported / elapsed))
+        self.out.flush()
+
+    def run(self, writer, filters=('#',), since=None, until=None):
+        names = self.topics(filters)
+        topic_keys = list(names)
+        if list(filters) == ['#']:
+            # Every topic; topics added since are exported too.
+            topic_keys = None
+        start = last_report = time.time()
+        after = None
+        while True:
+            with self.db.getSession() as session:
+                rows = session.getMessageRange(
+                    topic_keys, after, since, until, self.chunk_size)
+            for key, topic_key, updated, message in rows:
+                name = names.get(topic_key)
+                if name is None:
+                    names.update(self.topics(['#']))
+                    name = names[topic_key]
+                writer.write(name, updated, message)
+            self.exported += len(rows)
+            if len(rows) < self.chunk_size:
+                break
+            after = rows[-1][0]
+            now = time.time()
+            if now - last_report >= PROGRESS_INTERVAL:
+                self.report(start)
+                last_report = now
+        self.report(start, final=True)
+
+
+def main(argv):
+    parser = cmd.commandParser(
+        'export', 'Export recorded messages from the database')
+    parser.add_argument('-f', dest='format', choices=sorted(FORMATS),
+                        default='jsonl', help='output format')
+    parser.add_argument('-o', dest='output', default='-',
+                        help='output file, "-" for stdout (the default)')
+    parser.add_argument('--since',
+                        help='only messages received at or after this '
+                        'time (UTC)')
+    parser.add_argument('--until',
+                        help='only messages received before this time (UTC)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='messages read in one transaction '
+                        '(default %s)' % (CHUNK_SIZE,))
+    parser.add_argument('filters', nargs='*', default=['#'],
+                        help='MQTT topic filters to export (default "#")')
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+    exporter = Exporter(args.server, args.path, args.chunk_size)
+    # Always UTF-8, whatever the locale.
+    if args.output == '-':
+        out = io.open(sys.stdout.fileno(), 'w', encoding='utf-8',
+                      newline='', closefd=False)
+    else:
+        out = io.open(args.output, 'w', encoding='utf-8', newline='')
+    try:
+        exporter.run(FORMATS[args.format](out), args.filters,
+                     importer.parseTime(args.since),
+                     importer.parseTime(args.until))
+        out.flush()
+    except KeyboardInterrupt:
+        return 1
+    except IOError as e:
+        # Not an error if the reader of the output has had enough.
+        if e.errno != errno.EPIPE:
+            sys.stderr.write("error: %s\n" % (e,))
+        return 1
+    finally:
+        try:
+            out.close()
+        except IOError:
+            # Already reported.
+            pass
+    return 0
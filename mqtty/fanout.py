@@ -0,0 +1,182 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Re-broadcast received messages to local consumers as Server-Sent
+# Events.  A consumer connects to
+#
+#   GET /events?topic=<filter>[&topic=<filter>...]
+#
+# and receives every message whose topic matches one of the MQTT
+# filters (all of them by default) as an SSE "message" event with a
+# JSON body.  Each consumer has a bounded queue; when it falls behind
+# the oldest messages are dropped and an "overrun" event says how many.
+
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
+import paho.mqtt.client as mqtt
+
+# Number of messages queued for each consumer.
+QUEUE_SIZE = 1000
+# Seconds between keepalive comments sent to idle consumers.
+KEEPALIVE = 15
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class FanoutClient(object):
+    def __init__(self, filters, queue_size=QUEUE_SIZE):
+        self.filters = filters
+        self.queue = collections.deque(maxlen=queue_size)
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def matches(self, topic):
+        for f in self.filters:
+            if mqtt.topic_matches_sub(f, topic):
+                return True
+        return False
+
+    def put(self, item):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(item)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Return (items, dropped) with everything queued since the
+        last call, waiting up to timeout seconds for something."""
+        with self.condition:
+            if not self.queue:
+                self.condition.wait(timeout)
+            items = list(self.queue)
+            self.queue.clear()
+            dropped = self.dropped
+            self.dropped = 0
+        return items, dropped
+
+
+class FanoutHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        fanout = self.server.fanout
+        url = urlparse.urlparse(self.path)
+        if url.path != '/events':
+            self.send_error(404)
+            return
+        filters = urlparse.parse_qs(url.query).get('topic', ['#'])
+        client = FanoutClient(filters, fanout.queue_size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        fanout.addClient(client)
+        try:
+            while fanout.running:
+                items, dropped = client.get(KEEPALIVE)
+                out = []
+                if dropped:
+                    out.append('event: overrun\ndata: %s\n\n' %
+                               json.dumps(dict(dropped=dropped)))
+                for item in items:
+                    out.append('event: message\ndata: %s\n\n' % (item,))
+                if not out:
+                    out.append(': keepalive\n\n')
+                self.wfile.write(''.join(out).encode('utf8'))
+                self.wfile.flush()
+        except (socket.error, ValueError):
+            # The consumer went away.
+            pass
+        finally:
+            fanout.removeClient(client)
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        return str(self.client_address or self.server.server_address)
+
+    def log_message(self, format, *args):
+        self.server.fanout.log.debug(format % args)
+
+
+class TCPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class FanoutServer(object):
+    """Serve received messages to any number of local consumers.
+
+    The writer calls put() for every message; this only appends to the
+    queues of matching consumers, so a slow consumer never holds up
+    ingest.
+    """
+
+    def __init__(self, port=None, path=None, queue_size=QUEUE_SIZE):
+        self.log = logging.getLogger('mqtty.fanout')
+        self.queue_size = queue_size
+        self.clients = []
+        self.lock = threading.Lock()
+        self.running = True
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = UnixServer(path, FanoutHandler)
+        else:
+            # Only local consumers may connect.
+            self.server = TCPServer(('127.0.0.1', port), FanoutHandler)
+        self.server.fanout = self
+
+    def addClient(self, client):
+        with self.lock:
+            self.clients = self.clients + [client]
+        self.log.debug("Added consumer for %s" % (client.filters,))
+
+    def removeClient(self, client):
+        with self.lock:
+            self.clients = [c for c in self.clients if c is not client]
+        self.log.debug("Removed consumer for %s" % (client.filters,))
+
+    def put(self, record):
+        clients = self.clients
+        if not clients:
+            return
+        item = None
+        for client in clients:
+            if not client.matches(record.topic):
+                continue
+            if item is None:
+                item = json.dumps(dict(
+                    topic=record.topic,
+                    updated=record.updated.strftime(TIME_FORMAT),
+                    payload=record.payload.decode('utf-8', 'replace')))
+            client.put(item)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.running = False
+        for client in self.clients:
+            with client.condition:
+                client.condition.notify()
+        self.server.shutdown()
+        self.server.server_close()
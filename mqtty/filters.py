@@ -0,0 +1,193 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Include and exclude rules applied to messages as they are received.
+#
+# A rule has an MQTT topic filter, an optional payload regex and an
+# action.  Rules are checked in order and the first one which matches
+# decides whether a message is kept; messages which match no rule are
+# kept.  The topic filters are compiled into a trie, and the payload
+# regexes of the rules which apply to a topic into a single regex, so
+# a message costs one (cached) lookup and one regex match however many
+# rules there are.
+
+import re
+import threading
+
+# Number of topics whose matching rules are remembered.
+CACHE_SIZE = 10000
+
+# Flags set for a whole pattern, which must move into a scoped group
+# when patterns are combined.
+GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+# Numbered or named backreferences, which would refer to the wrong
+# group once patterns are combined.
+BACKREFERENCE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?P=')
+
+
+def scoped(pattern):
+    """Return a payload pattern which may be combined with others.
+
+    Leading inline flags such as (?i) are turned into a scoped group;
+    ValueError is raised for patterns which cannot be combined.
+    """
+    flags = ''
+    while True:
+        m = GLOBAL_FLAGS.match(pattern)
+        if m is None:
+            break
+        flags += m.group(1)
+        pattern = pattern[m.end():]
+    try:
+        compiled = re.compile(pattern.encode('utf8'))
+    except re.error as e:
+        raise ValueError("Invalid payload pattern %r: %s" % (pattern, e))
+    if compiled.groupindex:
+        raise ValueError("Payload pattern %r may not have named groups" %
+                         (pattern,))
+    if BACKREFERENCE.search(pattern):
+        raise ValueError("Payload pattern %r may not have backreferences" %
+                         (pattern,))
+    if flags:
+        pattern = '(?%s:%s)' % (flags, pattern)
+    return pattern
+
+
+class TopicTrie(object):
+    """Find the values added with the MQTT filters matching a topic."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, topic_filter, value):
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.setdefault(level, {})
+        node.setdefault(None, []).append(value)
+
+    def match(self, topic):
+        levels = topic.split('/')
+        ret = []
+        self._match(self.root, levels, 0, ret)
+        return ret
+
+    def _match(self, node, levels, i, ret):
+        # Wildcards do not match topics starting with $ at the first
+        # level.
+        wild = i > 0 or not levels[0].startswith('$')
+        if wild and '#' in node:
+            # Also matches the parent level.
+            ret.extend(node['#'].get(None, ()))
+        if i == len(levels):
+            ret.extend(node.get(None, ()))
+            return
+        child = node.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, ret)
+        if wild and '+' in node:
+            self._match(node['+'], levels, i + 1, ret)
+
+
+class Rule(object):
+    def __init__(self, index, topic='#', payload=None, action='exclude',
+                 name=None):
+        self.index = index
+        self.topic = topic
+        self.payload = payload
+        self.action = action
+        self.name = name or '%s %s' % (action, topic)
+        self.hits = 0
+
+
+class Filter(object):
+    """Drop excluded messages and pass the rest on to the next stage."""
+
+    def __init__(self, rules, next_stage, cache_size=CACHE_SIZE):
+        self.rules = []
+        self.trie = TopicTrie()
+        for i, r in enumerate(rules):
+            rule = Rule(i, r.get('topic', '#'), r.get('payload'),
+                        r['action'], r.get('name'))
+            if rule.payload is not None:
+                rule.payload = scoped(rule.payload)
+            self.rules.append(rule)
+            self.trie.add(rule.topic, rule)
+        self.next_stage = next_stage
+        self.cache_size = cache_size
+        # Per topic, the combined regex of the rules which apply.
+        self.topics = {}
+        # Per set of rules, the combined regex.
+        self.classes = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        # Fail at startup rather than on the first message: every rule
+        # must compile on its own and combined with the others (which
+        # the rules of any one topic are a subset of).
+        for rule in self.rules:
+            self.compile([rule])
+        self.compile([r for r in self.rules if r.payload is not None])
+
+    def compile(self, rules):
+        """Combine the payload regexes of rules into one, in order.
+
+        Each rule is a lookahead from the start of the payload followed
+        by an empty group named after the rule; alternatives are tried
+        in order, so the name of the group which matched is that of the
+        first matching rule.
+        """
+        parts = []
+        for rule in rules:
+            if rule.payload is None:
+                parts.append('(?P<r%s>)' % (rule.index,))
+                # Nothing after a rule which always matches is used.
+                break
+            parts.append('(?=[\\s\\S]*?(?:%s))(?P<r%s>)' %
+                         (rule.payload, rule.index))
+        return re.compile('|'.join(parts).encode('utf8'))
+
+    def lookup(self, topic):
+        matcher = self.topics.get(topic)
+        if matcher is not None:
+            return matcher
+        rules = sorted(self.trie.match(topic), key=lambda r: r.index)
+        key = tuple(r.index for r in rules)
+        matcher = self.classes.get(key)
+        if matcher is None:
+            if rules:
+                matcher = self.compile(rules)
+            else:
+                matcher = False
+            self.classes[key] = matcher
+        if len(self.topics) >= self.cache_size:
+            self.topics.clear()
+        self.topics[topic] = matcher
+        return matcher
+
+    def match(self, topic, payload):
+        """Return the first rule matching the message, or None."""
+        matcher = self.lookup(topic)
+        if not matcher:
+            return None
+        m = matcher.match(payload)
+        if m is None:
+            return None
+        return self.rules[int(m.lastgroup[1:])]
+
+    def put(self, record):
+        with self.lock:
+            rule = self.match(record.topic, record.payload)
+            if rule is not None:
+                rule.hits += 1
+                if rule.action == 'exclude':
+                    self.dropped += 1
+                    return
+        self.next_stage.put(record)
@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Bulk import of recorded messages: "mqtty import [options] FILE...".
+#
+# Each file (or "-" for stdin, optionally gzipped) holds one message
+# per line, either as JSON
+#
+#   {"topic": "a/b", "payload": "...", "updated": "2017-01-01 00:00:00.0"}
+#
+# ("message" is accepted for "payload", and "timestamp" or "time" in
+# seconds since the epoch for "updated") or as printed by
+# "mosquitto_sub -v", a topic and the payload separated by a space.
+# The format is recognised from the first line of each file.  Messages
+# are written through the same batched writer as received ones, in
+# much larger transactions, each inserted with a single executemany.
+# The exit status is 1 if any of them could not be written.
+
+import calendar
+import datetime
+import gzip
+import io
+import json
+import logging
+import sys
+import threading
+import time
+
+import dateutil.parser
+
+from mqtty import cmd
+from mqtty import config
+from mqtty import db
+from mqtty import events
+from mqtty import ingest
+
+# Messages written in one transaction.
+BATCH_SIZE = 10000
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 2.0
+
+GZIP_MAGIC = b'\x1f\x8b'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def parseTime(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.utcfromtimestamp(value)
+    try:
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+    except ValueError:
+        updated = dateutil.parser.parse(value)
+        if updated.tzinfo is not None:
+            updated = datetime.datetime.utcfromtimestamp(
+                calendar.timegm(updated.utctimetuple()) +
+                updated.microsecond / 1e6)
+        return updated
+
+
+def parseJSON(line):
+    data = json.loads(line.decode('utf8'))
+    payload = data.get('payload', data.get('message', ''))
+    if isinstance(payload, (dict, list)):
+        payload = json.dumps(payload)
+    if not isinstance(payload, bytes):
+        payload = u'%s' % (payload,)
+        payload = payload.encode('utf8')
+    updated = data.get('updated')
+    if updated is None:
+        updated = data.get('timestamp', data.get('time'))
+    return ingest.Record(data['topic'], payload, parseTime(updated))
+
+
+def parseMosquitto(line):
+    topic, _, payload = line.partition(b' ')
+    if not topic:
+        raise ValueError("No topic")
+    return ingest.Record(topic.decode('utf8'), payload)
+
+
+def openInput(name):
+    # A buffered binary file, which can be peeked at, on Python 2 too.
+    if name == '-':
+        f = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+    else:
+        f = io.open(name, 'rb')
+    if f.peek(2)[:2] == GZIP_MAGIC:
+        f = gzip.GzipFile(fileobj=f)
+    return f
+
+
+class Importer(object):
+    def __init__(self, server=None, path=config.DEFAULT_CONFIG_PATH,
+                 batch_size=BATCH_SIZE, drop_indexes=False, out=sys.stderr):
+        self.log = logging.getLogger('mqtty.importer')
+        self.config = config.Config(server, path=path, headless=True)
+        self.db = db.Database(self, self.config.dburi, None)
+        self.writer = ingest.Writer(
+            self.db, events.EventRing(), batch_size=batch_size,
+            ingest_queue=ingest.IngestQueue(max_messages=batch_size * 2),
+            bulk=True)
+        self.drop_indexes = drop_indexes
+        self.out = out
+        self.read = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def dropIndexes(self):
+        """Drop the message indexes; return the SQL to recreate them."""
+        if self.db.engine.dialect.name != 'sqlite':
+            self.log.warning("Indexes are only dropped with sqlite")
+            return []
+        with self.db.engine.begin() as conn:
+            indexes = conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type='index' "
+                "AND tbl_name='message' AND sql IS NOT NULL").fetchall()
+            for name, sql in indexes:
+                conn.execute('DROP INDEX "%s"' % (name,))
+        return [sql for name, sql in indexes]
+
+    def createIndexes(self, indexes):
+        with self.db.engine.begin() as conn:
+            for sql in indexes:
+                conn.execute(sql)
+
+    def report(self, start, final=False):
+        elapsed = max(time.time() - start, 1e-6)
+        written = self.writer.written
+        line = "%s %s messages (%.1f MB), written %.1f/s, %s errors" % (
+            'Imported' if final else 'Read', self.read,
+            self.bytes / 1e6, written / elapsed, self.errors)
+        if self.writer.failed:
+            line += ", %s not written" % (self.writer.failed,)
+        self.out.write(line + '\n')
+        self.out.flush()
+
+    def importFile(self, name, start, last_report):
+        f = openInput(name)
+        parse = None
+        try:
+            for lineno, line in enumerate(f, 1):
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    continue
+                if parse is None:
+                    if line.lstrip().startswith(b'{'):
+                        parse = parseJSON
+                    else:
+                        parse = parseMosquitto
+                try:
+                    record = parse(line)
+                except Exception as e:
+                    self.errors += 1
+                    self.log.debug("%s:%s: %s" % (name, lineno, e))
+                    continue
+                self.read += 1
+                self.bytes += len(line)
+                # Blocks while the writer catches up.
+                self.writer.put(record)
+                if not self.read % 1000:
+                    now = time.time()
+                    if now - last_report >= PROGRESS_INTERVAL:
+                        self.report(start)
+                        last_report = now
+        finally:
+            if name != '-':
+                f.close()
+        return last_report
+
+    def run(self, names):
+        indexes = []
+        if self.drop_indexes:
+            indexes = self.dropIndexes()
+        thread = threading.Thread(target=self.writer.run)
+        thread.daemon = True
+        thread.start()
+        start = last_report = time.time()
+        try:
+            for name in names:
+                last_report = self.importFile(name, start, last_report)
+        finally:
+            self.writer.finish()
+            thread.join()
+            if indexes:
+                self.out.write("Recreating %s indexes\n" % (len(indexes),))
+                self.createIndexes(indexes)
+        self.report(start, final=True)
+
+
+def main(argv):
+    parser = cmd.commandParser(
+        'import', 'Import recorded messages into the database')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='messages written in one transaction '
+                        '(default %s)' % (BATCH_SIZE,))
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='drop the message indexes during the import '
+                        'and recreate them afterwards (sqlite only)')
+    parser.add_argument('files', nargs='*', default=['-'],
+                        help='files to import, "-" for stdin (the default)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+    importer = Importer(args.server, args.path, args.batch_size,
+                        args.drop_indexes)
+    try:
+        importer.run(args.files)
+    except KeyboardInterrupt:
+        return 1
+    except IOError as e:
+        print("error: %s" % (e,))
+        return 1
+    if importer.writer.failed:
+        # The details have been logged.
+        return 1
+    return 0
@@ -0,0 +1,388 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from six.moves import queue
+
+from mqtty import events
+
+# Maximum number of messages written in one transaction.
+BATCH_SIZE = 500
+# Number of QoS 1 and 2 messages remembered to recognise redeliveries.
+DEDUP_SIZE = 10000
+# Limits of the queue of messages waiting to be written.
+MAX_MESSAGES = 100000
+MAX_BYTES = 256 * 1024 * 1024
+# With the sample policy, one in this many messages of each topic is
+# kept while the queue is full.
+SAMPLE_RATE = 10
+
+POLICIES = ('block', 'drop-oldest', 'drop-newest', 'sample')
+
+
+class Record(object):
+    """A received message on its way to the database."""
+
+    __slots__ = ('topic', 'payload', 'updated', 'segment', 'replayed',
+                 'source', 'text')
+
+    def __init__(self, topic, payload, updated=None):
+        self.topic = topic
+        self.payload = payload
+        if updated is None:
+            updated = datetime.datetime.utcnow()
+        self.updated = updated
+        # The journal segment holding the record, if any.
+        self.segment = None
+        # Replayed from the journal, so possibly written already.
+        self.replayed = False
+        # The name of the server the record was received from.
+        self.source = None
+        # The payload as text, if it has been decoded already.
+        self.text = None
+
+
+class Deduplicator(object):
+    """Recognise QoS 1 messages redelivered by the broker.
+
+    A redelivery has the DUP flag set and the same packet id, topic
+    and payload as the original.
+    """
+
+    def __init__(self, size=DEDUP_SIZE):
+        self.size = size
+        self.seen = collections.OrderedDict()
+        self.duplicates = 0
+
+    def check(self, msg):
+        """Return True if msg has been received already."""
+        if msg.qos == 0:
+            return False
+        key = (msg.topic, msg.mid, hash(msg.payload))
+        if key in self.seen:
+            if msg.dup:
+                self.duplicates += 1
+                return True
+            del self.seen[key]
+        self.seen[key] = True
+        if len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        return False
+
+
+class IngestQueue(object):
+    """A queue of records bounded by count and by payload bytes.
+
+    When it is full, the policy decides what happens to a new record:
+
+    block        wait for room, holding up the MQTT client
+    drop-oldest  drop the oldest queued records to make room
+    drop-newest  drop the new record
+    sample       keep one in sample_rate records of each topic, making
+                 room as for drop-oldest, and drop the rest
+    """
+
+    def __init__(self, max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES,
+                 policy='block', sample_rate=SAMPLE_RATE):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy %s" % (policy,))
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.items = collections.deque()
+        self.bytes = 0
+        self.condition = threading.Condition()
+        self.dropped = 0
+        # Per topic, records seen since the queue became full.
+        self.seen = {}
+
+    def _full(self, size):
+        # A record is always accepted into an empty queue, however
+        # large it is.
+        if not self.items:
+            return False
+        return (len(self.items) >= self.max_messages or
+                self.bytes + size > self.max_bytes)
+
+    def put(self, record, force=False, block=False):
+        """Queue a record; return the records dropped to make room.
+
+        If force is True the record is queued whatever the limits; if
+        block is True it waits for room whatever the policy.
+        """
+        size = 0
+        if record is not None:
+            size = len(record.payload)
+        dropped = []
+        keep = True
+        with self.condition:
+            if not force and self._full(size):
+                if self.policy == 'block' or block:
+                    while self._full(size):
+                        self.condition.wait()
+                elif self.policy == 'drop-newest':
+                    keep = False
+                elif self.policy == 'sample':
+                    count = self.seen.get(record.topic, 0)
+                    self.seen[record.topic] = count + 1
+                    keep = count % self.sample_rate == 0
+                if keep:
+                    while self._full(size):
+                        old = self.items.popleft()
+                        self.bytes -= len(old.payload)
+                        dropped.append(old)
+                else:
+                    dropped.append(record)
+            elif self.seen:
+                # No longer full; start sampling afresh next time.
+                self.seen = {}
+            if keep:
+                self.items.append(record)
+                self.bytes += size
+            self.dropped += len(dropped)
+            self.condition.notify_all()
+        return dropped
+
+    def get(self, block=True):
+        with self.condition:
+            while not self.items:
+                if not block:
+                    raise queue.Empty()
+                self.condition.wait()
+            record = self.items.popleft()
+            if record is not None:
+                self.bytes -= len(record.payload)
+            self.condition.notify_all()
+        return record
+
+    def qsize(self):
+        return len(self.items)
+
+
+def makeQueue(queue_config):
+    """Return an IngestQueue with the ingest-queue settings."""
+    return IngestQueue(
+        queue_config.get('max-messages', MAX_MESSAGES),
+        queue_config.get('max-bytes', MAX_BYTES),
+        queue_config.get('policy', 'block'),
+        queue_config.get('sample-rate', SAMPLE_RATE))
+
+
+class Writer(object):
+    """Write received messages to the database in batches.
+
+    Messages are queued by the MQTT client thread and written by the
+    writer thread, one transaction per batch; events are published
+    once each batch is committed.
+    """
+
+    def __init__(self, database, event_ring, batch_size=BATCH_SIZE,
+                 journal=None, checkpoint_interval=None, ingest_queue=None,
+                 bulk=False):
+        self.log = logging.getLogger('mqtty.ingest')
+        self.db = database
+        self.events = event_ring
+        self.batch_size = batch_size
+        # Insert each batch with one executemany and publish no
+        # message events; for imports.
+        self.bulk = bulk
+        self.journal = journal
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        if ingest_queue is None:
+            ingest_queue = IngestQueue()
+        self.queue = ingest_queue
+        # Callables which see every message as it is received, before
+        # it is written.
+        self.taps = []
+        # Decides which of the messages the taps see are stored.
+        self.sampler = None
+        self.topics = {}
+        # Per server, the seconds the oldest message of the last batch
+        # waited between being received and being committed.
+        self.lag = {}
+        self.running = True
+        self.received = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def put(self, record):
+        self.received += 1
+        for tap in self.taps:
+            tap(record)
+        if self.sampler is not None and not self.sampler.sample(record):
+            self.preview(record)
+            return
+        self.store(record)
+
+    def preview(self, record):
+        # The record is not stored, but live tail still shows it; the
+        # event has no message key.  Nothing is shown until a message
+        # of the topic has been written.
+        topic_key = self.topics.get(record.topic)
+        if topic_key is None:
+            return
+        text = record.text
+        if text is None:
+            text = record.payload.decode('utf-8', 'replace')
+        self.events.put(events.MessageAddedEvent(
+            topic_key, None, len(text), record.updated, text))
+
+    def store(self, record):
+        if self.journal is not None:
+            self.journal.append(record)
+        dropped = self.queue.put(record)
+        if dropped and self.journal is not None:
+            # Dropped records are done with as far as the journal is
+            # concerned.
+            self.journal.commit(dropped)
+
+    def replay(self):
+        # Queue whatever a previous run left in the journal; this must
+        # happen before any new message is put, and while the writer
+        # is running, so that the queue keeps its bounds.
+        for record in self.journal.replay():
+            self.queue.put(record, block=True)
+
+    def checkpoint(self):
+        self.journal.checkpoint(self.db.sync)
+        self.last_checkpoint = time.time()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        self.running = False
+        self.queue.put(None, force=True)
+
+    def finish(self):
+        # Stop once everything queued so far is written.
+        self.queue.put(None, force=True)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(0)
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.running = False
+                    break
+                batch.append(record)
+            if self.journal is not None:
+                # Group commit: one sync covers the whole batch.
+                self.journal.sync()
+            try:
+                if self.bulk:
+                    self.insert(batch)
+                else:
+                    self.write(batch)
+                if self.journal is not None:
+                    self.journal.commit(batch)
+            except Exception:
+                # The messages stay in the journal until the next run.
+                self.log.exception("Unable to write %s messages" %
+                                   (len(batch),))
+                self.failed += len(batch)
+                # Topics created in the failed transaction are gone.
+                self.topics.clear()
+            if (self.journal is not None and
+                    time.time() - self.last_checkpoint >=
+                    self.checkpoint_interval):
+                self.checkpoint()
+            if not self.running:
+                break
+        if self.journal is not None:
+            self.checkpoint()
+        self.log.debug("Writer stopped after %s messages" % (self.written,))
+
+    def write(self, batch):
+        start = time.time()
+        new_events = []
+        oldest = {}
+        with self.db.getSession() as session:
+            for record in batch:
+                if record.source not in oldest and not record.replayed:
+                    oldest[record.source] = record.updated
+                topic_key = self.topics.get(record.topic)
+                if topic_key is None:
+                    topic = session.getTopicByName(record.topic)
+                    if not topic:
+                        topic = session.createTopic(record.topic)
+                        new_events.append(
+                            events.TopicAddedEvent(topic.key, topic.name))
+                    topic_key = self.topics[record.topic] = topic.key
+                text = record.text
+                if text is None:
+                    text = record.payload.decode('utf-8', 'replace')
+                if record.replayed and session.hasMessage(
+                        topic_key, record.updated, text):
+                    continue
+                message = session.createMessage(
+                    text, topic_key=topic_key, updated=record.updated)
+                new_events.append(events.MessageAddedEvent(
+                    topic_key, message.key, len(text), record.updated, text))
+        # Publish only once the transaction is committed so that
+        # readers can see what the events refer to.
+        for event in new_events:
+            self.events.put(event)
+        now = datetime.datetime.utcnow()
+        for source, updated in oldest.items():
+            if source is not None:
+                self.lag[source] = (now - updated).total_seconds()
+        self.written += len(batch)
+        self.batches += 1
+        self.log.debug("Wrote %s messages in %.3f seconds" %
+                       (len(batch), time.time() - start))
+
+    def insert(self, batch):
+        # Topics are looked up once per batch, and the messages
+        # inserted without loading them back, so there are no keys to
+        # publish message events with.
+        start = time.time()
+        new_events = []
+        with self.db.getSession() as session:
+            for name in set(record.topic for record in batch):
+                if name in self.topics:
+                    continue
+                topic = session.getTopicByName(name)
+                if not topic:
+                    topic = session.createTopic(name)
+                    new_events.append(
+                        events.TopicAddedEvent(topic.key, topic.name))
+                self.topics[name] = topic.key
+            rows = []
+            for record in batch:
+                text = record.text
+                if text is None:
+                    text = record.payload.decode('utf-8', 'replace')
+                rows.append(dict(topic_key=self.topics[record.topic],
+                                 updated=record.updated, message=text))
+            session.insertMessages(rows)
+        for event in new_events:
+            self.events.put(event)
+        self.written += len(batch)
+        self.batches += 1
+        self.log.debug("Inserted %s messages in %.3f seconds" %
+                       (len(batch), time.time() - start))
@@ -0,0 +1,175 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# An append-only journal of received messages, so that the database
+# can be written without syncing it on every commit.
+#
+# Every record is written to the current segment file as it is
+# received, so that it survives the process; the writer syncs the
+# journal once per batch (a group commit) before writing the batch to
+# the database, which makes it survive a power loss as well.  At a checkpoint
+# the journal moves on to a new segment, the database files are synced
+# and every older segment whose records have all been committed is
+# removed.  Segments left behind by a crash are replayed on startup.
+
+import calendar
+import datetime
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from mqtty import ingest
+
+# Seconds between checkpoints.
+CHECKPOINT_INTERVAL = 60
+
+# Each entry is its length and CRC followed by the receive time, the
+# length of the topic, the topic and the payload.
+FRAME = struct.Struct('<II')
+ENTRY = struct.Struct('<dH')
+SUFFIX = '.journal'
+
+
+class Journal(object):
+    def __init__(self, path):
+        self.log = logging.getLogger('mqtty.journal')
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        self.lock = threading.Lock()
+        # Per segment: number of records appended and committed.
+        self.appended = {}
+        self.committed = {}
+        segments = self.segments()
+        if segments:
+            self.segment = segments[-1] + 1
+        else:
+            self.segment = 0
+        self.file = None
+        self.open()
+
+    def segments(self):
+        ret = []
+        for name in os.listdir(self.path):
+            if name.endswith(SUFFIX):
+                try:
+                    ret.append(int(name[:-len(SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(ret)
+
+    def _segmentPath(self, segment):
+        return os.path.join(self.path, '%08d%s' % (segment, SUFFIX))
+
+    def open(self):
+        # Unbuffered, so that each record reaches the OS as soon as it
+        # is appended.
+        self.file = open(self._segmentPath(self.segment), 'ab', 0)
+        self.appended[self.segment] = 0
+        self.committed[self.segment] = 0
+
+    def replay(self):
+        """Yield the records of the segments left by a previous run."""
+        for segment in self.segments():
+            if segment >= self.segment:
+                continue
+            count = 0
+            for record in self._read(segment):
+                record.segment = segment
+                record.replayed = True
+                count += 1
+                yield record
+            with self.lock:
+                self.appended[segment] = count
+                self.committed.setdefault(segment, 0)
+            self.log.info("Replaying %s messages from journal segment %s" %
+                          (count, segment))
+
+    def _read(self, segment):
+        # One entry at a time; a segment may be larger than memory.
+        with open(self._segmentPath(segment), 'rb') as f:
+            while True:
+                frame = f.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    break
+                length, crc = FRAME.unpack(frame)
+                body = f.read(length)
+                if (len(body) < length or
+                        zlib.crc32(body) & 0xffffffff != crc):
+                    # A write torn by the crash; nothing after it was
+                    # synced.
+                    self.log.warning("Truncated entry in journal "
+                                     "segment %s" % (segment,))
+                    break
+                updated, topic_len = ENTRY.unpack_from(body, 0)
+                topic = body[ENTRY.size:ENTRY.size + topic_len].decode(
+                    'utf8')
+                payload = body[ENTRY.size + topic_len:]
+                yield ingest.Record(
+                    topic, payload,
+                    datetime.datetime.utcfromtimestamp(updated))
+
+    def append(self, record):
+        topic = record.topic.encode('utf8')
+        updated = calendar.timegm(record.updated.utctimetuple()) + (
+            record.updated.microsecond / 1e6)
+        body = ENTRY.pack(updated, len(topic)) + topic + record.payload
+        frame = FRAME.pack(len(body), zlib.crc32(body) & 0xffffffff)
+        with self.lock:
+            self.file.write(frame + body)
+            self.appended[self.segment] += 1
+            record.segment = self.segment
+
+    def sync(self):
+        """Make every record appended so far durable."""
+        with self.lock:
+            self.file.flush()
+            fd = self.file.fileno()
+        os.fsync(fd)
+
+    def commit(self, records):
+        with self.lock:
+            for record in records:
+                self.committed[record.segment] += 1
+
+    def checkpoint(self, sync_database):
+        """Remove the segments whose records are all in the database.
+
+        sync_database is called to make the database durable once the
+        journal has moved on to a new segment.
+        """
+        with self.lock:
+            # Records appended since the last sync are only in this
+            # segment; make them durable before moving on.
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.segment += 1
+            self.open()
+        sync_database()
+        with self.lock:
+            done = sorted(s for s in self.appended
+                          if s != self.segment and
+                          self.committed[s] >= self.appended[s])
+            for segment in done:
+                del self.appended[segment]
+                del self.committed[segment]
+        for segment in done:
+            os.unlink(self._segmentPath(segment))
+        if done:
+            self.log.debug("Removed journal segments %s" % (done,))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -76,6 +76,8 @@ MOVE_PROJECT_TOPIC = 'move to project topic'
 COPY_PROJECT_TOPIC = 'copy to project topic'
 REMOVE_PROJECT_TOPIC = 'remove from project topic'
 RENAME_PROJECT_TOPIC = 'rename project topic'
+# Message list screen:
+TOGGLE_TAIL = 'toggle tail'
 # Diff screens:
 SELECT_PATCHSETS = 'select patchsets'
 NEXT_SELECTABLE = 'next selectable'
@@ -144,6 +146,8 @@ DEFAULT_KEYMAP = {
     REMOVE_PROJECT_TOPIC: [['T', 'D']],
     RENAME_PROJECT_TOPIC: [['T', 'r']],
 
+    TOGGLE_TAIL: 'f',
+
     SELECT_PATCHSETS: 'p',
     NEXT_SELECTABLE: 'tab',
     PREV_SELECTABLE: 'shift tab',
@@ -27,7 +27,7 @@ GLOBAL_HELP = (
     (keymap.QUIT,
      "Quit Mqtty"),
     (keymap.CHANGE_SEARCH,
-     "Search for changes"),
+     "Show messages of all topics matching a filter"),
     (keymap.LIST_HELD,
      "List held changes"),
     (keymap.KILL,
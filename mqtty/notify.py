@@ -0,0 +1,219 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Update notifications from the process which writes the database to
+# the read-only viewers attached to it.  Every viewer binds a unix
+# datagram socket in the notification directory; the writer sends each
+# batch of events to all of them without ever blocking.  Datagrams are
+# numbered so that a viewer which missed some can catch up by
+# refreshing its screen.
+
+import datetime
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+
+from mqtty import events
+
+# Seconds between checks of the notification directory for viewers.
+SCAN_INTERVAL = 1.0
+# Maximum number of events sent in one datagram.
+MAX_EVENTS = 64
+# Maximum encoded size of a datagram; batches are split to fit.
+MAX_DATAGRAM = 65536
+RECEIVE_BUFFER = 1024 * 1024
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode(event):
+    data = dict(type=event.__class__.__name__)
+    for k in event.__slots__:
+        value = getattr(event, k)
+        if isinstance(value, datetime.datetime):
+            value = value.strftime(TIME_FORMAT)
+        data[k] = value
+    return data
+
+
+def decode(data):
+    klass = getattr(events, data.pop('type'))
+    if data.get('updated'):
+        data['updated'] = datetime.datetime.strptime(data['updated'],
+                                                     TIME_FORMAT)
+    return klass(**data)
+
+
+class Notifier(object):
+    """Send the events put in an event ring to the attached viewers."""
+
+    def __init__(self, directory, ring):
+        self.log = logging.getLogger('mqtty.notify')
+        self.directory = directory
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.wakeup = threading.Event()
+        self.reader = ring.reader(self.wakeup.set)
+        self.ring = ring
+        self.viewers = []
+        self.mtime = None
+        self.sequence = 0
+        self.running = True
+
+    def scan(self):
+        # Viewers add and remove their sockets, which changes the
+        # modification time of the directory.
+        try:
+            mtime = os.stat(self.directory).st_mtime
+            if mtime == self.mtime:
+                return
+            names = os.listdir(self.directory)
+        except OSError:
+            mtime = None
+            names = []
+        self.mtime = mtime
+        self.viewers = [os.path.join(self.directory, n) for n in names
+                        if n.endswith('.sock')]
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(SCAN_INTERVAL)
+            self.wakeup.clear()
+            self.scan()
+            evs, overrun = self.reader.read()
+            if overrun:
+                # Skip a number so that the viewers see the gap.
+                self.sequence += 1
+            for batch in self.batches(evs):
+                self.send(batch)
+        self.ring.removeReader(self.reader)
+        self.socket.close()
+
+    def batches(self, evs):
+        # Split the events into batches whose datagrams fit in
+        # MAX_DATAGRAM, leaving room for the sequence number.
+        limit = MAX_DATAGRAM - 64
+        batch = []
+        size = 0
+        for event in evs:
+            data = json.dumps(encode(event)).encode('utf8')
+            if len(data) + 1 > limit:
+                # Too large to send at all (a very long topic name);
+                # skip a number so that the viewers refresh instead.
+                self.log.debug("Not sending a %s byte notification" %
+                               (len(data),))
+                if batch:
+                    yield batch
+                    batch = []
+                    size = 0
+                self.sequence += 1
+                continue
+            if batch and (len(batch) >= MAX_EVENTS or
+                          size + len(data) + 1 > limit):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(data)
+            size += len(data) + 1
+        if batch:
+            yield batch
+
+    def send(self, batch):
+        self.sequence += 1
+        if not self.viewers:
+            return
+        datagram = (b'{"seq": ' + str(self.sequence).encode('ascii') +
+                    b', "events": [' + b','.join(batch) + b']}')
+        for path in self.viewers[:]:
+            try:
+                self.socket.sendto(datagram, path)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # The viewer has gone away.
+                    self.log.debug("Removing stale viewer socket %s" %
+                                   (path,))
+                    self.viewers.remove(path)
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                     errno.ENOBUFS, errno.EMSGSIZE):
+                    self.log.exception("Unable to notify %s" % (path,))
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+
+class Listener(object):
+    """Receive the events sent by a Notifier and put them in a ring."""
+
+    def __init__(self, directory, ring):
+        self.log = logging.getLogger('mqtty.notify')
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.path = os.path.join(directory, '%s.sock' % os.getpid())
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   RECEIVE_BUFFER)
+        except socket.error:
+            pass
+        self.socket.bind(self.path)
+        self.events = ring
+        self.sequence = None
+
+    def run(self):
+        while True:
+            try:
+                # One byte more than a datagram may hold, to tell when
+                # one was truncated.
+                data = self.socket.recv(MAX_DATAGRAM + 1)
+            except socket.error:
+                break
+            if not data:
+                break
+            if len(data) > MAX_DATAGRAM:
+                self.log.debug("Discarding a truncated notification")
+                self.events.drop()
+                self.sequence = None
+                continue
+            try:
+                data = json.loads(data.decode('utf8'))
+                if (self.sequence is not None and
+                        data['seq'] != self.sequence + 1):
+                    self.log.debug("Missed notifications %s to %s" %
+                                   (self.sequence + 1, data['seq'] - 1))
+                    self.events.drop()
+                self.sequence = data['seq']
+                for event in data['events']:
+                    self.events.put(decode(event))
+            except Exception:
+                self.log.exception("Unable to decode notification")
+                self.events.drop()
+
+    def stop(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
@@ -0,0 +1,95 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+
+from mqtty import db
+
+# How long the focus must rest on a topic before it is prefetched.
+PREFETCH_DELAY = 0.3
+
+
+class Prefetcher(object):
+    """Load the first page of messages of the focused topic in the
+    background.
+
+    Pages are kept as positioned MessageCursors, so a message list can
+    display them immediately and continue paging from where the
+    prefetch stopped.  The cache is bounded by the total size of the
+    message bodies it holds.
+    """
+
+    def __init__(self, app, budget, page_size):
+        self.log = logging.getLogger('mqtty.prefetch')
+        self.app = app
+        self.budget = budget
+        self.page_size = page_size
+        self.cursors = collections.OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.alarm = None
+        self.topic_key = None
+
+    def focus(self, topic_key):
+        if topic_key == self.topic_key:
+            return
+        self.cancel()
+        self.topic_key = topic_key
+        if topic_key is None or topic_key in self.cursors:
+            return
+        self.alarm = self.app.loop.set_alarm_in(PREFETCH_DELAY, self._start)
+
+    def cancel(self):
+        if self.alarm is not None:
+            self.app.loop.remove_alarm(self.alarm)
+            self.alarm = None
+        self.app.executor.cancel(self)
+        self.topic_key = None
+
+    def _start(self, loop=None, data=None):
+        self.alarm = None
+        self.log.debug("Prefetching topic %s" % (self.topic_key,))
+        cursor = db.MessageCursor(self.app.db, self.topic_key,
+                                  page_size=self.page_size)
+        self.app.executor.submit(self, self._query, self._store, cursor)
+
+    def _query(self, cursor):
+        # Runs in an executor thread.
+        cursor.fetch()
+        return cursor
+
+    def _store(self, cursor):
+        size = sum(len(m.message) for m in cursor.buffer)
+        if size > self.budget:
+            return
+        self.cursors.pop(cursor.topic_key, None)
+        self.size -= self.sizes.pop(cursor.topic_key, 0)
+        self.cursors[cursor.topic_key] = cursor
+        self.sizes[cursor.topic_key] = size
+        self.size += size
+        while self.size > self.budget:
+            topic_key, old = self.cursors.popitem(last=False)
+            self.size -= self.sizes.pop(topic_key)
+
+    def take(self, topic_key):
+        cursor = self.cursors.pop(topic_key, None)
+        if cursor is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.size -= self.sizes.pop(topic_key)
+        self.log.debug("Prefetch %s for topic %s (hits: %s misses: %s)" % (
+            cursor and 'hit' or 'miss', topic_key, self.hits, self.misses))
+        return cursor
@@ -0,0 +1,327 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Load generation and latency probes: "mqtty bench-publish [options]".
+#
+# Probe messages are published at a given rate over a number of topics
+# and carry the time they were sent:
+#
+#   mqtty-probe <send time> <sequence> <padding to the payload size>
+#
+# bench-publish subscribes to its own topics and reports the latency
+# through the broker; any mqtty recording them measures it as well,
+# from the time each message was received, and shows it in the status
+# bar.  Senders and receivers on different hosts need synchronised
+# clocks.
+
+import calendar
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from mqtty import cmd
+from mqtty import config
+
+MAGIC = b'mqtty-probe '
+# Number of recent latencies the percentiles are taken from.
+WINDOW = 10000
+PERCENTILES = (50, 90, 99)
+# Seconds to wait for the last messages after publishing.
+GRACE = 2.0
+# Messages published but not yet sent (QoS 0) or acknowledged.
+INFLIGHT = 1000
+# Seconds to wait for the broker to accept a connection or subscription.
+CONNECT_TIMEOUT = 10.0
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 2.0
+
+
+def makePayload(sequence, size):
+    header = MAGIC + ('%.6f %d ' % (time.time(), sequence)).encode('ascii')
+    return header + b'x' * (size - len(header))
+
+
+def timestamp(updated):
+    """Return a UTC datetime in seconds since the epoch."""
+    return calendar.timegm(updated.utctimetuple()) + (
+        updated.microsecond / 1e6)
+
+
+def sentTime(payload):
+    """Return the time a probe was sent, or None if it is not one."""
+    if payload[:len(MAGIC)] != MAGIC:
+        return None
+    try:
+        return float(payload[len(MAGIC):].split(b' ', 1)[0])
+    except ValueError:
+        return None
+
+
+class Latency(object):
+    """Latencies of the most recently received probe messages."""
+
+    def __init__(self, window=WINDOW):
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.count = 0
+        self._percentiles = (None, None)
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.count += 1
+
+    def tap(self, record):
+        # A writer tap; costs one comparison for other messages.
+        sent = sentTime(record.payload)
+        if sent is None:
+            return
+        self.add(timestamp(record.updated) - sent)
+
+    def percentiles(self):
+        """Return the percentiles and maximum in seconds, by name."""
+        with self.lock:
+            count, ret = self._percentiles
+            if count == self.count:
+                return ret
+            latencies = sorted(self.latencies)
+            count = self.count
+        ret = collections.OrderedDict()
+        if latencies:
+            for p in PERCENTILES:
+                index = max(0, (len(latencies) * p + 99) // 100 - 1)
+                ret['p%s' % (p,)] = latencies[index]
+            ret['max'] = latencies[-1]
+        with self.lock:
+            self._percentiles = (count, ret)
+        return ret
+
+
+def formatLatency(percentiles):
+    return ', '.join('%s %.1fms' % (name, seconds * 1000)
+                     for name, seconds in percentiles.items())
+
+
+class Publisher(object):
+    def __init__(self, server=None, path=config.DEFAULT_CONFIG_PATH,
+                 host=None, port=None, out=sys.stderr):
+        self.log = logging.getLogger('mqtty.probe')
+        self.config = config.Config(server, path=path, headless=True)
+        self.host = host or self.config.server['host']
+        self.port = port or self.config.server.get('port', 1883)
+        self.out = out
+        self.latency = Latency()
+        self.sent = 0
+        self.completed = 0
+        self.received = 0
+        self.condition = threading.Condition()
+        self.connected = threading.Event()
+        self.subscribed = threading.Event()
+        self.connect_error = None
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.connect_error = mqtt.connack_string(rc)
+            self.subscribed.set()
+            return
+        client.subscribe(userdata, 0)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        self.subscribed.set()
+
+    def on_publisher_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.connect_error = mqtt.connack_string(rc)
+        self.connected.set()
+
+    def on_connect_fail(self, client, userdata):
+        self.connect_error = "connection failed"
+        self.subscribed.set()
+        self.connected.set()
+
+    def on_publish(self, client, userdata, mid):
+        with self.condition:
+            self.completed += 1
+            self.condition.notify_all()
+
+    def on_disconnect(self, client, userdata, rc):
+        if userdata == 0:
+            # paho discards unsent QoS 0 messages; stop waiting for them.
+            with self.condition:
+                self.completed = self.sent
+                self.condition.notify_all()
+
+    def waitFor(self, event, clients):
+        if not event.wait(CONNECT_TIMEOUT) or self.connect_error:
+            for client in clients:
+                client.loop_stop()
+            raise IOError("Unable to connect to %s:%s: %s" % (
+                self.host, self.port,
+                self.connect_error or "no answer after %ss" % (
+                    CONNECT_TIMEOUT,)))
+
+    def wait(self, inflight):
+        # Wait until at most inflight messages are outstanding.
+        with self.condition:
+            while self.sent - self.completed > inflight:
+                self.condition.wait()
+
+    def on_message(self, client, userdata, msg):
+        sent = sentTime(msg.payload)
+        if sent is not None:
+            self.received += 1
+            self.latency.add(time.time() - sent)
+
+    def connect(self, client):
+        # wait() keeps the messages paho holds to INFLIGHT.
+        client.max_inflight_messages_set(0)
+        client.on_connect_fail = self.on_connect_fail
+        client.connect_async(self.host, self.port)
+        client.loop_start()
+
+    def report(self, start, final=False):
+        elapsed = max(time.time() - start, 1e-6)
+        line = "%s %s messages, %.1f/s, received %s" % (
+            'Published' if final else 'Sent', self.sent,
+            self.sent / elapsed, self.received)
+        percentiles = self.latency.percentiles()
+        if percentiles:
+            line += "; latency " + formatLatency(percentiles)
+        self.out.write(line + '\n')
+        self.out.flush()
+
+    def run(self, prefix='mqtty/bench', topics=1, size=100, rate=100.0,
+            qos=0, count=None, duration=10.0, receive=True):
+        clients = []
+        receiver = None
+        if receive:
+            receiver = mqtt.Client(userdata=prefix + '/#')
+            receiver.on_connect = self.on_connect
+            receiver.on_subscribe = self.on_subscribe
+            receiver.on_message = self.on_message
+            self.connect(receiver)
+            clients.append(receiver)
+            self.waitFor(self.subscribed, clients)
+        publisher = mqtt.Client(userdata=qos)
+        publisher.on_connect = self.on_publisher_connect
+        publisher.on_publish = self.on_publish
+        publisher.on_disconnect = self.on_disconnect
+        self.connect(publisher)
+        clients.append(publisher)
+        self.waitFor(self.connected, clients)
+        start = last_report = time.time()
+        while True:
+            now = time.time()
+            if count is not None and self.sent >= count:
+                break
+            if count is None and now - start >= duration:
+                break
+            if rate:
+                due = start + self.sent / rate
+                if due > now:
+                    time.sleep(due - now)
+            topic = '%s/%s' % (prefix, self.sent % topics)
+            self.wait(INFLIGHT - 1)
+            sequence = self.sent
+            with self.condition:
+                self.sent += 1
+            publisher.publish(topic, makePayload(sequence, size), qos)
+            if now - last_report >= PROGRESS_INTERVAL:
+                self.report(start)
+                last_report = now
+        self.wait(0)
+        elapsed = time.time() - start
+        if receiver is not None:
+            # Wait for the messages still on their way.
+            grace = time.time() + GRACE
+            while self.received < self.sent and time.time() < grace:
+                time.sleep(0.05)
+            receiver.disconnect()
+            receiver.loop_stop()
+        publisher.disconnect()
+        publisher.loop_stop()
+        self.report(start, final=True)
+        return collections.OrderedDict([
+            ('host', self.host),
+            ('port', self.port),
+            ('topics', topics),
+            ('size', size),
+            ('rate', rate),
+            ('qos', qos),
+            ('sent', self.sent),
+            ('received', self.received if receive else None),
+            ('seconds', elapsed),
+            ('sent_per_second', self.sent / max(elapsed, 1e-6)),
+            ('latency_ms', collections.OrderedDict(
+                (name, seconds * 1000) for name, seconds in
+                self.latency.percentiles().items())),
+        ])
+
+
+def main(argv):
+    parser = cmd.commandParser(
+        'bench-publish', 'Publish probe messages and measure their latency')
+    parser.add_argument('--host',
+                        help="the broker to publish to (default the "
+                        "server's)")
+    parser.add_argument('--port', type=int,
+                        help="the broker's port")
+    parser.add_argument('--prefix', default='mqtty/bench',
+                        help='the topic to publish under (default '
+                        'mqtty/bench)')
+    parser.add_argument('--topics', type=int, default=1,
+                        help='number of topics to spread messages over '
+                        '(default 1)')
+    parser.add_argument('--size', type=int, default=100,
+                        help='payload size in bytes (default 100)')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='messages per second, 0 for as fast as '
+                        'possible (default 100)')
+    parser.add_argument('--qos', type=int, choices=(0, 1, 2), default=0,
+                        help='the QoS to publish with (default 0)')
+    parser.add_argument('--count', type=int,
+                        help='number of messages to publish')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to publish for, if no count is '
+                        'given (default 10)')
+    parser.add_argument('--no-receive', dest='receive',
+                        action='store_false',
+                        help='only publish; leave measuring the latency '
+                        'to a recorder')
+    parser.add_argument('--report',
+                        help='write the results to this file as JSON')
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+    if args.topics < 1:
+        parser.error("there must be at least one topic")
+    publisher = Publisher(args.server, args.path, args.host, args.port)
+    try:
+        results = publisher.run(args.prefix, args.topics, args.size,
+                                args.rate, args.qos, args.count,
+                                args.duration, args.receive)
+    except KeyboardInterrupt:
+        return 1
+    except IOError as e:
+        sys.stderr.write("error: %s\n" % (e,))
+        return 1
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    return 0
@@ -0,0 +1,220 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# A processing stage between the MQTT clients and the database writer.
+#
+# Received messages are collected into batches which run through a
+# list of stages in a pool of processes; the results are handed to the
+# writer in the order the messages were received.  A stage is a
+# function
+#
+#   stage(topic, payload) -> payload
+#
+# which may return bytes, text (which is stored as it is) or None to
+# drop the message.  Stages are named either by one of the built-in
+# names in STAGES or as "package.module:function"; they run in other
+# processes, so they must be importable there.  If a stage raises an
+# exception, the message is passed on to the next stage unchanged.
+
+import collections
+import importlib
+import logging
+import multiprocessing
+import threading
+import time
+
+from concurrent import futures
+from six.moves import queue
+
+from mqtty import ingest
+
+# Maximum number of messages sent to a process at once.
+BATCH_SIZE = 500
+
+
+def decode(topic, payload):
+    return payload.decode('utf-8', 'replace')
+
+
+STAGES = {
+    'decode': decode,
+}
+
+_resolved = {}
+
+
+def resolve(name):
+    fn = _resolved.get(name)
+    if fn is None:
+        fn = STAGES.get(name)
+        if fn is None:
+            module, _, attr = name.partition(':')
+            if not attr:
+                raise ValueError("Unknown processing stage %s" % (name,))
+            fn = getattr(importlib.import_module(module), attr)
+        _resolved[name] = fn
+    return fn
+
+
+def process(stages, items):
+    """Run a batch through the stages; this runs in a pool process.
+
+    Return the results, the seconds spent in each stage and the number
+    of errors.
+    """
+    timings = [0.0] * len(stages)
+    errors = 0
+    results = []
+    fns = [resolve(name) for name in stages]
+    for topic, payload in items:
+        for i, fn in enumerate(fns):
+            if payload is None:
+                break
+            start = time.time()
+            try:
+                payload = fn(topic, payload)
+            except Exception:
+                errors += 1
+            timings[i] += time.time() - start
+        results.append(payload)
+    return results, timings, errors
+
+
+def makePool(workers):
+    # The pool starts its processes on the first batch, by which time
+    # the MQTT client and writer threads are running; a process forked
+    # then could inherit locks (logging, sqlite, paho) held by one of
+    # them and deadlock.  Start them from a clean process instead, or
+    # where the pool cannot do that, right away.
+    if hasattr(multiprocessing, 'get_context'):
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            method = 'forkserver'
+        else:
+            method = 'spawn'
+        try:
+            return futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context(method))
+        except TypeError:
+            # No mp_context before Python 3.7.
+            pass
+    pool = futures.ProcessPoolExecutor(workers)
+    pool.submit(len, ()).result()
+    return pool
+
+
+class Pipeline(object):
+    """Process received messages in a pool before they are written.
+
+    put() only queues the message; one thread sends batches to the
+    pool, keeping a few of them in flight, and another hands the
+    results to the writer as each batch completes, in order.
+    """
+
+    def __init__(self, writer, stages=('decode',), workers=None,
+                 batch_size=BATCH_SIZE, ingest_queue=None):
+        self.log = logging.getLogger('mqtty.process')
+        self.writer = writer
+        self.stages = list(stages)
+        for name in self.stages:
+            # Fail early rather than in every batch.
+            resolve(name)
+        self.batch_size = batch_size
+        workers = workers or multiprocessing.cpu_count()
+        self.pool = makePool(workers)
+        if ingest_queue is None:
+            ingest_queue = ingest.IngestQueue()
+        self.queue = ingest_queue
+        # Enough batches in flight to keep every process busy.
+        self.pending = queue.Queue(2 * workers)
+        self.lock = threading.Lock()
+        self.timings = collections.OrderedDict(
+            (name, 0.0) for name in self.stages)
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.threads = []
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def submit(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(0)
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.queue.put(None, force=True)
+                    break
+                batch.append(record)
+            future = self.pool.submit(
+                process, self.stages,
+                [(r.topic, r.payload) for r in batch])
+            # Blocks while enough batches are in flight.
+            self.pending.put((batch, future))
+        self.pending.put(None)
+
+    def collect(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch, future = item
+            try:
+                results, timings, errors = future.result()
+            except Exception:
+                # Write the messages as they were received rather than
+                # lose them.
+                self.log.exception("Unable to process %s messages" %
+                                   (len(batch),))
+                results = [r.payload for r in batch]
+                timings = [0.0] * len(self.stages)
+                errors = len(batch)
+            dropped = 0
+            for record, payload in zip(batch, results):
+                if payload is None:
+                    dropped += 1
+                    continue
+                if isinstance(payload, bytes):
+                    record.payload = payload
+                else:
+                    record.text = payload
+                    record.payload = payload.encode('utf8')
+                self.writer.put(record)
+            with self.lock:
+                for name, seconds in zip(self.stages, timings):
+                    self.timings[name] += seconds
+                self.processed += len(batch)
+                self.dropped += dropped
+                self.errors += errors
+
+    def run(self):
+        for target in (self.submit, self.collect):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Everything queued so far is processed and put to the writer.
+        self.queue.put(None, force=True)
+        for thread in self.threads:
+            thread.join()
+        self.pool.shutdown()
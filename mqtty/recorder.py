@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# The headless recorder.  Like mqtty.cmd, this must not import urwid or
+# any of the views.
+
+import fcntl
+import logging
+import signal
+import sys
+import threading
+import time
+
+from mqtty import api
+from mqtty import config
+from mqtty import db
+from mqtty import probe
+from mqtty import sync
+
+# Seconds between throughput log entries.
+STATS_INTERVAL = 60
+
+
+class Recorder(object):
+    """Record messages to the database without a user interface.
+
+    Only the MQTT client and the database writer run; the process
+    exits cleanly on SIGTERM or SIGINT.
+    """
+
+    def __init__(self, server=None, debug=False,
+                 path=config.DEFAULT_CONFIG_PATH):
+        self.server = server
+        self.config = config.Config(server, path=path, headless=True)
+        if debug:
+            level = logging.DEBUG
+        else:
+            level = logging.INFO
+        # Log to stderr so that the service manager collects it.
+        logging.basicConfig(stream=sys.stderr,
+                            format='%(asctime)s %(levelname)s %(message)s',
+                            level=level)
+        self.log = logging.getLogger('mqtty.Recorder')
+        self.log.debug("Starting")
+
+        self.lock_fd = open(self.config.lock_file, 'w')
+        try:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            print("error: another instance of mqtty is running for: %s" %
+                  self.config.server['name'])
+            sys.exit(1)
+
+        self.stopped = threading.Event()
+        self.db = db.Database(self, self.config.dburi, None)
+        self.sync = sync.Sync(self, False)
+
+    def stop(self, signum=None, frame=None):
+        self.log.info("Stopping on signal %s" % (signum,))
+        self.stopped.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.sync_thread = threading.Thread(target=self.sync.run)
+        self.sync_thread.daemon = True
+        self.sync_thread.start()
+        # Scripts may query the database and follow ingest through the
+        # local API while recording.
+        self.api = api.APIServer(self.db, self.sync.events,
+                                 self.config.socket_path)
+        self.api_thread = threading.Thread(target=self.api.run)
+        self.api_thread.daemon = True
+        self.api_thread.start()
+
+        writer = self.sync.writer
+        last_time = time.time()
+        last_written = 0
+        last_received = dict((c.name, 0) for c in self.sync.connections)
+        while not self.stopped.is_set():
+            self.stopped.wait(STATS_INTERVAL)
+            now = time.time()
+            written = writer.written
+            self.log.info(
+                "Wrote %s messages (%.1f/s), %s queued, %s dropped, "
+                "%s batches" % (
+                    written - last_written,
+                    (written - last_written) / (now - last_time),
+                    writer.qsize(), self.sync.dropped(), writer.batches))
+            for c in self.sync.connections:
+                received = c.received
+                if c.offline:
+                    state = "offline"
+                elif c.lag is None:
+                    state = "no lag yet"
+                else:
+                    state = "lag %.3fs" % (c.lag,)
+                self.log.info(
+                    "%s: received %s messages (%.1f/s), %s bytes, %s" % (
+                        c.name, received - last_received[c.name],
+                        (received - last_received[c.name]) /
+                        (now - last_time), c.received_bytes, state))
+                last_received[c.name] = received
+            if self.sync.filter:
+                for rule in self.sync.filter.rules:
+                    self.log.info("Filter %s: %s hits" %
+                                  (rule.name, rule.hits))
+            if self.sync.sampler:
+                for rule in self.sync.sampler.rules:
+                    self.log.info("Sampling %s (%s): stored %s of %s" %
+                                  (rule.topic, rule.policy, rule.stored,
+                                   rule.seen))
+            percentiles = self.sync.latency.percentiles()
+            if percentiles:
+                self.log.info("Probe latency: %s" %
+                              (probe.formatLatency(percentiles),))
+            pipeline = self.sync.pipeline
+            if pipeline:
+                self.log.info(
+                    "Processed %s messages, %s queued, %s dropped, "
+                    "%s errors; %s" % (
+                        pipeline.processed, pipeline.qsize(),
+                        pipeline.dropped, pipeline.errors,
+                        ', '.join('%s %.3fs' % t
+                                  for t in pipeline.timings.items())))
+            last_time = now
+            last_written = written
+        self.api.stop()
+        self.sync.stop()
+        self.log.info("Stopped after writing %s messages" %
+                      (writer.written,))
@@ -0,0 +1,257 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Replay of recorded messages: "mqtty replay [options] [FILTER...]".
+#
+# Messages are read from the database in the order they were received,
+# or from a file written by "mqtty export", and published to a broker
+# with the same intervals between them, scaled by --speed, or as fast
+# as possible with --fast.  A thread reads ahead of the publisher so
+# that it is never kept waiting for the database, and the publisher
+# waits while INFLIGHT messages are still on their way to the broker.
+
+import logging
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from six.moves import queue
+
+from mqtty import cmd
+from mqtty import config
+from mqtty import db
+from mqtty import importer
+
+# Messages read in one transaction.
+CHUNK_SIZE = 1000
+# Messages read ahead of the publisher.
+PREFETCH = 10000
+# Messages published but not yet sent (QoS 0) or acknowledged.
+INFLIGHT = 1000
+# Seconds to wait for the broker to accept the connection.
+CONNECT_TIMEOUT = 10.0
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 2.0
+
+
+class Replayer(object):
+    def __init__(self, server=None, path=config.DEFAULT_CONFIG_PATH,
+                 host=None, port=None, qos=0, speed=1.0, out=sys.stderr):
+        self.log = logging.getLogger('mqtty.replay')
+        self.config = config.Config(server, path=path, headless=True)
+        self.host = host or self.config.server['host']
+        self.port = port or self.config.server.get('port', 1883)
+        self.qos = qos
+        # None to publish as fast as possible.
+        self.speed = speed
+        self.out = out
+        self.queue = queue.Queue(PREFETCH)
+        self.connected = threading.Event()
+        self.connect_error = None
+        self.condition = threading.Condition()
+        self.published = 0
+        self.completed = 0
+        self.skew_total = 0.0
+        self.skew_max = 0.0
+
+    def readDatabase(self, filters, since, until):
+        database = db.Database(self, self.config.dburi, None, read_only=True)
+        with database.getSession() as session:
+            topics = session.getTopics()
+        names = dict((t.key, t.name) for t in topics
+                     if any(mqtt.topic_matches_sub(f, t.name)
+                            for f in filters))
+        after = None
+        while True:
+            with database.getSession() as session:
+                rows = session.getMessageRange(
+                    list(names), after, since, until, CHUNK_SIZE,
+                    sort_by='updated')
+            for key, topic_key, updated, message in rows:
+                self.queue.put((names[topic_key], updated,
+                                message.encode('utf8')))
+            if len(rows) < CHUNK_SIZE:
+                break
+            after = (rows[-1][2], rows[-1][0])
+
+    def readFile(self, name, filters, since, until):
+        f = importer.openInput(name)
+        try:
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    continue
+                try:
+                    record = importer.parseJSON(line)
+                except Exception as e:
+                    self.log.debug("Skipping %r: %s" % (line, e))
+                    continue
+                if not any(mqtt.topic_matches_sub(t, record.topic)
+                           for t in filters):
+                    continue
+                if since is not None and record.updated < since:
+                    continue
+                if until is not None and record.updated >= until:
+                    continue
+                self.queue.put((record.topic, record.updated,
+                                record.payload))
+        finally:
+            if name != '-':
+                f.close()
+
+    def read(self, reader, *args):
+        try:
+            reader(*args)
+        except Exception:
+            self.log.exception("Unable to read messages")
+        finally:
+            self.queue.put(None)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.connect_error = mqtt.connack_string(rc)
+        self.connected.set()
+
+    def on_connect_fail(self, client, userdata):
+        self.connect_error = "connection failed"
+        self.connected.set()
+
+    def on_publish(self, client, userdata, mid):
+        with self.condition:
+            self.completed += 1
+            self.condition.notify_all()
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.qos == 0:
+            # paho discards unsent QoS 0 messages; stop waiting for them.
+            with self.condition:
+                self.completed = self.published
+                self.condition.notify_all()
+
+    def wait(self, inflight):
+        # Wait until at most inflight messages are outstanding.
+        with self.condition:
+            while self.published - self.completed > inflight:
+                self.condition.wait()
+
+    def report(self, start, final=False):
+        elapsed = max(time.time() - start, 1e-6)
+        line = "%s %s messages, %.1f/s" % (
+            'Replayed' if final else 'Published', self.published,
+            self.published / elapsed)
+        if self.speed is not None:
+            line += ", skew mean %.3fs max %.3fs" % (
+                self.skew_total / max(self.published, 1), self.skew_max)
+        self.out.write(line + '\n')
+        self.out.flush()
+
+    def run(self, reader, *args):
+        client = mqtt.Client()
+        client.on_connect = self.on_connect
+        client.on_connect_fail = self.on_connect_fail
+        client.on_publish = self.on_publish
+        client.on_disconnect = self.on_disconnect
+        # Let the publisher, not paho, decide how fast messages go;
+        # wait() keeps the messages paho holds to INFLIGHT.
+        client.max_inflight_messages_set(0)
+        client.connect_async(self.host, self.port)
+        client.loop_start()
+        if not self.connected.wait(CONNECT_TIMEOUT) or self.connect_error:
+            client.loop_stop()
+            raise IOError("Unable to connect to %s:%s: %s" % (
+                self.host, self.port,
+                self.connect_error or "no answer after %ss" % (
+                    CONNECT_TIMEOUT,)))
+        thread = threading.Thread(target=self.read, args=(reader,) + args)
+        thread.daemon = True
+        thread.start()
+        first = None
+        start = last_report = time.time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            topic, updated, payload = item
+            now = time.time()
+            if self.speed is not None:
+                if first is None:
+                    first = updated
+                due = start + (updated - first).total_seconds() / self.speed
+                if due > now:
+                    time.sleep(due - now)
+                    now = time.time()
+                # How late the message is.
+                skew = now - due
+                self.skew_total += skew
+                self.skew_max = max(self.skew_max, skew)
+            self.wait(INFLIGHT - 1)
+            with self.condition:
+                self.published += 1
+            client.publish(topic, payload, self.qos)
+            if now - last_report >= PROGRESS_INTERVAL:
+                self.report(start)
+                last_report = now
+        self.wait(0)
+        client.disconnect()
+        client.loop_stop()
+        self.report(start, final=True)
+
+
+def main(argv):
+    parser = cmd.commandParser(
+        'replay', 'Publish recorded messages to a broker')
+    parser.add_argument('-i', dest='input',
+                        help='replay a file written by "mqtty export" '
+                        '("-" for stdin) rather than the database')
+    parser.add_argument('--host',
+                        help="the broker to publish to (default the "
+                        "server's)")
+    parser.add_argument('--port', type=int,
+                        help="the broker's port")
+    parser.add_argument('--qos', type=int, choices=(0, 1, 2), default=0,
+                        help='the QoS to publish with (default 0)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='how many times faster than recorded to '
+                        'publish (default 1)')
+    parser.add_argument('--fast', action='store_true',
+                        help='publish as fast as possible')
+    parser.add_argument('--since',
+                        help='only messages received at or after this '
+                        'time (UTC)')
+    parser.add_argument('--until',
+                        help='only messages received before this time (UTC)')
+    parser.add_argument('filters', nargs='*', default=['#'],
+                        help='MQTT topic filters to replay (default "#")')
+    args = parser.parse_args(argv)
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.DEBUG if args.debug else logging.WARNING)
+    if args.speed <= 0:
+        parser.error("the speed must be greater than 0")
+    speed = None if args.fast else args.speed
+    replayer = Replayer(args.server, args.path, args.host, args.port,
+                        args.qos, speed)
+    since = importer.parseTime(args.since)
+    until = importer.parseTime(args.until)
+    try:
+        if args.input:
+            replayer.run(replayer.readFile, args.input, args.filters,
+                         since, until)
+        else:
+            replayer.run(replayer.readDatabase, args.filters, since, until)
+    except KeyboardInterrupt:
+        return 1
+    except IOError as e:
+        sys.stderr.write("error: %s\n" % (e,))
+        return 1
+    return 0
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Per-topic sampling of the messages which are stored.  Each rule has
+# an MQTT topic filter and a policy, applied to every topic it matches
+# separately:
+#
+#   every-nth  store one in every "every" messages
+#   interval   store at most one message every "interval" seconds
+#   latest     store the last message received in each "interval"
+#              seconds, at the end of the interval
+#
+# The first rule which matches a topic applies.  The writer's taps see
+# every message before it is sampled.
+
+import threading
+import time
+
+from mqtty import filters
+
+# Number of topics whose matching rule is remembered.
+CACHE_SIZE = 10000
+# Maximum seconds between checks for held messages which are due.
+TICK = 1.0
+
+
+class Rule(object):
+    def __init__(self, index, topic, policy, every=1, interval=1.0):
+        self.index = index
+        self.topic = topic
+        self.policy = policy
+        self.every = every
+        self.interval = interval
+        self.seen = 0
+        self.stored = 0
+
+
+class Sampler(object):
+    """Decide which messages are stored.
+
+    store is called with the messages held by latest rules once they
+    are due.
+    """
+
+    def __init__(self, rules, store, cache_size=CACHE_SIZE):
+        self.rules = []
+        self.trie = filters.TopicTrie()
+        for i, r in enumerate(rules):
+            rule = Rule(i, r['topic'], r['policy'], r.get('every', 1),
+                        r.get('interval', 1.0))
+            self.rules.append(rule)
+            self.trie.add(rule.topic, rule)
+        self.store = store
+        self.cache_size = cache_size
+        self.topics = {}
+        # Per topic: a count for every-nth rules, the time of the last
+        # stored message for interval rules, or the held message and
+        # when it is due for latest rules.
+        self.state = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.tick = min([TICK] + [r.interval for r in self.rules
+                                  if r.policy == 'latest'])
+        self.running = True
+
+    def lookup(self, topic):
+        rule = self.topics.get(topic)
+        if rule is None:
+            rules = self.trie.match(topic)
+            if rules:
+                rule = min(rules, key=lambda r: r.index)
+            else:
+                rule = False
+            if len(self.topics) >= self.cache_size:
+                self.topics.clear()
+            self.topics[topic] = rule
+        return rule
+
+    def sample(self, record):
+        """Return True if the record is to be stored now."""
+        due = None
+        with self.lock:
+            rule = self.lookup(record.topic)
+            if not rule:
+                return True
+            rule.seen += 1
+            topic = record.topic
+            if rule.policy == 'every-nth':
+                count = self.state.get(topic, 0)
+                self.state[topic] = (count + 1) % rule.every
+                keep = count == 0
+            elif rule.policy == 'interval':
+                now = time.time()
+                last = self.state.get(topic)
+                keep = last is None or now - last >= rule.interval
+                if keep:
+                    self.state[topic] = now
+            else:
+                now = time.time()
+                held = self.state.get(topic)
+                if held is not None and held[1] <= now:
+                    # The interval is over but has not been flushed
+                    # yet; this record starts the next one.
+                    due = held[0]
+                    rule.stored += 1
+                    held = None
+                if held is None:
+                    self.state[topic] = [record, now + rule.interval, rule]
+                else:
+                    held[0] = record
+                keep = False
+            if keep:
+                rule.stored += 1
+        if due is not None:
+            self.store(due)
+        return keep
+
+    def flush(self, force=False):
+        now = time.time()
+        due = []
+        with self.lock:
+            for topic, held in list(self.state.items()):
+                if isinstance(held, list) and (force or held[1] <= now):
+                    del self.state[topic]
+                    held[2].stored += 1
+                    due.append(held[0])
+        for record in due:
+            self.store(record)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.tick)
+            self.flush()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        # Store whatever is still held.
+        self.flush(force=True)
@@ -0,0 +1,201 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# A ring of recently received messages in shared memory, for local
+# consumers which cannot afford a socket protocol.  This module does
+# not import urwid and may be used by other programs:
+#
+#   reader = shmring.Reader('mqtty-openstack')
+#   while True:
+#       for entry in reader.read():
+#           handle(entry.topic, entry.payload)  # memoryviews
+#           if not reader.valid(entry):
+#               # The slot was overwritten while it was being used.
+#               ...
+#
+# The segment starts with a header (magic, version, slot count, slot
+# size, then the number of messages written so far) followed by fixed
+# size slots.  Each slot holds its sequence number (one more than the
+# message number, or 0 while it is being written), the receive time,
+# the lengths of the topic and payload, the original payload size, the
+# topic and the payload, truncated to fit.  A reader which falls more
+# than a ring behind the writer, or finds that a slot does not hold the
+# message it expects, counts the lost messages in Reader.dropped.
+
+import calendar
+import struct
+import threading
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+MAGIC = b'MQTR'
+VERSION = 1
+SLOTS = 4096
+SLOT_SIZE = 4096
+
+HEADER = struct.Struct('<4sIII')
+HEAD = struct.Struct('<Q')
+HEAD_OFFSET = HEADER.size
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct('<QdHII6x')
+SEQ = struct.Struct('<Q')
+
+
+class RingError(Exception):
+    pass
+
+
+def _check():
+    if shared_memory is None:
+        raise RingError("Shared memory requires Python 3.8 or later")
+
+
+class Ring(object):
+    """The writing side of the ring; owns the segment."""
+
+    def __init__(self, name, slots=SLOTS, slot_size=SLOT_SIZE):
+        _check()
+        if slot_size <= SLOT_HEADER.size:
+            raise RingError("Slot size must be more than %s bytes" %
+                            (SLOT_HEADER.size,))
+        size = HEADER_SIZE + slots * slot_size
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=size)
+        except FileExistsError:
+            # Left behind by an instance which did not exit cleanly.
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=size)
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buf = self.shm.buf
+        self.head = 0
+        self.lock = threading.Lock()
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, slots, slot_size)
+        HEAD.pack_into(self.buf, HEAD_OFFSET, 0)
+
+    def put(self, record):
+        topic = record.topic.encode('utf8')
+        payload = record.payload
+        updated = calendar.timegm(record.updated.utctimetuple()) + (
+            record.updated.microsecond / 1e6)
+        space = self.slot_size - SLOT_HEADER.size
+        topic = topic[:min(space, 0xffff)]
+        stored = payload[:space - len(topic)]
+        with self.lock:
+            seq = self.head
+            offset = HEADER_SIZE + (seq % self.slots) * self.slot_size
+            buf = self.buf
+            # Mark the slot as being written before changing it.
+            SEQ.pack_into(buf, offset, 0)
+            start = offset + SLOT_HEADER.size
+            buf[start:start + len(topic)] = topic
+            start += len(topic)
+            buf[start:start + len(stored)] = stored
+            SLOT_HEADER.pack_into(buf, offset, seq + 1, updated, len(topic),
+                                  len(stored), len(payload))
+            self.head = seq + 1
+            HEAD.pack_into(buf, HEAD_OFFSET, self.head)
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class Entry(object):
+    __slots__ = ('seq', 'offset', 'topic', 'payload', 'updated', 'size')
+
+    def __init__(self, seq, offset, topic, payload, updated, size):
+        self.seq = seq
+        self.offset = offset
+        # memoryviews into the shared segment.
+        self.topic = topic
+        self.payload = payload
+        # Seconds since the epoch.
+        self.updated = updated
+        # The size of the original payload, which may be more than
+        # len(payload) if it did not fit in a slot.
+        self.size = size
+
+
+class Reader(object):
+    """Read messages from a ring written by another process."""
+
+    def __init__(self, name, oldest=False):
+        _check()
+        self.shm = shared_memory.SharedMemory(name)
+        try:
+            # The segment belongs to the writer; do not remove it when
+            # this process exits.
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        except Exception:
+            pass
+        self.buf = self.shm.buf
+        magic, version, self.slots, self.slot_size = HEADER.unpack_from(
+            self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise RingError("%s is not a message ring" % (name,))
+        head = self.head()
+        if oldest:
+            self.position = max(0, head - self.slots)
+        else:
+            self.position = head
+        self.dropped = 0
+
+    def head(self):
+        return HEAD.unpack_from(self.buf, HEAD_OFFSET)[0]
+
+    def read(self, limit=None):
+        """Return the entries written since the last read."""
+        head = self.head()
+        if head - self.position > self.slots:
+            self.dropped += head - self.slots - self.position
+            self.position = head - self.slots
+        if limit is not None:
+            head = min(head, self.position + limit)
+        ret = []
+        buf = self.buf
+        while self.position < head:
+            seq = self.position
+            self.position += 1
+            offset = HEADER_SIZE + (seq % self.slots) * self.slot_size
+            slot_seq, updated, topic_len, payload_len, size = (
+                SLOT_HEADER.unpack_from(buf, offset))
+            if slot_seq != seq + 1:
+                # Overwritten (or being overwritten) already.
+                self.dropped += 1
+                continue
+            start = offset + SLOT_HEADER.size
+            topic = buf[start:start + topic_len]
+            start += topic_len
+            payload = buf[start:start + payload_len]
+            ret.append(Entry(seq, offset, topic, payload, updated, size))
+        return ret
+
+    def valid(self, entry):
+        """Whether the entry's slot still holds it."""
+        return SEQ.unpack_from(self.buf, entry.offset)[0] == entry.seq + 1
+
+    def close(self):
+        # Any memoryviews of entries must have been released first.
+        self.buf.release()
+        self.shm.close()
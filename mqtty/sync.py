@@ -15,7 +15,11 @@
 
 import collections
 import logging
+import multiprocessing
+import os
+import socket
 import threading
+import time
 
 try:
     import ordereddict
@@ -23,10 +27,19 @@ except ImportError:
     pass
 import requests
 import requests.utils
-from six.moves import queue
-
 import paho.mqtt.client as mqtt
 
+from mqtty import events
+from mqtty import fanout
+from mqtty import filters
+from mqtty import ingest
+from mqtty import journal
+from mqtty import notify
+from mqtty import probe
+from mqtty import process
+from mqtty import sampling
+from mqtty import shmring
+from mqtty import worker
 import mqtty.version
 
 HIGH_PRIORITY = 0
@@ -35,6 +48,11 @@ LOW_PRIORITY = 2
 
 TIMEOUT = 30
 
+RECONNECT_MAX_DELAY = 120
+
+# Seconds to wait for each connection's network loop to stop.
+STOP_TIMEOUT = 10
+
 
 class OfflineError(Exception):
     pass
@@ -119,45 +137,437 @@ class Sync(object):
         self.app = app
         self.log = logging.getLogger('mqtty.sync')
         self.q = MultiQueue([HIGH_PRIORITY, NORMAL_PRIORITY, LOW_PRIORITY])
-        self.result_queue = queue.Queue()
+        self.events = events.EventRing()
+        journal_config = self.app.config.journal
+        queue_config = self.app.config.ingest_queue
+
+        def makeQueue():
+            return ingest.makeQueue(queue_config)
+
+        if journal_config:
+            # Messages are safe once they are in the journal, so the
+            # database need not sync on every commit.  In WAL mode
+            # NORMAL still keeps the database itself from being
+            # corrupted, which replaying the journal could not repair.
+            self.journal = journal.Journal(journal_config['path'])
+            self.app.db.synchronous = 'NORMAL'
+            self.writer = ingest.Writer(
+                self.app.db, self.events, journal=self.journal,
+                checkpoint_interval=journal_config.get(
+                    'checkpoint-interval', journal.CHECKPOINT_INTERVAL),
+                ingest_queue=makeQueue())
+        else:
+            self.journal = None
+            self.writer = ingest.Writer(self.app.db, self.events,
+                                        ingest_queue=makeQueue())
+        self.notifier = notify.Notifier(self.app.config.notify_dir,
+                                        self.events)
+        fanout_config = self.app.config.fanout
+        if fanout_config:
+            socket_path = fanout_config.get('socket')
+            if socket_path:
+                socket_path = os.path.expanduser(socket_path)
+            self.fanout = fanout.FanoutServer(
+                fanout_config.get('port'), socket_path,
+                fanout_config.get('queue-size', fanout.QUEUE_SIZE))
+            self.writer.taps.append(self.fanout.put)
+        else:
+            self.fanout = None
+        shm_config = self.app.config.shared_memory
+        if shm_config:
+            self.ring = shmring.Ring(
+                shm_config['name'], shm_config.get('slots', shmring.SLOTS),
+                shm_config.get('slot-size', shmring.SLOT_SIZE))
+            self.writer.taps.append(self.ring.put)
+        else:
+            self.ring = None
+        # Measures the latency of probe messages, should there be any.
+        self.latency = probe.Latency()
+        self.writer.taps.append(self.latency.tap)
+        if self.app.config.sampling:
+            self.sampler = sampling.Sampler(self.app.config.sampling,
+                                            self.writer.store)
+            self.writer.sampler = self.sampler
+        else:
+            self.sampler = None
+        processing = self.app.config.processing
+        if processing:
+            self.pipeline = process.Pipeline(
+                self.writer, processing.get('stages', ['decode']),
+                processing.get('workers'),
+                processing.get('batch-size', process.BATCH_SIZE),
+                makeQueue())
+            self.ingest = self.pipeline
+        else:
+            self.pipeline = None
+            self.ingest = self.writer
+        if self.app.config.filters:
+            self.filter = filters.Filter(self.app.config.filters, self.ingest)
+            self.ingest = self.filter
+        else:
+            self.filter = None
         self.session = requests.Session()
-        # Create a websockets client
-        self.client = mqtt.Client()
+        self.stopped = threading.Event()
+
+        for name, setting in self.app.config.ignoredSettings():
+            self.log.warning("The %s of server %s is not used; messages "
+                             "from every server are recorded with the "
+                             "settings of %s" % (
+                                 setting, name,
+                                 self.app.config.server['name']))
+        # One client per broker, all feeding the same writer (through
+        # the filter and processing pipeline, if there are any).
+        self.connections = []
+        for server in self.app.config.servers:
+            if server.get('workers'):
+                self.connections.append(WorkerPool(self, server))
+            else:
+                self.connections.append(Connection(self, server))
+
+    def dropped(self):
+        """The number of messages dropped because ingest fell behind."""
+        dropped = self.writer.queue.dropped
+        if self.pipeline:
+            dropped += self.pipeline.queue.dropped
+        for connection in self.connections:
+            dropped += connection.dropped
+        return dropped
+
+    def offlineServers(self):
+        return dict((c.name, c.offline_since) for c in self.connections
+                    if c.offline_since is not None)
+
+    @property
+    def offline_since(self):
+        offline = self.offlineServers()
+        if offline:
+            return min(offline.values())
+        return None
+
+    def updateOffline(self):
+        self.offline = any(c.offline for c in self.connections)
+
+    def connectionFor(self, topic):
+        """Return the connection a topic is received from and the name
+        of the topic on its broker."""
+        for connection in self.connections:
+            if topic.startswith(connection.prefix):
+                return connection, topic[len(connection.prefix):]
+        return None, None
+
+    def subscribe(self, topic, qos=1):
+        connection, name = self.connectionFor(topic)
+        if connection is not None:
+            connection.subscribe(name, qos)
+
+    def unsubscribe(self, topic):
+        connection, name = self.connectionFor(topic)
+        if connection is not None:
+            connection.unsubscribe(name)
+
+    def run(self, pipe=None):
+        self.writer_thread = threading.Thread(target=self.writer.run)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+        if self.journal:
+            self.writer.replay()
+        self.notifier_thread = threading.Thread(target=self.notifier.run)
+        self.notifier_thread.daemon = True
+        self.notifier_thread.start()
+        if self.fanout:
+            self.fanout_thread = threading.Thread(target=self.fanout.run)
+            self.fanout_thread.daemon = True
+            self.fanout_thread.start()
+        if self.pipeline:
+            self.pipeline.run()
+        if self.sampler:
+            self.sampler_thread = threading.Thread(target=self.sampler.run)
+            self.sampler_thread.daemon = True
+            self.sampler_thread.start()
+        for connection in self.connections:
+            connection.thread = threading.Thread(target=connection.run)
+            connection.thread.daemon = True
+            connection.thread.start()
+        self.stopped.wait()
+
+    def stop(self):
+        for connection in self.connections:
+            connection.stop()
+        # No message may be put after the writer's stop marker.
+        for connection in self.connections:
+            if connection.thread is not None:
+                connection.thread.join(STOP_TIMEOUT)
+        self.stopped.set()
+        if self.pipeline:
+            self.pipeline.stop()
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler_thread.join()
+        # Everything received so far is written before stopping.
+        self.writer.finish()
+        self.writer_thread.join()
+        self.notifier.stop()
+        self.notifier_thread.join()
+        if self.fanout:
+            self.fanout.stop()
+        if self.ring:
+            self.writer.taps.remove(self.ring.put)
+            self.ring.close()
+        if self.journal:
+            self.journal.close()
+
+    def _run(self, pipe, task=None):
+        if not task:
+            task = self.q.get()
+        self.log.debug('Run: %s' % (task,))
+
+
+class Connection(object):
+    """The connection to one broker, with its own network loop."""
+
+    def __init__(self, sync, server):
+        self.sync = sync
+        self.app = sync.app
+        self.writer = sync.writer
+        self.name = server['name']
+        self.log = logging.getLogger('mqtty.sync.%s' % (self.name,))
+        if self.app.config.namespace_topics:
+            self.prefix = self.name + '/'
+        else:
+            self.prefix = ''
+        self.dedup = ingest.Deduplicator()
+        self.received = 0
+        self.received_bytes = 0
+        # Messages dropped before they reached the writer's queue.
+        self.dropped = 0
+        self.offline = False
+        self.offline_since = time.time()
+        self.thread = None
+
+        # Keep a persistent session by default so that the broker holds
+        # QoS 1 messages for us while we are away; that needs a client
+        # id which is the same every time.
+        clean_session = server.get('clean-session', False)
+        client_id = server.get('client-id')
+        if client_id is None and not clean_session:
+            client_id = 'mqtty-%s-%s' % (socket.gethostname(), self.name)
+        self.connect(server, client_id)
+
+    def connect(self, server, client_id):
+        clean_session = server.get('clean-session', False)
+        self.client = mqtt.Client(client_id=client_id or '',
+                                  clean_session=clean_session)
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        # paho doubles the delay after each failed attempt.
+        self.client.reconnect_delay_set(
+            1, server.get('reconnect-max-delay', RECONNECT_MAX_DELAY))
+
+        # The connection is made by the network loop, which also
+        # reconnects whenever it is lost.
+        self.log.debug("Connecting to %s" % (server['host'],))
+        self.client.connect_async(server['host'], server.get('port', 1883))
 
-        # Connect to the firehose
-        # FIREHOSE_HOST = 'firehose.openstack.org'
-        FIREHOSE_HOST = self.app.config.server['host']
-        self.log.debug("Connecting to " + FIREHOSE_HOST)
-        self.client.connect(FIREHOSE_HOST)
-        self.log.debug("Connected to " + FIREHOSE_HOST)
+    @property
+    def lag(self):
+        """Seconds the last message written from this broker waited
+        after it was received."""
+        return self.writer.lag.get(self.name)
 
     def on_connect(self, client, userdata, flags, rc):
-        self.log.debug("Connected with result code " + str(rc))
-        # FIXME: just for draft implementation
-        # self.client.subscribe('#')
-        self.client.subscribe(self.app.config.subscribed_topic['topic'])
+        if rc != 0:
+            self.log.error("Unable to connect to %s: %s" %
+                           (self.name, mqtt.connack_string(rc)))
+            return
+        self.log.debug("Connected with result code %s, session present %s" %
+                       (rc, flags.get('session present')))
+        if self.offline_since is not None:
+            self.log.info("Connected to %s after %.1f seconds offline" %
+                          (self.name, time.time() - self.offline_since))
+        self.offline_since = None
+        self.offline = False
+        self.sync.updateOffline()
+        self.sync.events.put(events.ConnectionEvent(self.name))
+        subscriptions = self.subscriptions()
+        if subscriptions:
+            self.client.subscribe(subscriptions)
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.offline_since is None:
+            self.offline_since = time.time()
+        self.offline = True
+        self.sync.updateOffline()
+        self.log.info("Disconnected from %s with result code %s" %
+                      (self.name, rc))
+        self.sync.events.put(events.ConnectionEvent(
+            self.name, self.offline_since))
 
     def on_message(self, client, userdata, msg):
-        # FIXME: just for draft implementation
-        self.log.debug("on_message called =================")
+        if self.dedup.check(msg):
+            self.log.debug("Dropping redelivered message %s on %s" %
+                           (msg.mid, msg.topic))
+            return
+        self.received += 1
+        self.received_bytes += len(msg.payload)
+        record = ingest.Record(self.prefix + msg.topic, msg.payload)
+        record.source = self.name
+        self.sync.ingest.put(record)
+
+    def subscriptions(self):
+        ret = collections.OrderedDict()
+        for topic in self.app.config.subscribed_topics:
+            ret[topic['topic']] = topic.get('qos', 1)
+        # Topics subscribed to from the topic list.
         with self.app.db.getSession() as session:
-            topic = session.getTopicByName(msg.topic)
-            if not topic:
-                topic = session.createTopic(msg.topic)
-            session.createMessage(str(msg.payload.decode('utf-8')), topic)
-        # self.app.db.append(msg)
-        self.log.debug(msg.topic + ": " + str(msg.payload))
-        self.app.refresh(force=True)
-
-    def run(self, pipe):
-        # task = None
-        self.client.loop_forever()
-        # while True:
-        #     task = self._run(pipe, task)
+            for topic in session.getTopics(subscribed=True):
+                if topic.name.startswith(self.prefix):
+                    ret.setdefault(topic.name[len(self.prefix):], 1)
+        return list(ret.items())
 
-    def _run(self, pipe, task=None):
-        if not task:
-            task = self.q.get()
-        self.log.debug('Run: %s' % (task,))
+    def subscribe(self, topic, qos=1):
+        self.log.info("Subscribing to %s on %s" % (topic, self.name))
+        # If we are offline this fails, but the subscription is made
+        # when we connect.
+        self.client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic):
+        for t in self.app.config.subscribed_topics:
+            if t['topic'] == topic:
+                # Configured subscriptions are always kept.
+                return
+        self.log.info("Unsubscribing from %s on %s" % (topic, self.name))
+        self.client.unsubscribe(topic)
+
+    def run(self):
+        self.client.loop_forever(retry_first_connection=True)
+
+    def stop(self):
+        self.client.disconnect()
+
+
+class WorkerPool(Connection):
+    """Several worker processes sharing a subscription to one broker.
+
+    The broker splits the stream between the workers, which receive
+    messages and send them here in batches to be written.
+    """
+
+    def connect(self, server, client_id):
+        self.lock = threading.Lock()
+        group = server.get('share-group', worker.SHARE_GROUP)
+        subscriptions = self.subscriptions()
+        # The time each worker which is not connected was lost.
+        self.worker_offline = {}
+        self.pipes = []
+        self.processes = []
+        self.threads = []
+        for i in range(server['workers']):
+            ours, theirs = multiprocessing.Pipe()
+            if client_id:
+                worker_id = '%s-%s' % (client_id, i)
+            else:
+                worker_id = None
+            child = multiprocessing.Process(
+                target=worker.run,
+                args=(server, worker_id, group, subscriptions, theirs,
+                      server.get('reconnect-max-delay',
+                                 RECONNECT_MAX_DELAY),
+                      self.app.config.ingest_queue),
+                name='mqtty-worker-%s-%s' % (self.name, i))
+            child.daemon = True
+            child.start()
+            theirs.close()
+            self.worker_offline[i] = self.offline_since
+            self.pipes.append(ours)
+            self.processes.append(child)
+        self.log.debug("Started %s workers for %s" %
+                       (len(self.processes), server['host']))
+
+    def receive(self, index):
+        pipe = self.pipes[index]
+        while True:
+            try:
+                items = pipe.recv()
+            except (EOFError, IOError):
+                self.log.error("Worker %s for %s exited" % (index, self.name))
+                break
+            if items == 'stopped':
+                break
+            count = 0
+            size = 0
+            for item in items:
+                if item[0] == 'message':
+                    topic, payload, updated = item[1:]
+                    count += 1
+                    size += len(payload)
+                    record = ingest.Record(self.prefix + topic, payload,
+                                           updated)
+                    record.source = self.name
+                    self.sync.ingest.put(record)
+                elif item[0] == 'dropped':
+                    with self.lock:
+                        self.dropped += item[1]
+                else:
+                    self.setOffline(index, item[1])
+            with self.lock:
+                self.received += count
+                self.received_bytes += size
+
+    def setOffline(self, index, offline_since):
+        with self.lock:
+            if offline_since is None:
+                self.worker_offline.pop(index, None)
+            else:
+                self.worker_offline[index] = offline_since
+            if self.worker_offline:
+                offline_since = min(self.worker_offline.values())
+            else:
+                offline_since = None
+            changed = offline_since != self.offline_since
+            self.offline_since = offline_since
+            self.offline = offline_since is not None
+        if changed:
+            if offline_since is None:
+                self.log.info("All workers for %s connected" % (self.name,))
+            self.sync.updateOffline()
+            self.sync.events.put(events.ConnectionEvent(
+                self.name, offline_since))
+
+    def send(self, command):
+        for pipe in self.pipes:
+            try:
+                pipe.send(command)
+            except (EOFError, IOError):
+                pass
+
+    def subscribe(self, topic, qos=1):
+        self.log.info("Subscribing to %s on %s" % (topic, self.name))
+        self.send(('subscribe', topic, qos))
+
+    def unsubscribe(self, topic):
+        for t in self.app.config.subscribed_topics:
+            if t['topic'] == topic:
+                return
+        self.log.info("Unsubscribing from %s on %s" % (topic, self.name))
+        self.send(('unsubscribe', topic))
+
+    def run(self):
+        for i in range(len(self.pipes)):
+            thread = threading.Thread(target=self.receive, args=(i,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self):
+        self.send(('stop',))
+        # Everything the workers received is put to the writer before
+        # it stops.
+        for thread in self.threads:
+            thread.join()
+        for child in self.processes:
+            child.join(5)
+            if child.is_alive():
+                child.terminate()
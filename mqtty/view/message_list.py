@@ -14,27 +14,40 @@
 # under the License.
 
 import logging
+
+import paho.mqtt.client as mqtt
 import urwid
 
+from mqtty import db
+from mqtty import events
 from mqtty import keymap
 from mqtty import mywid
 from mqtty.view import message as view_message
 from mqtty.view import mouse_scroll_decorator
 
 
+# Number of rows fetched from each topic at a time as the list is
+# scrolled.
+PAGE_SIZE = 100
+
+
 class MessageListHeader(urwid.WidgetWrap):
-    def __init__(self):
-        cols = [(6, urwid.Text(u' No.')),
-                urwid.Text(u'Message'),
-                (20, urwid.Text(u'Updated')),
-                (11, urwid.Text(u'Size(Chars)')),
-                ]
+    def __init__(self, show_topic=False):
+        cols = [(6, urwid.Text(u' No.'))]
+        if show_topic:
+            cols.append((30, urwid.Text(u'Topic')))
+        cols += [urwid.Text(u'Message'),
+                 (20, urwid.Text(u'Updated')),
+                 (11, urwid.Text(u'Size(Chars)')),
+                 ]
         super(MessageListHeader, self).__init__(urwid.Columns(cols))
 
 
 @mouse_scroll_decorator.ScrollByWheel
 class MessageListView(urwid.WidgetWrap, mywid.Searchable):
     title = "Message"
+    show_topic = False
+    subscriptions = (events.MessageAddedEvent,)
 
     def getCommands(self):
         return [
@@ -49,6 +62,8 @@ class MessageListView(urwid.WidgetWrap, mywid.Searchable):
              "Sync subscribed projects"),
             (keymap.TOGGLE_MARK,
              "Toggle the process mark for the selected project"),
+            (keymap.TOGGLE_TAIL,
+             "Toggle following new messages as they arrive"),
             (keymap.INTERACTIVE_SEARCH,
              "Interactive search"),
         ]
@@ -66,10 +81,24 @@ class MessageListView(urwid.WidgetWrap, mywid.Searchable):
         self.topic = topic
         self.reverse = False
         self.sort_by = 'key'
+        self.page_size = PAGE_SIZE
         self.message_rows = {}
+        self.topic_names = {}
+        self.merger = None
+        self.newest = None
+        self.seeds = {}
+        self.tail = False
+        self.tail_mark = None
+        self.tail_pending = []
+        self.tail_count = 0
+        self.count = 0
+        self.count_mark = None
+        self.loading = None
+        self.reload = False
+        self.placeholder = urwid.Text(u' Loading...')
         self.listbox = urwid.ListBox(urwid.SimpleFocusListWalker([]))
         self.refresh()
-        self.header = MessageListHeader()
+        self.header = MessageListHeader(self.show_topic)
         self._w.contents.append((app.header, ('pack', 1)))
         self._w.contents.append((urwid.Divider(), ('pack', 1)))
         self._w.contents.append(
@@ -83,34 +112,272 @@ class MessageListView(urwid.WidgetWrap, mywid.Searchable):
     def sizing(self):
         return frozenset([urwid.FIXED])
 
+    def getTopics(self):
+        return [self.topic]
+
     def refresh(self):
         self.log.debug('message_list refresh called ===============')
+        if self.busy():
+            self.reload = True
+            return
+        self.reload = False
+        if self.tail:
+            if self.tail_pending:
+                self.flushTail()
+            else:
+                # Shown again after events were missed; start over
+                # from the latest messages.
+                self.startTail()
+            return
+        if self.merger is None:
+            self.merger = db.MessageMerger(reverse=self.reverse)
+            self.showPrefetched()
+        if not len(self.listbox.body):
+            self.listbox.body.append(self.placeholder)
+        self.loading = self.app.executor.submit(
+            self, self._queryRefresh, self._showMessages,
+            self.merger, set(self.topic_names), self.newest, self.nearEnd(),
+            self.count_mark)
+
+    def showPrefetched(self):
+        # The prefetcher reads the first page in the default order;
+        # display it right away and continue paging from its cursor.
+        if self.topic is None or self.sort_by != 'key' or self.reverse:
+            return
+        cursor = self.app.prefetcher.take(self.topic.key)
+        if cursor is None:
+            return
+        for message in cursor.buffer:
+            self._trackNewest(message)
+            self.listbox.body.append(self._makeRow(self.topic.key, message))
+        cursor.buffer.clear()
+        self.seeds[self.topic.key] = cursor
 
-        len(self.listbox.body)
-        i = 0
+    def busy(self):
+        return self.loading is not None and not self.loading.cancelled()
+
+    def nearEnd(self):
+        body = self.listbox.body
+        if self.placeholder in body or not len(body):
+            return True
+        return self.listbox.focus_position >= len(body) - self.page_size // 2
+
+    def _queryRefresh(self, merger, known, newest, more, count_mark):
+        # Runs in an executor thread; the merger and its cursor are
+        # only ever used by one query at a time.  Every topic is read
+        # through a single cursor, a page at a time, and only when the
+        # rows are needed.
+        topics = [t for t in self.getTopics() if t.key not in known]
+        new_keys = [t.key for t in topics]
+        if new_keys and merger.cursors:
+            merger.cursors[0].addTopics(new_keys)
+        elif new_keys:
+            cursor = None
+            if self.topic is not None:
+                cursor = self.seeds.pop(self.topic.key, None)
+            if cursor is None:
+                cursor = db.MessageSetCursor(self.app.db, new_keys,
+                                             sort_by=self.sort_by,
+                                             reverse=self.reverse,
+                                             page_size=self.page_size)
+                if self.reverse:
+                    # Anything newer than what is already displayed is
+                    # picked up by _queryNewer instead.
+                    cursor.position = newest
+            merger.addCursor(cursor)
+        topic_keys = known | set(new_keys)
+        newer = []
+        if self.reverse and newest is not None:
+            newer = self._queryNewer(topic_keys, newest)
+        else:
+            merger.resume()
+        rows = []
+        if more:
+            rows = merger.take(self.page_size)
+        return merger, topics, newer, rows, self._queryCount(
+            known, new_keys, count_mark)
+
+    def _queryCount(self, known, new_keys, count_mark):
+        # Count only the messages stored since the last refresh, and
+        # those of topics which are new to the list.
         with self.app.db.getSession() as session:
-            message_list = session.getMessagesByTopic(
-                self.topic, sort_by=self.sort_by)
-            if self.reverse:
-                message_list.reverse()
-            for message in message_list:
-                key = message.key
-                row = self.message_rows.get(key)
-                if not row:
-                    row = MessageRow(message, self.onSelect)
-                    self.listbox.body.append(row)
-                    self.message_rows[key] = row
-                else:
-                    row.update(message)
-                i = i + 1
-
-        self.title = "Messages: " + str(i)
-        self.app.status.update(title=self.title)
+            last = session.getLastMessageKey()
+            if last is None:
+                return 0, count_mark
+            count = 0
+            if known and last != count_mark:
+                count += session.getMessageCount(
+                    list(known), after=count_mark, upto=last)
+            if new_keys:
+                count += session.getMessageCount(new_keys, upto=last)
+        return count, last
+
+    def _queryNewer(self, topic_keys, newest):
+        # When the list is in descending order, new messages belong at
+        # the top; fetch everything past the newest message we have in
+        # ascending order.
+        cursor = db.MessageSetCursor(self.app.db, topic_keys,
+                                     sort_by=self.sort_by,
+                                     page_size=self.page_size)
+        cursor.position = newest
+        merger = db.MessageMerger([cursor])
+        newer = []
+        while not merger.exhausted:
+            newer += merger.take(self.page_size)
+        return newer
+
+    def _queryMore(self, merger):
+        return merger, [], [], merger.take(self.page_size), None
+
+    def _showMessages(self, result):
+        self.loading = None
+        merger, topics, newer, rows, count = result
+        if self.placeholder in self.listbox.body:
+            self.listbox.body.remove(self.placeholder)
+        if merger is not self.merger:
+            # The sort order changed while the query was running.
+            self.refresh()
+            return
+        for topic in topics:
+            self.topic_names[topic.key] = topic.name
+        for topic_key, message in newer:
+            if message.key in self.message_rows:
+                continue
+            self._trackNewest(message)
+            self.listbox.body.insert(0, self._makeRow(topic_key, message))
+        for topic_key, message in rows:
+            if message.key in self.message_rows:
+                continue
+            self._trackNewest(message)
+            self.listbox.body.append(self._makeRow(topic_key, message))
+        if count is not None:
+            count, self.count_mark = count
+            self.count += count
+            self.title = self.getTitle(self.count)
+            if self.app.frame.body is self:
+                self.app.status.update(title=self.title)
+        if self.reload:
+            self.refresh()
+        else:
+            self.checkLoadMore()
+
+    def getTitle(self, count):
+        return "Messages: " + str(count)
+
+    def interested(self, event):
+        # Only new messages in the displayed topics matter; refresh
+        # reads just the messages past our keyset position, or in tail
+        # mode appends the rows collected here.
+        if event.topic_key not in self.topic_names:
+            return False
+        if self.tail:
+            self.tail_pending.append(event)
+            return True
+        # Only tail shows messages which were not stored.
+        return event.message_key is not None
+
+    def startTail(self):
+        self.clearMessageList()
+        self.tail = True
+        self.loading = self.app.executor.submit(
+            self, self._queryTail, self._showTail)
+
+    def _queryTail(self):
+        # Runs in an executor thread.  Read the last window of messages
+        # newest first, across all of the topics.
+        topics = self.getTopics()
+        cursor = db.MessageSetCursor(self.app.db, [t.key for t in topics],
+                                     reverse=True,
+                                     page_size=self.app.config.tail_window)
+        rows = db.MessageMerger([cursor], reverse=True).take(
+            self.app.config.tail_window)
+        rows.reverse()
+        with self.app.db.getSession() as session:
+            count = session.getMessageCount([t.key for t in topics])
+        return topics, rows, count
+
+    def _showTail(self, result):
+        self.loading = None
+        if not self.tail:
+            # Tail was turned off while loading.
+            if self.reload:
+                self.refresh()
+            return
+        topics, rows, count = result
+        for topic in topics:
+            self.topic_names[topic.key] = topic.name
+        for topic_key, message in rows:
+            self.listbox.body.append(self._makeRow(topic_key, message))
+            self.tail_mark = message.key
+        self.message_rows = {}
+        self.tail_count = count
+        self.flushTail()
+
+    def flushTail(self):
+        window = self.app.config.tail_window
+        body = self.listbox.body
+        following = (not len(body) or
+                     self.listbox.focus_position == len(body) - 1)
+        pending = self.tail_pending
+        self.tail_pending = []
+        self.tail_count += len(pending)
+        rows = []
+        for event in pending[-window:]:
+            if (event.message_key is not None and
+                    self.tail_mark is not None and
+                    event.message_key <= self.tail_mark):
+                continue
+            rows.append(MessageRow(
+                event.message_key, event.preview, event.updated, event.size,
+                self.onSelect, self._topicName(event.topic_key)))
+        body.extend(rows)
+        if len(body) > window:
+            del body[:len(body) - window]
+        if following and len(body):
+            self.listbox.set_focus(len(body) - 1)
+        self.title = self.getTitle(self.tail_count) + ' [tail]'
+        if self.app.frame.body is self:
+            self.app.status.update(title=self.title)
+
+    def _topicName(self, topic_key):
+        if self.show_topic:
+            return self.topic_names.get(topic_key)
+        return None
+
+    def _makeRow(self, topic_key, message):
+        row = MessageRow(message.key, message.message, message.updated,
+                         len(message.message), self.onSelect,
+                         self._topicName(topic_key))
+        self.message_rows[message.key] = row
+        return row
+
+    def _trackNewest(self, message):
+        key = (getattr(message, self.sort_by), message.key)
+        if self.newest is None or self.newest < key:
+            self.newest = key
+
+    def checkLoadMore(self):
+        if self.busy() or self.merger is None or self.merger.exhausted:
+            return
+        if self.nearEnd():
+            self.loadMore()
+
+    def loadMore(self):
+        self.loading = self.app.executor.submit(
+            self, self._queryMore, self._showMessages, self.merger)
 
     def clearMessageList(self):
-        for key, value in self.message_rows.items():
-            self.listbox.body.remove(value)
+        del self.listbox.body[:]
         self.message_rows = {}
+        self.topic_names = {}
+        self.merger = None
+        self.newest = None
+        self.seeds = {}
+        self.tail = False
+        self.tail_mark = None
+        self.tail_pending = []
+        self.count = 0
+        self.count_mark = None
 
     def keypress(self, size, key):
         if self.searchKeypress(size, key):
@@ -118,6 +385,7 @@ class MessageListView(urwid.WidgetWrap, mywid.Searchable):
 
         if not self.app.input_buffer:
             key = super(MessageListView, self).keypress(size, key)
+            self.checkLoadMore()
         keys = self.app.input_buffer + [key]
         commands = self.app.config.keymap.getCommands(keys)
         ret = self.handleCommands(commands)
@@ -157,14 +425,34 @@ class MessageListView(urwid.WidgetWrap, mywid.Searchable):
             self.clearMessageList()
             self.refresh()
             return True
+        if keymap.TOGGLE_TAIL in commands:
+            if self.tail:
+                self.clearMessageList()
+                self.refresh()
+            else:
+                self.sort_by = 'key'
+                self.reverse = False
+                self.startTail()
+            return True
         if keymap.INTERACTIVE_SEARCH in commands:
             self.searchStart()
             return True
 
     def onSelect(self, button, data):
-        message = data
-        self.app.changeScreen(view_message.MessageView(
-            self.app, message))
+        if data is None:
+            # Messages seen in tail mode which were not stored.
+            return
+        self.app.executor.submit(self, self._queryMessage, self._showMessage,
+                                 data)
+
+    def _queryMessage(self, key):
+        with self.app.db.getSession() as session:
+            return session.getMessage(key)
+
+    def _showMessage(self, message):
+        if message is not None and self.app.frame.body is self:
+            self.app.changeScreen(view_message.MessageView(
+                self.app, message))
 
 
 class MessageListColumns(object):
@@ -202,33 +490,71 @@ class MessageRow(urwid.Button):
         self.name.set_text(name)
 
     def search(self, search, attribute):
-        return self.name.search(search, attribute)
+        found = self.name.search(search, attribute)
+        if self.topic is not None:
+            found = self.topic.search(search, attribute) or found
+        return found
 
-    def __init__(self, message, callback=None):
+    def __init__(self, key, text, updated, size, callback=None,
+                 topic_name=None):
         super(MessageRow, self).__init__('', on_press=callback,
-                                         user_data=(message))
+                                         user_data=(key))
         self.mark = False
         self._style = None
         self.message_key = urwid.Text(u'', align=urwid.RIGHT)  # message.key
         self.name = mywid.SearchableText('')
-        self._setName(message.message)
+        self._setName(text)
         self.updated = urwid.Text(u'', align=urwid.RIGHT)
         self.size = urwid.Text(u'', align=urwid.RIGHT)
         self.name.set_wrap_mode('clip')
-        col = urwid.Columns([
-            ('fixed', 6, self.message_key),
+        cols = [('fixed', 6, self.message_key)]
+        self.topic = None
+        if topic_name is not None:
+            self.topic = mywid.SearchableText(u' ' + topic_name, wrap='clip')
+            cols.append(('fixed', 30, self.topic))
+        cols += [
             self.name,
             ('fixed', 20, self.updated),
             ('fixed', 11, self.size),
-        ])
+        ]
+        col = urwid.Columns(cols)
         self.row_style = urwid.AttrMap(col, '')
         self._w = urwid.AttrMap(self.row_style, None,
                                 focus_map=self.message_focus_map)
         self._style = None  # 'focused-message'
         self.row_style.set_attr_map({None: self._style})
-        self.update(message)
+        self.update(key, updated, size)
+
+    def update(self, key, updated, size):
+        if key is None:
+            self.message_key.set_text(u'- ')
+        else:
+            self.message_key.set_text('%i ' % key)
+        if updated is not None:
+            updated = updated.strftime('%Y-%m-%d %H:%M:%S')
+        self.updated.set_text(str(updated))
+        self.size.set_text('%i ' % size)
+
+
+class MultiTopicMessageListView(MessageListView):
+    """Messages of every topic matching an MQTT topic filter (which may
+    contain + and # wildcards), interleaved in sort order."""
+
+    show_topic = True
+    subscriptions = (events.TopicAddedEvent, events.MessageAddedEvent)
+
+    def __init__(self, app, topic_filter):
+        self.topic_filter = topic_filter
+        super(MultiTopicMessageListView, self).__init__(app, None)
+
+    def getTopics(self):
+        with self.app.db.getSession() as session:
+            return session.getTopicsByFilter(self.topic_filter)
+
+    def getTitle(self, count):
+        return "Messages: %s (%i)" % (self.topic_filter, count)
 
-    def update(self, message):
-        self.message_key.set_text('%i ' % message.key)
-        self.updated.set_text(str(message.updated))
-        self.size.set_text('%i ' % len(message.message))
+    def interested(self, event):
+        if isinstance(event, events.TopicAddedEvent):
+            return mqtt.topic_matches_sub(self.topic_filter, event.name)
+        return super(MultiTopicMessageListView, self).interested(event)
@@ -13,9 +13,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import bisect
 import logging
 import urwid
 
+from mqtty import db
+from mqtty import events
 from mqtty import keymap
 from mqtty import mywid
 from mqtty.view import message_list as view_message_list
@@ -53,6 +56,7 @@ class TopicListHeader(urwid.WidgetWrap):
 @mouse_scroll_decorator.ScrollByWheel
 class TopicListView(urwid.WidgetWrap, mywid.Searchable):
     title = "Topics"
+    subscriptions = (events.TopicAddedEvent, events.MessageAddedEvent)
 
     def getCommands(self):
         return [
@@ -62,7 +66,7 @@ class TopicListView(urwid.WidgetWrap, mywid.Searchable):
             (keymap.TOGGLE_LIST_REVIEWED,
              "Toggle listing of projects with unreviewed changes"),
             (keymap.TOGGLE_SUBSCRIBED,
-             "Toggle the subscription flag for the selected project"),
+             "Subscribe to or unsubscribe from the selected topic"),
             (keymap.REFRESH,
              "Sync subscribed projects"),
             (keymap.TOGGLE_MARK,
@@ -98,9 +102,17 @@ class TopicListView(urwid.WidgetWrap, mywid.Searchable):
         self.reverse = False
         self.project_rows = {}
         self.topic_rows = {}
+        # The sort keys of the rows in ascending order.
+        self.row_keys = []
         self.open_topics = set()
         self.sort_by = 'name'
+        self.loading = None
+        self.reload = False
+        self.message_mark = None
+        self.placeholder = urwid.Text(u' Loading...')
         self.listbox = urwid.ListBox(urwid.SimpleFocusListWalker([]))
+        urwid.connect_signal(self.listbox.body, 'modified',
+                             self.onFocusChanged)
         self.refresh()
         self.header = TopicListHeader()
         self._w.contents.append((app.header, ('pack', 1)))
@@ -118,41 +130,113 @@ class TopicListView(urwid.WidgetWrap, mywid.Searchable):
 
     def refresh(self):
         self.log.debug('topic_list refresh called ===============')
-
-        len(self.listbox.body)
-        # for row in self.listbox.body:
-        #     self.listbox.body.remove(row)
-        i = 0
+        if self.loading is not None and not self.loading.cancelled():
+            self.reload = True
+            return
+        self.reload = False
+        if not self.topic_rows and not len(self.listbox.body):
+            self.listbox.body.append(self.placeholder)
+        if self.topic_rows:
+            topic_mark = max(self.topic_rows)
+        else:
+            topic_mark = None
+        self.loading = self.app.executor.submit(
+            self, self._queryTopics, self._showTopics,
+            topic_mark, self.message_mark)
+
+    def _queryTopics(self, topic_mark, message_mark):
+        # Runs in an executor thread.  Only topics and messages added
+        # since the last refresh are read; messages are never removed,
+        # so their counts can be updated from the difference.
         with self.app.db.getSession() as session:
-            topic_list = session.getTopics(sort_by=self.sort_by)
-            if self.reverse:
-                topic_list.reverse()
-            for topic in topic_list:
-                num_msg = len(session.getMessagesByTopic(topic))
-                key = topic.key
-                row = self.topic_rows.get(key)
-                if not row:
-                    row = TopicRow(topic, num_msg, self.onSelect)
-                    self.listbox.body.append(row)
-                    self.topic_rows[key] = row
-                else:
-                    row.update(topic, num_msg)
-                i = i + 1
-
-        self.title = "Topics: " + str(i)
-        self.app.status.update(title=self.title)
-
-
-#            if i > 0:
-#                self.listbox.body.pop()
-        # for key in self.app.db.topics:
-        #     self.log.debug(key)
-        #     self.listbox.body.append(TopicRow(Topic(key, key + "_name")))
+            last_key = session.getLastMessageKey()
+            topic_list = session.getTopics(sort_by=self.sort_by,
+                                           after=topic_mark)
+            counts = session.getMessageCounts(after=message_mark,
+                                              upto=last_key)
+        return topic_list, counts, last_key
+
+    def _showTopics(self, result):
+        self.loading = None
+        topic_list, counts, last_key = result
+        if self.placeholder in self.listbox.body:
+            self.listbox.body.remove(self.placeholder)
+        if last_key is not None:
+            self.message_mark = last_key
+        for key, row in self.topic_rows.items():
+            if key in counts:
+                row.update(row.topic, row.num + counts[key])
+        for topic in topic_list:
+            row = TopicRow(topic, counts.get(topic.key, 0), self.onSelect)
+            self.topic_rows[topic.key] = row
+        if topic_list:
+            self.sortTopicList()
+
+        self.title = "Topics: " + str(len(self.topic_rows))
+        if self.app.frame.body is self:
+            self.app.status.update(title=self.title)
+        if self.reload:
+            self.refresh()
+
+    def interested(self, event):
+        # Events are applied to the rows directly; only fall back to
+        # a query if a row is missing.
+        if self.loading is not None and not self.loading.cancelled():
+            # The query may or may not include this event; read
+            # everything past the new mark once it completes.
+            self.reload = True
+            return False
+        if isinstance(event, events.TopicAddedEvent):
+            if event.topic_key not in self.topic_rows:
+                topic = db.Topic(event.name, key=event.topic_key)
+                row = TopicRow(topic, 0, self.onSelect)
+                self.topic_rows[topic.key] = row
+                self.insertTopicRow(row)
+                self.title = "Topics: " + str(len(self.topic_rows))
+                self.app.status.update(title=self.title)
+            return False
+        if event.message_key is None:
+            # Sampled out, so not counted.
+            return False
+        if (self.message_mark is not None and
+                event.message_key <= self.message_mark):
+            return False
+        row = self.topic_rows.get(event.topic_key)
+        if row is None:
+            return True
+        self.message_mark = event.message_key
+        row.update(row.topic, row.num + 1)
+        return False
+
+    def sortKey(self, row):
+        return (getattr(row.topic, self.sort_by), row.topic.key)
+
+    def sortTopicList(self):
+        rows = sorted(self.topic_rows.values(), key=self.sortKey,
+                      reverse=self.reverse)
+        self.row_keys = [self.sortKey(row) for row in rows]
+        if self.reverse:
+            self.row_keys.reverse()
+        focus = self.listbox.focus
+        self.listbox.body[:] = rows
+        if focus in rows:
+            self.listbox.set_focus(rows.index(focus))
+
+    def insertTopicRow(self, row):
+        # The rows are already in order, so a new one goes straight to
+        # its place rather than sorting them all again.
+        key = self.sortKey(row)
+        index = bisect.bisect(self.row_keys, key)
+        self.row_keys.insert(index, key)
+        if self.reverse:
+            index = len(self.row_keys) - 1 - index
+        self.listbox.body.insert(index, row)
 
     def clearTopicList(self):
-        for key, value in self.topic_rows.items():
-            self.listbox.body.remove(value)
+        del self.listbox.body[:]
         self.topic_rows = {}
+        self.row_keys = []
+        self.message_mark = None
 
     def keypress(self, size, key):
         if self.searchKeypress(size, key):
@@ -179,34 +263,66 @@ class TopicListView(urwid.WidgetWrap, mywid.Searchable):
             if not len(self.listbox.body):
                 return True
             self.sort_by = 'key'
-            self.clearTopicList()
-            self.refresh()
+            self.sortTopicList()
             return True
         if keymap.SORT_BY_TOPIC in commands:
             if not len(self.listbox.body):
                 return True
             self.sort_by = 'name'
-            self.clearTopicList()
-            self.refresh()
+            self.sortTopicList()
             return True
-
+        if keymap.SORT_BY_REVERSE in commands:
             if not len(self.listbox.body):
                 return True
             if self.reverse:
                 self.reverse = False
             else:
                 self.reverse = True
-            self.clearTopicList()
-            self.refresh()
+            self.sortTopicList()
+            return True
+        if keymap.TOGGLE_SUBSCRIBED in commands:
+            row = self.listbox.focus
+            if isinstance(row, TopicRow):
+                self.toggleSubscribed(row)
             return True
         if keymap.INTERACTIVE_SEARCH in commands:
             self.searchStart()
             return True
 
+    def toggleSubscribed(self, row):
+        if self.app.sync is None:
+            self.app.error("Subscriptions can not be changed by a "
+                           "read-only viewer")
+            return
+        with self.app.db.getSession() as session:
+            topic = session.getTopic(row.topic.key)
+            if topic is None:
+                return
+            topic.subscribed = not topic.subscribed
+            subscribed = topic.subscribed
+        row.topic.subscribed = subscribed
+        row.update(row.topic, row.num)
+        if subscribed:
+            self.app.sync.subscribe(row.topic.name)
+        else:
+            self.app.sync.unsubscribe(row.topic.name)
+
+    def onFocusChanged(self):
+        if self.app.frame.body is not self:
+            return
+        row = self.listbox.focus
+        if (isinstance(row, TopicRow) and
+                ('topic', row.topic.key) not in self.app.screen_cache.screens):
+            self.app.prefetcher.focus(row.topic.key)
+        else:
+            self.app.prefetcher.focus(None)
+
     def onSelect(self, button, data):
         topic = data
-        self.app.changeScreen(view_message_list.MessageListView(
-            self.app, topic))
+        self.app.prefetcher.cancel()
+        self.app.changeCachedScreen(
+            ('topic', topic.key),
+            lambda: view_message_list.MessageListView(self.app, topic))
 
 
 class TopicListColumns(object):
@@ -227,7 +343,7 @@ class TopicListColumns(object):
 
 class TopicRow(urwid.Button, TopicListColumns):
     topic_focus_map = {None: 'focused',
-                       # 'subscribed-project': 'focused-subscribed-project',
+                       'subscribed-project': 'focused-subscribed-project',
                        # 'marked-project': 'focused-marked-project',
                        }
 
@@ -265,8 +381,6 @@ class TopicRow(urwid.Button, TopicListColumns):
         self.row_style = urwid.AttrMap(col, '')
         self._w = urwid.AttrMap(self.row_style, None,
                                 focus_map=self.topic_focus_map)
-        self._style = None  # 'subscribed-project'
-        self.row_style.set_attr_map({None: self._style})
         # self.num_msg = num_msg
         self.update(topic, num_msg)
 
@@ -274,10 +388,20 @@ class TopicRow(urwid.Button, TopicListColumns):
         return self.name.search(search, attribute)
 
     def update(self, topic, num_msg):
+        self.topic = topic
+        self.num = num_msg
         # FIXME: showing 'topic_key' is just for debugging. This should be
         # removed.
         self.topic_key.set_text('%i ' % topic.key)
         self.num_msg.set_text('%i ' % num_msg)
+        if topic.subscribed:
+            style = 'subscribed-project'
+        else:
+            style = None
+        if style != self._style:
+            self._style = style
+            if not self.mark:
+                self.row_style.set_attr_map({None: style})
         # self._setName(str(topic.key) + " " + topic.name + " " + str(num_msg))
 
     def toggleMark(self):
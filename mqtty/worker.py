@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Ingest worker processes.  Each worker has its own connection to the
+# broker and subscribes through a shared subscription
+# ($share/<group>/<filter>), so that the broker splits the stream
+# between them.  Received messages are sent in batches over a pipe to
+# the process which writes the database.  Meanwhile they wait in a
+# queue with the ingest-queue limits and policy, so that a worker
+# whose writer falls behind blocks its broker connection or drops
+# messages as configured rather than growing without bound.
+#
+# Items sent to the writer are tuples:
+#
+#   ('message', topic, payload, updated)
+#   ('offline', offline_since)   # None once connected
+#   ('dropped', count)           # dropped since the last batch
+#
+# and the writer sends commands back:
+#
+#   ('subscribe', topic_filter, qos)
+#   ('unsubscribe', topic_filter)
+#   ('stop',)
+#
+# The worker answers 'stop' with a final batch and then 'stopped'.
+
+import logging
+import signal
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from six.moves import queue
+
+from mqtty import ingest
+
+SHARE_GROUP = 'mqtty'
+# Seconds between batches sent to the writer.
+FLUSH_INTERVAL = 0.05
+
+
+def shared(group, topic_filter):
+    return '$share/%s/%s' % (group, topic_filter)
+
+
+class Worker(object):
+    def __init__(self, server, client_id, group, subscriptions, pipe,
+                 reconnect_max_delay, queue_config):
+        self.log = logging.getLogger('mqtty.worker')
+        self.server = server
+        self.group = group
+        self.subscriptions = dict(subscriptions)
+        self.pipe = pipe
+        self.dedup = ingest.Deduplicator()
+        self.lock = threading.Lock()
+        self.outbox = ingest.makeQueue(queue_config)
+        # Connection state changes not yet sent.
+        self.status = []
+        self.reported_dropped = 0
+        self.offline_since = time.time()
+        self.running = True
+        self.client = mqtt.Client(
+            client_id=client_id or '',
+            clean_session=server.get('clean-session', False))
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.reconnect_delay_set(1, reconnect_max_delay)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self.log.error("Unable to connect: %s" %
+                           (mqtt.connack_string(rc),))
+            return
+        self.offline_since = None
+        with self.lock:
+            self.status.append(('offline', None))
+        if self.subscriptions:
+            self.client.subscribe(
+                [(shared(self.group, t), qos)
+                 for t, qos in self.subscriptions.items()])
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.offline_since is None:
+            self.offline_since = time.time()
+        with self.lock:
+            self.status.append(('offline', self.offline_since))
+
+    def on_message(self, client, userdata, msg):
+        if self.dedup.check(msg):
+            return
+        # Blocks the network loop while the outbox is full, if that is
+        # the policy; never once stopping, as nothing empties it then.
+        self.outbox.put(ingest.Record(msg.topic, msg.payload),
+                        force=not self.running)
+
+    def flush(self):
+        with self.lock:
+            items = self.status
+            self.status = []
+        while True:
+            try:
+                record = self.outbox.get(False)
+            except queue.Empty:
+                break
+            items.append(('message', record.topic, record.payload,
+                          record.updated))
+        dropped = self.outbox.dropped - self.reported_dropped
+        if dropped:
+            items.append(('dropped', dropped))
+            self.reported_dropped += dropped
+        if items:
+            self.pipe.send(items)
+
+    def handle(self, command):
+        if command[0] == 'subscribe':
+            topic, qos = command[1:]
+            self.subscriptions[topic] = qos
+            self.client.subscribe(shared(self.group, topic), qos)
+        elif command[0] == 'unsubscribe':
+            topic = command[1]
+            self.subscriptions.pop(topic, None)
+            self.client.unsubscribe(shared(self.group, topic))
+        elif command[0] == 'stop':
+            self.running = False
+
+    def run(self):
+        self.client.connect_async(self.server['host'],
+                                  self.server.get('port', 1883))
+        self.client.loop_start()
+        try:
+            while self.running:
+                # Wait for a command, or until the next batch is due.
+                while self.running and self.pipe.poll(FLUSH_INTERVAL):
+                    self.handle(self.pipe.recv())
+                self.flush()
+        except (EOFError, IOError):
+            # The writer has gone away.
+            self.running = False
+        # Release the network loop if it is waiting for room.
+        try:
+            self.flush()
+        except (EOFError, IOError):
+            pass
+        self.client.disconnect()
+        self.client.loop_stop()
+        try:
+            self.flush()
+            self.pipe.send('stopped')
+        except (EOFError, IOError):
+            pass
+        self.pipe.close()
+
+
+def run(server, client_id, group, subscriptions, pipe, reconnect_max_delay,
+        queue_config):
+    """The entry point of a worker process."""
+    # The writer decides when the workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Worker(server, client_id, group, subscriptions, pipe,
+           reconnect_max_delay, queue_config).run()